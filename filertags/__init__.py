@@ -1 +1,15 @@
 default_app_config = 'filertags.apps.FilerTagsConfig'
+
+
+def resolve_many(paths):
+    """Resolves an iterable of logical paths in batches, see filerfiles for
+    the queries it takes.
+
+    Returns a dict which maps every path to its actual url; paths that
+    can't be resolved map to what filerfile returns for them.
+    """
+    # imported here since the package is imported before the app registry
+    # is ready
+    from .templatetags.filertags import filerfiles
+    return filerfiles(paths)
+
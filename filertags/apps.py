@@ -7,4 +7,6 @@ class FilerTagsConfig(AppConfig):
     verbose_name = 'Django Filer TemplateTags'
 
     def ready(self):
-        import filertags.signals
\ No newline at end of file
+        import filertags.signals
+        from filertags import instrumentation
+        instrumentation.configure()
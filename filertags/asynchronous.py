@@ -0,0 +1,210 @@
+"""Async counterparts of filerfile, filerthumbnail and filerfiles for async
+views.
+
+Resolutions held by the manifest are answered without leaving the event
+loop. The caches are read with the async cache methods, which the cache
+backends shipped with Django implement by running their synchronous
+methods through sync_to_async, so a cache lookup costs a thread hop unless
+the backend has native async support. With Django's async ORM (4.1+) the
+indexed lookups are awaited natively and only the tree walks and the
+hashed name searches hop to a thread. Without it every lookup that misses
+the manifest runs the synchronous resolver through asgiref's
+sync_to_async, one thread hop per call; afilerfiles resolves a whole batch
+with a single hop.
+
+The resolvers record the same timers and counters as their synchronous
+counterparts, see filertags.instrumentation. This module needs Python 3.6;
+the rest of the package doesn't import it.
+"""
+import functools
+
+from django.db.models.query import QuerySet
+
+from filer.models.filemodels import File
+
+from . import caching, instrumentation, manifest
+from .lookups import chunks, find_hashed_files, get_possible_paths, \
+    get_stored_file_queries, hashed_files, log_miss, match_stored_files, \
+    non_polymorphic, walk_folder_tree, walk_folder_trees
+from .models import LogicalPath, hash_path
+from .settings import LOGICAL_EQ_ACTUAL_URL, LOGICAL_PATH_INDEX, \
+    LOGICAL_PATH_INDEX_FALLBACK
+from .templatetags.filertags import filerfile, filerfiles, filerthumbnail
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:  # Django < 3.0
+    sync_to_async = None
+
+# aget, afirst and async iteration over querysets came with Django 4.1,
+# the async cache methods with 4.0
+HAS_ASYNC_ORM = hasattr(QuerySet, 'aget')
+
+
+def _to_thread(func):
+    if sync_to_async is None:
+        # there is no event loop integration to speak of; keep the
+        # coroutine interface and run the lookup in place
+        async def run(*args):
+            return func(*args)
+        return run
+    return sync_to_async(func)
+
+
+def _timed(name):
+    """Coroutine counterpart of instrumentation.timed."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with instrumentation.timing(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _untimed(func):
+    # the synchronous resolvers run by the timed coroutines would record
+    # their timer a second time
+    return getattr(func, '__wrapped__', func)
+
+
+def _get_miss_value(path):
+    return path if LOGICAL_EQ_ACTUAL_URL else ''
+
+
+async def _afind_file(path):
+    if LOGICAL_PATH_INDEX:
+        entry = await LogicalPath.objects.select_related('file').filter(
+            path_hash=hash_path(path)).afirst()
+        if entry is not None:
+            return entry.file
+        if not LOGICAL_PATH_INDEX_FALLBACK:
+            return None
+    return await _to_thread(walk_folder_tree)(path)
+
+
+@_timed('filerthumbnail')
+async def afilerthumbnail(path):
+    """Async counterpart of filerthumbnail."""
+    if not HAS_ASYNC_ORM:
+        return await _to_thread(_untimed(filerthumbnail))(path)
+    filer_file = (await caching.aget_many(caching.FILE, [path])).get(path, caching.NOT_CACHED)
+    if filer_file is caching.NOT_CACHED:
+        filer_file = await _afind_file(path)
+        await caching.aset_many(caching.FILE, {path: filer_file})
+        if filer_file is None:
+            instrumentation.incr('filerthumbnail.miss')
+            return None
+        instrumentation.incr('filerthumbnail.resolved')
+    elif filer_file is None:
+        instrumentation.incr('filerthumbnail.cached_miss')
+        return None
+    else:
+        instrumentation.incr('filerthumbnail.cache_hit')
+    return filer_file.file
+
+
+async def _afind_url(path):
+    if not LOGICAL_EQ_ACTUAL_URL:
+        file_obj = await afilerthumbnail(path)
+        return file_obj.url if file_obj else None
+    files = [filer_file async for filer_file in
+             non_polymorphic(File.objects).filter(
+                 file__in=get_possible_paths(path))[:2]]
+    if len(files) == 1:
+        return files[0].url
+    candidates = hashed_files(path)
+    filer_file = await candidates.afirst() if candidates is not None else None
+    if filer_file:
+        instrumentation.incr('filerfile.fallback')
+        return filer_file.url
+    log_miss(path, 'No file found' if not files else 'Multiple files found')
+    return None
+
+
+@_timed('filerfile')
+async def afilerfile(path):
+    """Async counterpart of filerfile."""
+    path = path.strip('/')
+    url = manifest.lookup(path)
+    if url is not None:
+        instrumentation.incr('filerfile.manifest_hit')
+        return url
+    if not HAS_ASYNC_ORM:
+        return await _to_thread(_untimed(filerfile))(path)
+    url = (await caching.aget_many(caching.URL, [path])).get(path, caching.NOT_CACHED)
+    if url is caching.NOT_CACHED:
+        url = await _afind_url(path)
+        await caching.aset_many(caching.URL, {path: url})
+        if url is None:
+            instrumentation.incr('filerfile.miss')
+            return _get_miss_value(path)
+        instrumentation.incr('filerfile.resolved')
+    elif url is None:
+        instrumentation.incr('filerfile.cached_miss')
+        return _get_miss_value(path)
+    else:
+        instrumentation.incr('filerfile.cache_hit')
+    return url
+
+
+async def _afind_urls(paths):
+    """Async counterpart of _find_urls."""
+    if LOGICAL_EQ_ACTUAL_URL:
+        paths_by_storage_path, queries = get_stored_file_queries(paths)
+        candidates = []
+        for files in queries:
+            candidates.extend([filer_file async for filer_file in files])
+        files = match_stored_files(paths_by_storage_path, candidates)
+        missing = [path for path in paths if path not in files]
+        if missing:
+            files.update(await _to_thread(find_hashed_files)(missing))
+    else:
+        files = {}
+        if LOGICAL_PATH_INDEX:
+            paths_by_hash = dict((hash_path(path), path) for path in paths)
+            for chunk in chunks(paths_by_hash):
+                entries = LogicalPath.objects.select_related('file').filter(
+                    path_hash__in=chunk)
+                async for entry in entries:
+                    files[paths_by_hash[entry.path_hash]] = entry.file
+        missing = [path for path in paths if path not in files]
+        if missing and (not LOGICAL_PATH_INDEX or LOGICAL_PATH_INDEX_FALLBACK):
+            files.update(await _to_thread(walk_folder_trees)(missing))
+        await caching.aset_many(caching.FILE, files)
+    return dict((path, filer_file.url) for path, filer_file in files.items())
+
+
+@_timed('filerfiles')
+async def afilerfiles(paths):
+    """Async counterpart of filerfiles."""
+    normalized_paths = dict((path, path.strip('/')) for path in paths)
+    if not HAS_ASYNC_ORM:
+        return await _to_thread(_untimed(filerfiles))(list(normalized_paths))
+    wanted = set(normalized_paths.values())
+    urls = manifest.lookup_many(wanted)
+    if urls:
+        wanted -= set(urls)
+        instrumentation.incr('filerfiles.manifest_hit', len(urls))
+    cached = await caching.aget_many(caching.URL, wanted)
+    urls.update(cached)
+    missing = wanted - set(cached)
+    instrumentation.incr('filerfiles.cache_hit', len(cached))
+    if missing:
+        found = await _afind_urls(missing)
+        urls.update(found)
+        not_found = missing - set(found)
+        resolutions = dict.fromkeys(not_found)
+        resolutions.update(found)
+        await caching.aset_many(caching.URL, resolutions)
+        instrumentation.incr('filerfiles.resolved', len(found))
+        instrumentation.incr('filerfiles.miss', len(not_found))
+        for path in not_found:
+            log_miss(path, 'No file found')
+    return dict((path, urls.get(normalized) or _get_miss_value(normalized))
+                for path, normalized in normalized_paths.items())
+
+
+async def aresolve_many(paths):
+    """Async counterpart of filertags.resolve_many."""
+    return await afilerfiles(paths)
@@ -0,0 +1,258 @@
+"""Cache for the resolutions of logical paths.
+
+Lookups go through a small in-process LRU first and through the django
+cache named by FILERTAGS_CACHE_ALIAS second, so a warm page render
+resolves its paths without touching the database. Entries are
+invalidated from the File and Folder signal hooks in filertags.signals.
+
+Paths that can't be resolved are cached as None for MISS_CACHE_TIMEOUT
+seconds; saving a file invalidates the misses of its lookup paths too.
+Most cache backends can't tell a stored None from a missing key, so misses
+are stored in the django cache as a marker string.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+from .paths import normalize_path
+from .settings import CACHE_ENABLED, CACHE_ALIAS, CACHE_TIMEOUT, \
+    CACHE_KEY_PREFIX, LOCAL_CACHE_SIZE, LOCAL_CACHE_TIMEOUT, MISS_CACHE_TIMEOUT
+
+# kinds of cached values: filerfile caches urls, filerthumbnail filer files
+URL = 'url'
+FILE = 'file'
+KINDS = (URL, FILE)
+
+NOT_CACHED = object()
+
+# what a miss is stored as in the django cache
+_MISS = '__filertags_miss__'
+
+
+class LRUCache(object):
+    """Thread safe, size bounded mapping whose entries expire after
+    timeout seconds.
+    """
+
+    def __init__(self, maxsize, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                return default
+            # re-insert to mark the entry as the most recently used one
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        expires = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_local_cache = LRUCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_TIMEOUT)
+
+
+def _shared_cache():
+    return caches[CACHE_ALIAS]
+
+
+def make_key(kind, path):
+    digest = hashlib.md5(normalize_path(path).encode('utf-8')).hexdigest()
+    return '%s:%s:%s' % (CACHE_KEY_PREFIX, kind, digest)
+
+
+def _to_shared(value):
+    return _MISS if value is None else value
+
+
+def _from_shared(value):
+    return None if value == _MISS else value
+
+
+def _get_timeouts(value):
+    """Returns the local and shared cache timeouts for a cached value."""
+    if value is None:
+        return min(LOCAL_CACHE_TIMEOUT, MISS_CACHE_TIMEOUT), MISS_CACHE_TIMEOUT
+    return LOCAL_CACHE_TIMEOUT, CACHE_TIMEOUT
+
+
+def get(kind, path):
+    """Returns the cached resolution of path, None for a cached miss or
+    NOT_CACHED.
+    """
+    if not CACHE_ENABLED:
+        return NOT_CACHED
+    key = make_key(kind, path)
+    value = _local_cache.get(key, NOT_CACHED)
+    if value is NOT_CACHED:
+        value = _shared_cache().get(key, NOT_CACHED)
+        if value is not NOT_CACHED:
+            value = _from_shared(value)
+            _local_cache.set(key, value, _get_timeouts(value)[0])
+    return value
+
+
+def set(kind, path, value):
+    """Caches the resolution of path; None records a miss."""
+    if not CACHE_ENABLED:
+        return
+    key = make_key(kind, path)
+    local_timeout, timeout = _get_timeouts(value)
+    _local_cache.set(key, value, local_timeout)
+    _shared_cache().set(key, _to_shared(value), timeout)
+
+
+def _get_local_many(kind, paths):
+    """Returns the resolutions found in the local cache and a key -> path
+    dict of the ones to look up in the shared cache.
+    """
+    found = {}
+    missing = {}
+    for path in paths:
+        key = make_key(kind, path)
+        value = _local_cache.get(key, NOT_CACHED)
+        if value is NOT_CACHED:
+            missing[key] = path
+        else:
+            found[path] = value
+    return found, missing
+
+
+def _add_shared(found, missing, shared):
+    for key, value in shared.items():
+        value = _from_shared(value)
+        _local_cache.set(key, value, _get_timeouts(value)[0])
+        found[missing[key]] = value
+    return found
+
+
+def get_many(kind, paths):
+    """Returns a dict with the cached resolutions of the given paths."""
+    if not CACHE_ENABLED:
+        return {}
+    found, missing = _get_local_many(kind, paths)
+    if missing:
+        _add_shared(found, missing, _shared_cache().get_many(list(missing)))
+    return found
+
+
+async def aget_many(kind, paths):
+    """Async counterpart of get_many, for cache backends with async
+    methods (Django 4.0+).
+    """
+    if not CACHE_ENABLED:
+        return {}
+    found, missing = _get_local_many(kind, paths)
+    if missing:
+        _add_shared(found, missing, await _shared_cache().aget_many(list(missing)))
+    return found
+
+
+def _set_local_many(kind, values):
+    """Caches the resolutions of a path -> value dict locally and returns
+    (key -> value dict, timeout) pairs to store in the shared cache;
+    resolutions and misses expire after different timeouts.
+    """
+    resolved, misses = {}, {}
+    for path, value in values.items():
+        (misses if value is None else resolved)[make_key(kind, path)] = value
+    batches = []
+    for data in (resolved, misses):
+        if not data:
+            continue
+        local_timeout, timeout = _get_timeouts(next(iter(data.values())))
+        for key, value in data.items():
+            _local_cache.set(key, value, local_timeout)
+        batches.append((dict((key, _to_shared(value)) for key, value in data.items()),
+                        timeout))
+    return batches
+
+
+def set_many(kind, values):
+    """Caches the resolutions from a path -> value dict."""
+    if not CACHE_ENABLED or not values:
+        return
+    for data, timeout in _set_local_many(kind, values):
+        _shared_cache().set_many(data, timeout)
+
+
+async def aset_many(kind, values):
+    """Async counterpart of set_many."""
+    if not CACHE_ENABLED or not values:
+        return
+    for data, timeout in _set_local_many(kind, values):
+        await _shared_cache().aset_many(data, timeout)
+
+
+def invalidate(paths):
+    """Drops the cached resolutions of all the given logical paths."""
+    keys = [make_key(kind, path) for path in paths for kind in KINDS]
+    if not keys:
+        return
+    for key in keys:
+        _local_cache.delete(key)
+    _shared_cache().delete_many(keys)
+
+
+def _counter_key(name):
+    return '%s:counter:%s' % (CACHE_KEY_PREFIX, name)
+
+
+def _initial_counter_value():
+    # counters restart from the current time when they are evicted, so
+    # they don't fall back to a value a process might still hold
+    return int(time.time() * 1000)
+
+
+def get_counter(name):
+    """Returns the value of a counter shared by all the processes through
+    the django cache.
+    """
+    key = _counter_key(name)
+    value = _shared_cache().get(key)
+    if value is None:
+        # counters never expire; add keeps a concurrently set value
+        _shared_cache().add(key, _initial_counter_value(), None)
+        value = _shared_cache().get(key)
+    return value
+
+
+def incr_counter(name):
+    """Increments a shared counter."""
+    key = _counter_key(name)
+    try:
+        _shared_cache().incr(key)
+    except ValueError:
+        # the counter was never read or got evicted
+        _shared_cache().add(key, _initial_counter_value(), None)
+
+
+def clear_local():
+    _local_cache.clear()
@@ -0,0 +1,296 @@
+"""Single pass scanner for the parts of css filertags cares about.
+
+The scanner walks a stylesheet once and reports comments and url() tokens.
+Strings are skipped as a whole, so url( and /* appearing inside strings
+are not mistaken for tokens, and nothing inside a comment is reported
+as an url.
+
+Large stylesheets can be rewritten with bounded memory by feeding them in
+chunks to a CssRewriter.
+"""
+import re
+from collections import namedtuple
+
+URL = 'url'
+COMMENT = 'comment'
+
+# a token starts with a comment, a string or an url( which doesn't follow
+# a word character; the search always moves forward which keeps the
+# scanner linear in the size of the css
+_TOKEN_START_REGEX = re.compile(r"""/\*|["']|\burl\(""")
+# the longest prefix of a token start that can be split between two chunks
+_MAX_SPLIT_START_LENGTH = len('url(') - 1
+# the start of the annotation which may follow an url() token; an url at
+# the end of a chunk is only held back while the text following it might
+# still turn out to be its annotation
+_ANNOTATION_PREFIX = " /* logicalurl('"
+# comments which don't end within a chunk are carried over to the next one
+# up to this length; longer ones can't be annotations and are skipped
+# without being kept in memory
+_MAX_COMMENT_LENGTH = 4096
+_LOGICAL_URL_COMMENT_REGEX = re.compile(r"/\* logicalurl\('(.*)'\) \*/$")
+_IMPORT_COMMENT_REGEX = re.compile(r"/\* filertags-import\('(.*)'\) \*/$")
+# an @import rule with its target given either as url() or as a string,
+# followed by optional media queries
+_IMPORT_REGEX = re.compile(
+    r"""@import\s*(?:url\(\s*(["']?)([^"')]*)\1\s*\)|(["'])([^"'\n]*)\3)"""
+    r"""\s*([^;{}]*);""", re.I)
+
+
+class Token(namedtuple('Token', 'kind start end value')):
+    """A css token; value is the text between the parentheses of an url()
+    token and the full text of a comment token.
+    """
+
+
+def _skip_string(text, start):
+    """Returns the index following the string starting at start or None
+    if the string isn't terminated.
+    """
+    quote = text[start]
+    i = start + 1
+    length = len(text)
+    while i < length:
+        char = text[i]
+        if char == '\\':
+            i += 2
+            continue
+        if char == quote or char == '\n':
+            # an unescaped new line ends a (bad) string
+            return i + 1
+        i += 1
+    return None
+
+
+def _skip_open_string(text, start, quote):
+    """Skips the rest of a string whose content continues at start.
+    Returns the index following it and None, or, if it doesn't end
+    within text, the index from which to continue skipping it and quote.
+    """
+    i = start
+    length = len(text)
+    while i < length:
+        char = text[i]
+        if char == '\\':
+            if i + 1 == length:
+                # the escaped character is in the next chunk
+                return i, quote
+            i += 2
+            continue
+        if char == quote or char == '\n':
+            return i + 1, None
+        i += 1
+    return length, quote
+
+
+def _skip_open_comment(text, start):
+    """Comment counterpart of _skip_open_string."""
+    end = text.find('*/', start)
+    if end != -1:
+        return end + 2, None
+    # the end of the comment might be split between two chunks
+    return max(start, len(text) - 1) if text.endswith('*') else len(text), COMMENT
+
+
+def _find_url_end(text, start):
+    """Returns the index of the closing parenthesis of the url( whose
+    opening parenthesis precedes start or -1 if it isn't closed.
+    """
+    i = start
+    length = len(text)
+    while i < length and text[i] in ' \t\r\n\f':
+        i += 1
+    if i < length and text[i] in '"\'':
+        i = _skip_string(text, i)
+        if i is None:
+            return -1
+    return text.find(')', i)
+
+
+def _scan(text, position, final, state=None):
+    """Returns the tokens found in text starting from position, the index
+    up to which text was scanned and the state the scan ended in.
+
+    Unless final is set, more text is expected to follow: scanning stops at
+    the start of a token which might not be complete yet. Strings and long
+    comments which don't end within text are skipped instead; the returned
+    state, the quote of the string or COMMENT, tells that the text
+    following continues them and is passed back to scan it.
+    """
+    tokens = []
+    length = len(text)
+    if state == COMMENT:
+        position, state = _skip_open_comment(text, position)
+    elif state is not None:
+        position, state = _skip_open_string(text, position, state)
+    if state is not None:
+        return tokens, (length if final else position), None if final else state
+    while True:
+        match = _TOKEN_START_REGEX.search(text, position)
+        if match is None:
+            if final:
+                return tokens, length, None
+            # the start of a token might be split between two chunks
+            return tokens, max(position, length - _MAX_SPLIT_START_LENGTH), None
+        start = match.start()
+        marker = match.group()
+        if marker == '/*':
+            end = text.find('*/', start + 2)
+            if end == -1:
+                if final:
+                    # an unterminated comment extends to the end of the css
+                    tokens.append(Token(COMMENT, start, length, text[start:]))
+                    return tokens, length, None
+                if length - start <= _MAX_COMMENT_LENGTH:
+                    return tokens, start, None
+                end, state = _skip_open_comment(text, start + 2)
+                return tokens, end, state
+            end += 2
+            tokens.append(Token(COMMENT, start, end, text[start:end]))
+            position = end
+        elif marker in ('"', "'"):
+            end, state = _skip_open_string(text, start + 1, marker)
+            if state is not None:
+                if final:
+                    # an unterminated string extends to the end of the css
+                    return tokens, length, None
+                return tokens, end, state
+            position = end
+        else:
+            value_start = match.end()
+            value_end = _find_url_end(text, value_start)
+            if value_end == -1:
+                if not final:
+                    return tokens, start, None
+                position = value_start
+                continue
+            tokens.append(Token(URL, start, value_end + 1, text[value_start:value_end]))
+            position = value_end + 1
+
+
+def _may_be_annotated(following):
+    """Tells whether the text following an url() token at the end of a
+    chunk might still become its annotation.
+    """
+    if len(following) < len(_ANNOTATION_PREFIX):
+        return _ANNOTATION_PREFIX.startswith(following)
+    return following.startswith(_ANNOTATION_PREFIX) and \
+        len(following) <= _MAX_COMMENT_LENGTH + 1
+
+
+def iter_tokens(text):
+    """Yields the comment and url() tokens of a css, in order."""
+    tokens, _, _ = _scan(text, 0, True)
+    return iter(tokens)
+
+
+def replace_spans(text, replacements, start=0, end=None):
+    """Returns text[start:end] with the (start, end, new_text) replacements
+    applied; replacements have to be ordered and must not overlap.
+    """
+    end = len(text) if end is None else end
+    parts = []
+    position = start
+    for span_start, span_end, new_text in replacements:
+        parts.append(text[position:span_start])
+        parts.append(new_text)
+        position = span_end
+    parts.append(text[position:end])
+    return ''.join(parts)
+
+
+def get_logical_url(comment):
+    """Returns the logical url of a logicalurl('...') annotation or None."""
+    match = _LOGICAL_URL_COMMENT_REGEX.match(comment)
+    return match.group(1) if match else None
+
+
+def annotated_urls(text, tokens):
+    """Yields (start, end, logical url) for the url() tokens followed by a
+    single space and a logicalurl annotation; start and end span both the
+    url() token and the annotation.
+    """
+    previous = None
+    for token in tokens:
+        if (token.kind == COMMENT and previous is not None and
+                previous.kind == URL and previous.end + 1 == token.start and
+                text[previous.end] == ' '):
+            logical_url = get_logical_url(token.value)
+            if logical_url is not None:
+                yield previous.start, token.end, logical_url
+        previous = token
+
+
+def get_imported_url(comment):
+    """Returns the logical url of a filertags-import('...') marker or None."""
+    match = _IMPORT_COMMENT_REGEX.match(comment)
+    return match.group(1) if match else None
+
+
+def iter_leading_imports(text):
+    """Yields (start, end, url, media) for the @import rules at the start of
+    a css, the only place where they are allowed; scanning stops at the
+    first other rule and at rules which don't end within text.
+    """
+    position = 0
+    length = len(text)
+    while position < length:
+        if text[position].isspace():
+            position += 1
+        elif text.startswith('/*', position):
+            end = text.find('*/', position + 2)
+            if end == -1:
+                return
+            position = end + 2
+        elif text.startswith('@charset', position):
+            end = text.find(';', position)
+            if end == -1:
+                return
+            position = end + 1
+        else:
+            match = _IMPORT_REGEX.match(text, position)
+            if match is None:
+                return
+            url = match.group(2) if match.group(4) is None else match.group(4)
+            yield match.start(), match.end(), url.strip(), match.group(5).strip()
+            position = match.end()
+
+
+def iter_annotated_urls(text):
+    return annotated_urls(text, iter_tokens(text))
+
+
+class CssRewriter(object):
+    """Rewrites a css which is fed in chunks of text.
+
+    get_replacements(text, tokens) is called with the complete tokens of
+    each chunk and returns the ordered (start, end, new_text) replacements
+    to apply to text. Incomplete tokens at the end of a chunk are carried
+    over to the next one, so memory use is bounded by the chunk size and
+    the size of the largest url() token; strings and comments are skipped
+    across chunks without being kept.
+    """
+
+    def __init__(self, get_replacements):
+        self.get_replacements = get_replacements
+        self._pending = ''
+        # number of characters at the start of _pending that were already
+        # rewritten; they are kept as context for the \\b of url(
+        self._context = 0
+        # whether the pending text continues a string or a comment
+        self._state = None
+
+    def feed(self, text, final=False):
+        """Returns the rewritten text which can be written out so far."""
+        text = self._pending + text
+        tokens, end, self._state = _scan(text, self._context, final, self._state)
+        if (not final and tokens and tokens[-1].kind == URL and
+                _may_be_annotated(text[tokens[-1].end:])):
+            # an annotation might follow the url in the next chunk; the
+            # text after it is short and contains no open string
+            end = tokens.pop().start
+        output = replace_spans(
+            text, self.get_replacements(text, tokens), self._context, end)
+        self._context = 1 if end > 0 else 0
+        self._pending = text[end - self._context:]
+        return output
@@ -0,0 +1,213 @@
+"""Bundling of the css files imported with @import into the importing css.
+
+With FILERTAGS_CSS_BUNDLE_IMPORTS turned on, resolve_resource_urls inlines
+the css files imported by the leading @import rules of an uploaded css,
+all of them or none. The inlined content is enclosed in comments holding
+the logical url of the imported css:
+
+    /* filertags-import('/media/css/base.css') */
+    ...
+    /* filertags-endimport('/media/css/base.css') */
+
+The imported css files are recorded as references of the importing one,
+so that saving one of them rebuilds the bundles importing it, see
+rebuild_import_bundles. The css files whose @import rules couldn't be
+bundled yet, e.g. because an imported css wasn't uploaded, are bundled
+then as well.
+"""
+import re
+import urllib.parse
+
+from filer.models.filemodels import File
+
+from . import css as css_tools
+from . import signals
+from .lookups import find_files, non_polymorphic
+from .models import CssReference
+from .paths import normalize_path
+
+_IMPORT_START_TEMPLATE = "/* filertags-import('%s') */"
+_IMPORT_END_TEMPLATE = "/* filertags-endimport('%s') */"
+_IMPORT_START_REGEX = re.compile(r"/\* filertags-import\('([^']*)'\) \*/")
+
+
+def get_bundled_logical_urls(content):
+    """Returns the logical urls of the css files bundled into a css."""
+    return set(_IMPORT_START_REGEX.findall(content))
+
+
+def _is_relative_url(url):
+    url = url.strip('\'\" ')
+    parsed_url = urllib.parse.urlparse(url)
+    return not (parsed_url.scheme or parsed_url.netloc or url.startswith(('/', '#')))
+
+
+def get_bundled_content(css):
+    """Returns the content of a stored css to inline into the css files
+    importing it, or None if it can't be inlined: its urls are resolved
+    (and thereby rebased) only once it was parsed, @import rules it didn't
+    bundle itself would end up after other rules and relative urls it
+    didn't resolve would point elsewhere from the importing css.
+    """
+    try:
+        _, content = signals._read_stored_css(css)
+    except (IOError, ValueError):
+        return None
+    match = re.match(r'(@charset "[^"]*";)?%s\n?' % re.escape(
+        signals._ALREADY_PARSED_MARKER), content)
+    if match is None:
+        return None
+    content = content[match.end():]
+    if next(css_tools.iter_leading_imports(content), None) is not None:
+        return None
+    tokens = list(css_tools.iter_tokens(content))
+    annotated = set(start for start, _, _ in css_tools.annotated_urls(content, tokens))
+    if any(token.kind == css_tools.URL and token.start not in annotated and
+           _is_relative_url(token.value) for token in tokens):
+        return None
+    return content
+
+
+def imports_css(content, logical_file_path):
+    """Tells whether the css with the given logical path is bundled into
+    content.
+    """
+    return (_IMPORT_START_TEMPLATE % logical_file_path) in content
+
+
+def get_import_region(logical_file_path, content):
+    """Returns the content of an imported css enclosed in its markers."""
+    return '%s\n%s\n%s' % (_IMPORT_START_TEMPLATE % logical_file_path, content,
+                           _IMPORT_END_TEMPLATE % logical_file_path)
+
+
+def _get_import_region_regex(logical_file_path):
+    return re.compile(r'%s\n.*?\n%s' % (
+        re.escape(_IMPORT_START_TEMPLATE % logical_file_path),
+        re.escape(_IMPORT_END_TEMPLATE % logical_file_path)), re.S)
+
+
+def iter_import_rules(text, logical_folder_path):
+    """Yields (start, end, logical url, media) for the leading @import rules
+    of a css. The logical url of the rules whose url was resolved by
+    resolve_resource_urls is read from their annotation; it is None for
+    the css files not served from filer.
+    """
+    for start, end, url, media in css_tools.iter_leading_imports(text):
+        match = signals._LOGICAL_URL_REGEX.match(media)
+        if match is not None:
+            logical_url = match.group(1)
+            media = media[match.end():].strip()
+        else:
+            logical_url = signals._get_logical_url(logical_folder_path, url)
+        yield start, end, logical_url, media
+
+
+def get_import_bundles(text, logical_folder_path, css_file, contents=None):
+    """Returns the leading @import rules of a css as (start, end, logical
+    url) tuples of the css files they import, and the content to inline in
+    place of each of them.
+
+    The rules are bundled all together or not at all: inlining only some
+    of them would move the others after the inlined rules, where they are
+    ignored, or change the order of the rules. contents maps logical urls
+    to the content of css files known already, None for the ones which
+    can't be inlined.
+    """
+    rules = list(iter_import_rules(text, logical_folder_path))
+    imports = [(start, end, logical_url) for start, end, logical_url, _ in rules
+               if logical_url is not None]
+    if not rules or len(imports) < len(rules) or any(media for _, _, _, media in rules):
+        return imports, {}
+    logical_urls = set(logical_url for _, _, logical_url in imports)
+    contents = dict((logical_url, content) for logical_url, content
+                    in (contents or {}).items() if logical_url in logical_urls)
+    unknown = logical_urls - set(contents)
+    if unknown:
+        files = find_files(set(normalize_path(path) for path in unknown))
+        for logical_url in unknown:
+            imported_css = files.get(normalize_path(logical_url))
+            contents[logical_url] = get_bundled_content(imported_css) \
+                if imported_css is not None and signals._is_css(imported_css) else None
+    importing_path = urllib.parse.urljoin(
+        logical_folder_path, signals._get_filer_file_name(css_file))
+    for logical_url, content in contents.items():
+        # a css importing, directly or not, the css being bundled is left
+        # as an @import; inlining it would never end
+        if content is None or logical_url == importing_path or \
+                imports_css(content, importing_path):
+            return imports, {}
+    return imports, contents
+
+
+def rebuild_import_bundles(imported_css_files):
+    """Brings the bundles importing the css files of a logical url -> File
+    dict up to date: the inlined content is replaced with the current
+    content of the css files, and the css files that couldn't bundle their
+    @import rules yet are bundled now. The css files are saved, so the
+    bundles importing them in turn are rebuilt as well.
+    """
+    contents = dict((logical_file_path, get_bundled_content(imported_css))
+                    for logical_file_path, imported_css in imported_css_files.items())
+    imported_pks = set(imported_css.pk for imported_css in imported_css_files.values())
+    css_files = signals._get_referencing_css_files(list(contents))
+    for css in signals._iter_css_files(css_files):
+        if css.pk in imported_pks:
+            continue
+        try:
+            for _ in range(signals._CSS_UPDATE_ATTEMPTS):
+                if _rebuild_import_bundle(css, contents) is not None:
+                    break
+                # changed while it was being rebuilt; read it again
+                css = non_polymorphic(File.objects.filter(pk=css.pk)).first()
+                if css is None:
+                    break
+        except IOError:
+            # the filer database might have File entries that reference
+            # files no longer phisically exist
+            continue
+
+
+def _rebuild_import_bundle(css, contents):
+    encoding, old_content = signals._read_stored_css(css)
+    if not signals._is_already_parsed(old_content):
+        return False
+    logical_folder_path = signals._construct_logical_folder_path(css)
+    importing_path = urllib.parse.urljoin(
+        logical_folder_path, signals._get_filer_file_name(css))
+    new_content = old_content
+    for logical_file_path, content in contents.items():
+        if content is None or imports_css(content, importing_path):
+            # the imported css bundles this one by now
+            continue
+        region = get_import_region(logical_file_path, content)
+        new_content = _get_import_region_regex(logical_file_path).sub(
+            lambda match: region, new_content)
+    imports, bundles = get_import_bundles(
+        new_content, logical_folder_path, css, contents)
+    if bundles:
+        new_content = css_tools.replace_spans(new_content, [
+            (start, end, get_import_region(logical_url, bundles[logical_url]))
+            for start, end, logical_url in imports])
+        imports = []
+    if new_content == old_content:
+        return False
+    rewritten = signals._RewrittenContent(encoding)
+    rewritten.write(new_content, final=True)
+    written = signals._write_css_update(css, css.sha1, rewritten)
+    if written:
+        CssReference.objects.set_references(
+            css, signals.get_referenced_logical_urls(new_content) |
+            set(logical_url for _, _, logical_url in imports))
+    return written
+
+
+def rebuild_import_bundles_of(logical_file_paths):
+    """Rebuilds the bundles importing the css files among the logical paths."""
+    css_paths = [path for path in logical_file_paths if path.endswith('.css')]
+    if not css_paths:
+        return
+    files = find_files(set(normalize_path(path) for path in css_paths))
+    rebuild_import_bundles(dict(
+        (path, files[normalize_path(path)]) for path in css_paths
+        if normalize_path(path) in files))
@@ -0,0 +1,77 @@
+"""Gzip compressed copies of the css files rewritten by filertags.
+
+With FILERTAGS_CSS_GZIP turned on, the File hooks in filertags.signals
+store a compressed copy, named after the css with .gz appended, next to
+every css whose stored file changed, so that it can be served
+precompressed. The copy of the previous file is deleted when a css is
+stored under another name, and along with the css. The filertags_backfill
+command writes the copies of the css files stored before.
+"""
+import gzip
+import tempfile
+
+from django.core.files.base import File as DjangoFile
+
+from .paths import get_file_name
+from .settings import CSS_GZIP_LEVEL
+
+# the stored css is compressed in chunks of _CHUNK_SIZE bytes; compressed
+# content larger than _SPOOL_SIZE is kept in a temporary file on disk
+_CHUNK_SIZE = 64 * 1024
+_SPOOL_SIZE = 1024 * 1024
+
+
+def can_overwrite(storage):
+    # storages which overwrite existing files on save (e.g. the s3 storages
+    # of django-storages) flag it with file_overwrite; saving over the old
+    # file keeps its name and spares a delete round trip
+    return getattr(storage, 'file_overwrite', False)
+
+
+def get_compressed_name(name):
+    return '%s.gz' % name
+
+
+def save_compressed_copy(filer_file):
+    """Stores a gzip compressed copy of a stored file next to it."""
+    storage = filer_file.file.storage
+    name = filer_file.file.name
+    compressed = tempfile.SpooledTemporaryFile(max_size=_SPOOL_SIZE)
+    try:
+        # a fixed mtime keeps the compressed bytes identical for identical
+        # content
+        with storage.open(name, 'rb') as stored, gzip.GzipFile(
+                filename='', mode='wb', fileobj=compressed,
+                compresslevel=CSS_GZIP_LEVEL, mtime=0) as gzip_file:
+            for chunk in iter(lambda: stored.read(_CHUNK_SIZE), b''):
+                gzip_file.write(chunk)
+        compressed.seek(0)
+        compressed_name = get_compressed_name(name)
+        if not can_overwrite(storage):
+            storage.delete(compressed_name)
+        storage.save(compressed_name, DjangoFile(compressed, compressed_name))
+    finally:
+        compressed.close()
+
+
+def update_compressed_copy(css, previous, rewritten):
+    """Brings the compressed copy of a saved css up to date.
+
+    previous holds the stored name and sha1 of the css before it was
+    saved, None for new files; rewritten tells whether filertags rewrote
+    its content while it was saved.
+    """
+    name = css.file.name if css.file else None
+    storage = css.file.storage
+    if previous is not None and previous[0] and previous[0] != name and \
+            previous[0].endswith('.css'):
+        storage.delete(get_compressed_name(previous[0]))
+    if not name or not get_file_name(css).endswith('.css'):
+        return
+    if rewritten or previous is None or previous != (name, css.sha1):
+        try:
+            save_compressed_copy(css)
+        except IOError:
+            # the filer database might have File entries that reference
+            # files no longer phisically exist
+            pass
@@ -0,0 +1,147 @@
+"""Deferred updates of the css files referencing saved resources.
+
+With FILERTAGS_CSS_UPDATE_MODE set to 'deferred' the post save hook of a
+resource only enqueues its logical url. All the logical urls enqueued
+during a transaction are handed at once to the configured backend after
+the transaction commits, so a css referencing many of the saved resources
+is read and rewritten once instead of once per resource.
+
+Backends are classes with a process(logical_file_paths) method, set with
+FILERTAGS_CSS_UPDATE_BACKEND:
+
+    filertags.css_updates.InlineBackend   updates the css files right after
+                                          the commit, in the saving thread
+    filertags.css_updates.ThreadBackend   updates them in a worker thread of
+                                          the current process
+
+Other task queues can be plugged in with a backend which sends the logical
+urls to a task calling filertags.signals.update_css_files_referencing.
+"""
+import logging
+import queue
+import threading
+
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.utils.module_loading import import_string
+
+from .settings import CSS_UPDATE_BACKEND
+
+logger = logging.getLogger(__name__)
+
+
+class InlineBackend(object):
+
+    def process(self, logical_file_paths):
+        from .signals import update_css_files_referencing
+        update_css_files_referencing(logical_file_paths)
+
+
+class ThreadBackend(object):
+    """Updates the css files in a daemon thread; logical urls enqueued while
+    the worker is busy are coalesced into its next batch.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def process(self, logical_file_paths):
+        self._queue.put(set(logical_file_paths))
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='filertags-css-updates')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _next_batch(self):
+        batches = [self._queue.get()]
+        while True:
+            try:
+                batches.append(self._queue.get_nowait())
+            except queue.Empty:
+                return batches
+
+    def _run(self):
+        from .signals import update_css_files_referencing
+        while True:
+            batches = self._next_batch()
+            paths = set().union(*batches)
+            try:
+                update_css_files_referencing(paths)
+            except Exception:
+                logger.exception('Updating the css files referencing %d '
+                                 'resources failed', len(paths))
+            finally:
+                for connection in connections.all():
+                    connection.close()
+                for _ in batches:
+                    self._queue.task_done()
+
+    def join(self):
+        """Waits for the queued updates; meant for tests."""
+        self._queue.join()
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = import_string(CSS_UPDATE_BACKEND)()
+    return _backend
+
+
+def _flush(logical_file_paths):
+    if logical_file_paths:
+        get_backend().process(logical_file_paths)
+
+
+# the logical urls enqueued by this thread per database alias, waiting for
+# the transaction to commit
+_pending = threading.local()
+
+
+def _get_pending(alias):
+    if not hasattr(_pending, 'paths'):
+        _pending.paths = {}
+    return _pending.paths.setdefault(alias, set())
+
+
+def get_pending(using=None):
+    """Returns the logical urls enqueued by this thread which are waiting
+    for the transaction to commit.
+    """
+    return set(_get_pending(using or DEFAULT_DB_ALIAS))
+
+
+def flush_pending(using=None):
+    """Hands the logical urls enqueued by this thread to the backend."""
+    paths = _get_pending(using or DEFAULT_DB_ALIAS)
+    pending = set(paths)
+    paths.clear()
+    _flush(pending)
+
+
+def enqueue(logical_file_path, using=None):
+    """Queues the update of the css files referencing logical_file_path
+    until the current transaction commits. Outside of a transaction, or on
+    Django versions without transaction.on_commit, the update is done
+    immediately.
+
+    Every call registers a commit callback, since a rollback drops the
+    callbacks without telling; the first callback run after a commit
+    flushes all the logical urls of the thread and the others find nothing
+    left. The urls enqueued in a transaction that was rolled back are
+    flushed with the next commit, which only rewrites the css files with
+    the urls they already hold.
+    """
+    alias = using or DEFAULT_DB_ALIAS
+    if not hasattr(transaction, 'on_commit') or \
+            not transaction.get_connection(alias).in_atomic_block:
+        _flush(set([logical_file_path]))
+        return
+    _get_pending(alias).add(logical_file_path)
+    transaction.on_commit(lambda: flush_pending(alias), using=alias)
@@ -0,0 +1,125 @@
+"""In-process snapshot of the filer folder tree.
+
+With FILERTAGS_FOLDER_TREE_SNAPSHOT turned on, the folders of the logical
+paths resolved by filerthumbnail and filerfiles are looked up in memory in
+a (parent id, folder name) -> folder id map of the whole tree, loaded with
+a single query, so only the file itself is queried.
+
+The snapshot of every process is loaded again once the generation counter
+shared through the django cache named by FILERTAGS_CACHE_ALIAS changes.
+The counter is checked at most once every FILERTAGS_LOCAL_CACHE_TIMEOUT
+seconds and bumped by the Folder hooks in filertags.signals once the
+transaction changing the tree commits.
+
+Django < 1.9 can't run code after a commit, so a change made inside a
+transaction is announced before it's visible and another process may
+load the old tree again. A cache which doesn't keep the counter, like
+the DummyCache, never announces changes at all. The snapshot is
+therefore loaded again once it's older than FILERTAGS_FOLDER_TREE_MAX_AGE
+seconds whatever the counter says, and at every check when the counter
+can't be read.
+"""
+import threading
+import time
+
+from django.db import transaction
+
+from filer.models.foldermodels import Folder
+
+from . import caching
+from .settings import FOLDER_TREE_MAX_AGE, LOCAL_CACHE_TIMEOUT
+
+_GENERATION = 'folder-tree'
+
+
+class FolderTree(object):
+    """Snapshot of the folder tree at a given generation."""
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.loaded = time.time()
+        children = {}
+        ambiguous = set()
+        folders = Folder.objects.order_by().values_list('parent_id', 'name', 'pk')
+        for parent_id, name, pk in folders.iterator():
+            key = (parent_id, name)
+            if key in children:
+                ambiguous.add(key)
+            children[key] = pk
+        # sibling folders sharing a name can't be told apart, the same way
+        # a .get() would fail on them
+        for key in ambiguous:
+            del children[key]
+        self._children = children
+
+    def __len__(self):
+        return len(self._children)
+
+    def get_folder_id(self, folder_names):
+        """Returns the id of the folder at the end of a sequence of folder
+        names starting at the root, or None.
+        """
+        folder_id = None
+        for name in folder_names:
+            folder_id = self._children.get((folder_id, name))
+            if folder_id is None:
+                return None
+        return folder_id
+
+
+_lock = threading.Lock()
+_tree = None
+_checked = 0
+
+
+def get_tree():
+    """Returns the snapshot of this process, loading it again if the tree
+    changed since it was loaded.
+    """
+    global _tree, _checked
+    now = time.time()
+    tree = _tree
+    if tree is not None and now - _checked < LOCAL_CACHE_TIMEOUT:
+        return tree
+    with _lock:
+        # the generation is read before the tree so that changes made while
+        # it's loaded trigger another load
+        generation = caching.get_counter(_GENERATION)
+        if _tree is None or generation is None or _tree.generation != generation \
+                or now - _tree.loaded >= FOLDER_TREE_MAX_AGE:
+            _tree = FolderTree(generation)
+        _checked = now
+        return _tree
+
+
+def get_folder_ids(folder_paths):
+    """Maps tuples of folder names to folder ids."""
+    tree = get_tree()
+    folder_ids = ((folder_path, tree.get_folder_id(folder_path))
+                  for folder_path in folder_paths)
+    return dict((folder_path, folder_id) for folder_path, folder_id in folder_ids
+                if folder_id is not None)
+
+
+def reset():
+    """Makes the next lookup of this process load the snapshot again."""
+    global _tree, _checked
+    with _lock:
+        _tree = None
+        _checked = 0
+
+
+def invalidate():
+    """Drops the snapshot of this process right away and the ones of the
+    other processes once the current transaction commits.
+    """
+    reset()
+
+    def bump():
+        caching.incr_counter(_GENERATION)
+        # a load done before the commit might have missed the change
+        reset()
+    if hasattr(transaction, 'on_commit'):
+        transaction.on_commit(bump)
+    else:  # Django < 1.9
+        bump()
@@ -0,0 +1,249 @@
+"""Counters and timers for the resolution filters and the signal hooks.
+
+Instrumentation is off unless FILERTAGS_INSTRUMENTATION is set or a sink is
+added; when off, recording a metric costs a single check of the (empty)
+list of sinks and no query is counted.
+Sinks are configured with FILERTAGS_INSTRUMENTATION_SINKS, a list of
+dotted paths to classes with a record(metric) method, and can also be
+registered at runtime with add_sink.
+
+Timers report the duration of a call in seconds together with the number
+of queries it ran on the default database, counted by a wrapper around
+the executed queries; their sql isn't recorded. The async resolvers of
+filertags.asynchronous record the same timers and counters as their
+synchronous counterparts. Timers:
+
+    filerfile               the filerfile filter
+    filerthumbnail          the filerthumbnail filter
+    filerfiles              filerfiles and resolve_many
+    filerurls               rendering of a filerurls block
+    signals.<hook>          a signal hook of filertags.signals, named after
+                            its function: resolve_resource_urls,
+                            record_css_references, remember_stored_css,
+                            compress_stored_css, remember_compressed_css,
+                            delete_compressed_css,
+                            update_referencing_css_files,
+                            update_css_files_in_moved_folder,
+                            remember_file_lookup_paths,
+                            update_file_lookup_paths,
+                            remember_deleted_file_lookup_paths,
+                            invalidate_deleted_file_lookup_paths,
+                            remember_folder_path,
+                            update_folder_lookup_paths,
+                            invalidate_folder_tree,
+                            invalidate_deleted_folder_tree
+
+Counters report cache hits, misses and fallbacks:
+
+    filerfile.manifest_hit       resolution served from the manifest
+    filerfile.cache_hit          resolution served from the cache
+    filerfile.resolved           resolution found in the database
+    filerfile.fallback           resolution found by find_hashed_file
+    filerfile.miss               unresolved path, the raw path was returned
+    filerfile.cached_miss        unresolved path served from the miss cache
+    filerthumbnail.cache_hit     file served from the cache
+    filerthumbnail.resolved      file found in the database
+    filerthumbnail.miss          unresolved path, None was returned
+    filerthumbnail.cached_miss   unresolved path served from the miss cache
+    filerfiles.manifest_hit      paths of a batch served from the manifest
+    filerfiles.cache_hit         paths of a batch served from the cache
+    filerfiles.resolved          paths of a batch found in the database
+    filerfiles.miss              paths of a batch left unresolved; not
+                                 counted for the paths of filerurls blocks
+"""
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+
+from django.dispatch import Signal
+from django.utils.module_loading import import_string
+
+from .settings import INSTRUMENTATION, INSTRUMENTATION_SINKS
+
+logger = logging.getLogger(__name__)
+
+COUNTER = 'counter'
+TIMER = 'timer'
+
+# sent by SignalSink for every recorded metric
+metric_recorded = Signal()
+
+
+class Metric(namedtuple('Metric', 'kind name value queries')):
+    """A recorded metric; queries is only set for timers."""
+
+
+class LoggingSink(object):
+
+    def record(self, metric):
+        if metric.kind == TIMER:
+            logger.debug('%s took %.6fs and %d queries',
+                         metric.name, metric.value, metric.queries)
+        else:
+            logger.debug('%s +%d', metric.name, metric.value)
+
+
+class SignalSink(object):
+
+    def record(self, metric):
+        metric_recorded.send(sender=self.__class__, metric=metric)
+
+
+class MemorySink(object):
+    """Keeps all the recorded metrics in memory; meant for tests."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = defaultdict(int)
+            self.timings = defaultdict(list)
+            self.queries = defaultdict(list)
+
+    def record(self, metric):
+        with self._lock:
+            if metric.kind == TIMER:
+                self.timings[metric.name].append(metric.value)
+                self.queries[metric.name].append(metric.queries)
+            else:
+                self.counters[metric.name] += metric.value
+
+
+_sinks = []
+
+
+def configure():
+    """Instantiates the sinks from the settings; called once the app is ready."""
+    del _sinks[:]
+    if INSTRUMENTATION:
+        _sinks.extend(import_string(path)() for path in INSTRUMENTATION_SINKS)
+
+
+def add_sink(sink):
+    _sinks.append(sink)
+
+
+def remove_sink(sink):
+    _sinks.remove(sink)
+
+
+def _record(metric):
+    for sink in _sinks:
+        try:
+            sink.record(metric)
+        except Exception:
+            # a broken sink must never break rendering or uploads
+            logger.exception('Instrumentation sink %r failed', sink)
+
+
+def incr(name, value=1):
+    if _sinks:
+        _record(Metric(COUNTER, name, value, None))
+
+
+class _QueryCounter(object):
+    """Execute wrapper counting the queries run through a connection."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class _CountingCursor(object):
+    """Counts the queries executed by a cursor wrapper; used on Django
+    versions without execute_wrapper.
+    """
+
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._cursor.__exit__(*exc_info)
+
+    def execute(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+    def callproc(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.callproc(*args, **kwargs)
+
+
+@contextmanager
+def _count_queries(connection):
+    counter = _QueryCounter()
+    if hasattr(connection, 'execute_wrapper'):
+        with connection.execute_wrapper(counter):
+            yield counter
+        return
+    # Django < 2.0: the cursors of the connection are wrapped instead
+    factories = ('make_cursor', 'make_debug_cursor')
+    usual = dict((factory, connection.__dict__.get(factory)) for factory in factories)
+
+    def counting(make_cursor):
+        return lambda cursor: _CountingCursor(make_cursor(cursor), counter)
+    for factory in factories:
+        setattr(connection, factory, counting(getattr(connection, factory)))
+    try:
+        yield counter
+    finally:
+        for factory, make_cursor in usual.items():
+            if make_cursor is None:
+                delattr(connection, factory)
+            else:
+                setattr(connection, factory, make_cursor)
+
+
+@contextmanager
+def timing(name):
+    """Records the duration and the query count of the block as the timer
+    name; used by timed and by the async resolvers.
+    """
+    if not _sinks:
+        yield
+        return
+    from django.db import connections, DEFAULT_DB_ALIAS
+    with _count_queries(connections[DEFAULT_DB_ALIAS]) as queries:
+        started = time.time()
+        try:
+            yield
+        finally:
+            _record(Metric(TIMER, name, time.time() - started, queries.count))
+
+
+def timed(name):
+    """Decorator which records the duration and the query count of every
+    call of the decorated function.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return func(*args, **kwargs)
+            with timing(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,286 @@
+"""Lookups of filer files by logical path, shared by the template tags and
+their async counterparts in filertags.asynchronous.
+"""
+import itertools
+import logging
+import operator
+import re
+from functools import reduce
+
+from django.db.models import Q
+
+from filer.models import File, Folder
+import filer.settings as filer_settings
+
+from . import caching, folder_tree
+from .models import LogicalPath
+from .paths import get_file_name
+from .settings import LOGICAL_PATH_INDEX, LOGICAL_PATH_INDEX_FALLBACK, \
+    LOCAL_CACHE_SIZE, MISS_LOG_INTERVAL, FOLDER_TREE_SNAPSHOT
+
+# misses have always been logged under the logger of the template tags
+logger = logging.getLogger('filertags.templatetags.filertags')
+
+# unresolved paths logged during the last MISS_LOG_INTERVAL seconds
+_logged_misses = caching.LRUCache(LOCAL_CACHE_SIZE, MISS_LOG_INTERVAL)
+
+
+def log_miss(path, reason):
+    """Logs an unresolved path, at most once per MISS_LOG_INTERVAL seconds;
+    a broken reference on a busy page would otherwise flood the logs.
+    """
+    if _logged_misses.get(path) is None:
+        _logged_misses.set(path, True)
+        logger.info('%s on %s' % (reason, path))
+
+
+def q_matches_name(file_name):
+    return (Q(original_filename=file_name, name='') |
+            Q(original_filename=file_name, name__isnull=True) |
+            Q(name=file_name))
+
+
+def non_polymorphic(files):
+    """Returns the files of a queryset as plain File rows. The lookups only
+    read fields of File; downcasting costs a query per subclass (e.g. Image)
+    among the results.
+    """
+    if hasattr(files, 'non_polymorphic'):
+        return files.non_polymorphic()
+    return files
+
+
+def walk_folder_tree(path):
+    parts = path.strip('/').split('/')
+    folder_names = parts[:-1]
+    file_name = parts[-1]
+    if not path or not folder_names or not file_name:
+        return None
+
+    if FOLDER_TREE_SNAPSHOT:
+        folder_id = folder_tree.get_tree().get_folder_id(folder_names)
+        if folder_id is None:
+            log_miss(path, 'Folder matching query does not exist.')
+            return None
+        try:
+            return non_polymorphic(File.objects).get(
+                q_matches_name(file_name), Q(folder_id=folder_id))
+        except (File.DoesNotExist, File.MultipleObjectsReturned) as e:
+            log_miss(path, str(e))
+            return None
+
+    current_parent = None
+    try:
+        for folder_name in folder_names:
+            if not current_parent:
+                folder = Folder.objects.get(name=folder_name, parent__isnull=True)
+            else:
+                folder = Folder.objects.get(name=folder_name, parent=current_parent)
+            current_parent = folder
+        return non_polymorphic(File.objects).get(q_matches_name(file_name), Q(folder=folder))
+    except (File.DoesNotExist, File.MultipleObjectsReturned, Folder.DoesNotExist) as e:
+        log_miss(path, str(e))
+        return None
+
+
+def find_file(path):
+    if LOGICAL_PATH_INDEX:
+        filer_file = LogicalPath.objects.lookup(path)
+        if filer_file is not None or not LOGICAL_PATH_INDEX_FALLBACK:
+            return filer_file
+    # files saved before the index was built are only found by walking the tree
+    return walk_folder_tree(path)
+
+
+def get_possible_paths(path):
+    return ['%s/%s' % (storage['main']['UPLOAD_TO_PREFIX'], path)
+            for storage in list(filer_settings.FILER_STORAGES.values())]
+
+
+def hashed_files(path):
+    """Returns the files stored directly in the folder of path whose name
+    matches even though their upload name was modified (e.g. made unique
+    by storage), oldest first, or None if there are no storages.
+    """
+    path = path.strip('/')
+    slash_index = path.rfind('/')
+    folder_slug, file_name = path[:slash_index+1], path[slash_index+1:]
+    folder_paths = get_possible_paths(folder_slug)
+    if not folder_paths:
+        return None
+    # the startswith lookups can use the index on file, the regex makes sure
+    # the file is not stored in a subfolder of folder_path
+    in_folder = reduce(operator.or_, (Q(file__startswith=folder_path)
+                                      for folder_path in folder_paths))
+    direct_child_regex = r'^(%s)[^/]*$' % '|'.join(
+        re.escape(folder_path) for folder_path in folder_paths)
+    return non_polymorphic(File.objects).filter(
+        q_matches_name(file_name), in_folder,
+        file__regex=direct_child_regex).order_by('pk')
+
+
+def find_hashed_file(path):
+    """Finds a file stored directly in the folder of path whose name matches
+    even though its upload name was modified (e.g. made unique by storage).
+    """
+    files = hashed_files(path)
+    return files.first() if files is not None else None
+
+
+_QUERY_CHUNK_SIZE = 500
+
+
+def chunks(items, size=_QUERY_CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def q_matches_names(file_names):
+    return (Q(original_filename__in=file_names, name='') |
+            Q(original_filename__in=file_names, name__isnull=True) |
+            Q(name__in=file_names))
+
+
+def unique_matches(pairs):
+    """Builds a dict out of (key, value) pairs, leaving out the keys that
+    appear more than once the same way a .get() would fail on them.
+    """
+    matches = {}
+    ambiguous = set()
+    for key, value in pairs:
+        if key in matches:
+            ambiguous.add(key)
+        matches[key] = value
+    for key in ambiguous:
+        del matches[key]
+    return matches
+
+
+def find_folder_ids(folder_paths):
+    """Maps tuples of folder names to folder ids, resolving all the folders
+    of the same depth with a single query.
+    """
+    if FOLDER_TREE_SNAPSHOT:
+        return folder_tree.get_folder_ids(folder_paths)
+    resolved = {}
+    parents = {(): None}
+    depth = max(len(folder_path) for folder_path in folder_paths)
+    for level in range(1, depth + 1):
+        wanted = set(folder_path[:level] for folder_path in folder_paths
+                     if len(folder_path) >= level and folder_path[:level - 1] in parents)
+        if not wanted:
+            break
+        names = set(folder_path[-1] for folder_path in wanted)
+        parent_ids = set(parents[folder_path[:-1]] for folder_path in wanted)
+        found = []
+        for names_chunk in chunks(names):
+            if level == 1:
+                folders = Folder.objects.filter(parent__isnull=True, name__in=names_chunk)
+            else:
+                folders = Folder.objects.filter(parent__in=parent_ids, name__in=names_chunk)
+            found.extend(folders.values_list('parent_id', 'name', 'pk'))
+        found = unique_matches(((parent_id, name), pk) for parent_id, name, pk in found)
+        level_parents = {}
+        for folder_path in wanted:
+            key = (parents[folder_path[:-1]], folder_path[-1])
+            if key in found:
+                level_parents[folder_path] = found[key]
+        resolved.update(level_parents)
+        parents = level_parents
+    return resolved
+
+
+def walk_folder_trees(paths):
+    """Batch counterpart of walk_folder_tree."""
+    split_paths = {}
+    for path in paths:
+        parts = path.strip('/').split('/')
+        if len(parts) > 1 and parts[-1]:
+            split_paths[path] = (tuple(parts[:-1]), parts[-1])
+    if not split_paths:
+        return {}
+    folder_ids = find_folder_ids(set(folder_path for folder_path, _ in split_paths.values()))
+    wanted = {}
+    for path, (folder_path, file_name) in split_paths.items():
+        if folder_path in folder_ids:
+            wanted[(folder_ids[folder_path], file_name)] = path
+    if not wanted:
+        return {}
+    candidates = []
+    for ids_chunk in chunks(set(folder_id for folder_id, _ in wanted)):
+        for names_chunk in chunks(set(file_name for _, file_name in wanted)):
+            candidates.extend(non_polymorphic(File.objects).filter(
+                q_matches_names(names_chunk), folder__in=ids_chunk))
+    found = unique_matches(
+        ((filer_file.folder_id, get_file_name(filer_file)), filer_file)
+        for filer_file in candidates)
+    return dict((wanted[key], filer_file) for key, filer_file in found.items()
+                if key in wanted)
+
+
+def find_files(paths):
+    """Batch counterpart of find_file."""
+    found = {}
+    if LOGICAL_PATH_INDEX:
+        found.update(LogicalPath.objects.lookup_many(paths))
+        if not LOGICAL_PATH_INDEX_FALLBACK:
+            return found
+    missing = [path for path in paths if path not in found]
+    if missing:
+        found.update(walk_folder_trees(missing))
+    return found
+
+
+def get_stored_file_queries(paths):
+    """Returns the storage path -> logical path map of paths and the
+    querysets of the files stored at those storage paths, for
+    match_stored_files.
+    """
+    paths_by_storage_path = {}
+    for path in paths:
+        for storage_path in get_possible_paths(path):
+            paths_by_storage_path[storage_path] = path
+    return paths_by_storage_path, [
+        non_polymorphic(File.objects).filter(file__in=chunk)
+        for chunk in chunks(paths_by_storage_path)]
+
+
+def match_stored_files(paths_by_storage_path, candidates):
+    return unique_matches(
+        (paths_by_storage_path[filer_file.file.name], filer_file)
+        for filer_file in candidates)
+
+
+def find_stored_files(paths):
+    """Maps logical paths to the files stored at the same path."""
+    paths_by_storage_path, queries = get_stored_file_queries(paths)
+    return match_stored_files(
+        paths_by_storage_path, itertools.chain.from_iterable(queries))
+
+
+def find_hashed_files(paths):
+    """Batch counterpart of find_hashed_file."""
+    paths_by_location = {}
+    for path in paths:
+        slash_index = path.rfind('/')
+        folder_slug, file_name = path[:slash_index+1], path[slash_index+1:]
+        for folder_path in get_possible_paths(folder_slug):
+            paths_by_location[(folder_path, file_name)] = path
+    found = {}
+    for chunk in chunks(paths_by_location):
+        folder_paths = set(folder_path for folder_path, _ in chunk)
+        in_folders = reduce(operator.or_, (Q(file__startswith=folder_path)
+                                           for folder_path in folder_paths))
+        direct_child_regex = r'^(%s)[^/]*$' % '|'.join(
+            re.escape(folder_path) for folder_path in folder_paths)
+        candidates = non_polymorphic(File.objects).filter(
+            q_matches_names(set(file_name for _, file_name in chunk)), in_folders,
+            file__regex=direct_child_regex).order_by('pk')
+        for candidate in candidates:
+            stored_name = str(candidate.file)
+            location = (stored_name[:stored_name.rfind('/')+1], get_file_name(candidate))
+            path = paths_by_location.get(location)
+            if path is not None and path not in found:
+                found[path] = candidate
+    return found
@@ -0,0 +1,85 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from filer.models.filemodels import File
+
+from filertags.css_gzip import save_compressed_copy
+from filertags.models import CssReference, LogicalPath, hash_path
+from filertags.paths import get_all_folder_paths, normalize_path
+from filertags.settings import CSS_GZIP
+from filertags.signals import _get_css_encoding, _get_filer_file_name, \
+    get_referenced_logical_urls
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the filertags lookup tables for all the files in filer, '
+            'and the compressed copies of the css files with FILERTAGS_CSS_GZIP.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of rows inserted with a single query.')
+
+    def handle(self, *args, **options):
+        count = self.backfill_logical_paths(options['batch_size'])
+        self.stdout.write('Indexed %d logical paths.' % count)
+        count = self.backfill_css_references(options['batch_size'])
+        self.stdout.write('Indexed %d css references.' % count)
+        if CSS_GZIP:
+            count = self.backfill_compressed_css()
+            self.stdout.write('Compressed %d css files.' % count)
+
+    def backfill_logical_paths(self, batch_size):
+        folder_paths = get_all_folder_paths()
+        entries = {}
+        files = File.objects.filter(folder__isnull=False).order_by('pk').values_list(
+            'pk', 'folder_id', 'name', 'original_filename')
+        for pk, folder_id, name, original_filename in files.iterator():
+            path = '%s/%s' % (folder_paths[folder_id], name or original_filename)
+            # the most recent file wins when several share the same path,
+            # the same way the post save hook would have left it
+            path_hash = hash_path(path)
+            entries[path_hash] = LogicalPath(
+                path_hash=path_hash, path=path, file_id=pk)
+        with transaction.atomic():
+            LogicalPath.objects.all().delete()
+            LogicalPath.objects.bulk_create(
+                list(entries.values()), batch_size=batch_size)
+        return len(entries)
+
+    def backfill_css_references(self, batch_size):
+        references = []
+        css_files = File.objects.filter(original_filename__endswith='.css')
+        for css in css_files.iterator():
+            try:
+                content = css.file.read()
+                content = content.decode(
+                    _get_css_encoding(content, _get_filer_file_name(css)))
+            except (IOError, ValueError) as e:
+                self.stderr.write('Skipping %s: %s' % (css.pk, e))
+                continue
+            finally:
+                css.file.close()
+            paths = set(normalize_path(path)
+                        for path in get_referenced_logical_urls(content))
+            references.extend(
+                CssReference(css_id=css.pk, path_hash=hash_path(path), path=path)
+                for path in paths)
+        with transaction.atomic():
+            CssReference.objects.all().delete()
+            CssReference.objects.bulk_create(references, batch_size=batch_size)
+        return len(references)
+
+    def backfill_compressed_css(self):
+        count = 0
+        css_files = File.objects.filter(original_filename__endswith='.css')
+        for css in css_files.iterator():
+            if not css.file:
+                continue
+            try:
+                save_compressed_copy(css)
+            except IOError as e:
+                self.stderr.write('Skipping %s: %s' % (css.pk, e))
+                continue
+            count += 1
+        return count
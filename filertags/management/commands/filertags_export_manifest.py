@@ -0,0 +1,62 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from filer.models.filemodels import File
+
+from filertags import manifest
+from filertags.paths import get_all_folder_paths, get_file_name, \
+    get_storage_path
+from filertags.settings import LOGICAL_EQ_ACTUAL_URL, MANIFEST
+
+
+def iter_manifest_entries(chunk_size):
+    """Yields (path, url) for every file filerfile can resolve."""
+    # logical paths are built from all the folder paths, loaded at once,
+    # instead of querying the ancestors of every file
+    folder_paths = {} if LOGICAL_EQ_ACTUAL_URL else get_all_folder_paths()
+    files = File.objects.filter(folder__isnull=False).order_by('pk')
+    last_pk = 0
+    while True:
+        chunk = list(files.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            return
+        for filer_file in chunk:
+            if not filer_file.file:
+                continue
+            if LOGICAL_EQ_ACTUAL_URL:
+                path = get_storage_path(filer_file)
+            else:
+                path = '%s/%s' % (folder_paths[filer_file.folder_id],
+                                  get_file_name(filer_file))
+            if path is not None:
+                yield path, filer_file.url
+        last_pk = chunk[-1].pk
+
+
+class Command(BaseCommand):
+    help = ('Writes the logical path -> url manifest used to resolve paths '
+            'without querying the database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output',
+            help='Manifest file to write; defaults to FILERTAGS_MANIFEST.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Number of files loaded with a single query.')
+
+    def handle(self, *args, **options):
+        output = options['output'] or MANIFEST
+        if not output:
+            raise CommandError('Either set FILERTAGS_MANIFEST or use --output.')
+        started = time.time()
+        # the changes appended by the save hooks until now are part of the
+        # exported entries
+        delta_position = manifest.get_delta_position(output)
+        # later files win over earlier ones sharing the same path, the same
+        # way the LogicalPath table is built
+        entries = dict(iter_manifest_entries(options['chunk_size']))
+        count = manifest.replace(output, entries.items(), delta_position)
+        self.stdout.write('Wrote %d paths to %s in %.1fs.' % (
+            count, output, time.time() - started))
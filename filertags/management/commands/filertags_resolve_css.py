@@ -0,0 +1,123 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+    as_completed
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from filer.models.filemodels import File
+from filer.models.foldermodels import Folder
+
+from filertags.signals import reresolve_css
+
+
+def _close_connections():
+    for connection in connections.all():
+        connection.close()
+
+
+def reresolve_css_files(css_ids, dry_run):
+    """Resolves again the css files with the given ids.
+    Returns the number of processed, changed and failed css files.
+    """
+    processed = changed = failed = 0
+    for css in File.objects.filter(pk__in=css_ids):
+        processed += 1
+        try:
+            if reresolve_css(css, dry_run=dry_run):
+                changed += 1
+        except (IOError, ValueError):
+            # missing files and css with invalid charsets
+            failed += 1
+    return processed, changed, failed
+
+
+def _reresolve_css_files_in_worker(css_ids, dry_run):
+    try:
+        return reresolve_css_files(css_ids, dry_run)
+    finally:
+        # every worker opens its own database connections
+        _close_connections()
+
+
+def _iter_chunks(ids, chunk_size):
+    chunk = []
+    for pk in ids:
+        chunk.append(pk)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Command(BaseCommand):
+    help = ('Resolves again the resource urls of all the css files in filer, '
+            'e.g. after a storage migration or a filer upgrade.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--folder', type=int,
+            help='Only resolve the css files from the subtree of this folder id.')
+        parser.add_argument(
+            '--dry-run', action='store_true', default=False,
+            help='Report the css files that would change without saving them.')
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of css files resolved in parallel.')
+        parser.add_argument(
+            '--processes', action='store_true', default=False,
+            help='Use a pool of processes instead of threads.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=100,
+            help='Number of css files handed to a worker at once.')
+
+    def get_css_ids(self, folder_id):
+        css_files = File.objects.filter(original_filename__endswith='.css')
+        if folder_id is not None:
+            try:
+                folder = Folder.objects.get(pk=folder_id)
+            except Folder.DoesNotExist:
+                raise CommandError('Folder %s does not exist.' % folder_id)
+            css_files = css_files.filter(
+                folder__in=folder.get_descendants(include_self=True))
+        return list(css_files.order_by('pk').values_list('pk', flat=True).iterator())
+
+    def get_executor(self, workers, processes):
+        if processes:
+            # forked workers must not share the database connections of the
+            # parent process
+            _close_connections()
+            return ProcessPoolExecutor(max_workers=workers)
+        return ThreadPoolExecutor(max_workers=workers)
+
+    def iter_results(self, chunks, dry_run, workers, processes):
+        if workers <= 1:
+            for chunk in chunks:
+                yield reresolve_css_files(chunk, dry_run)
+            return
+        with self.get_executor(workers, processes) as executor:
+            futures = [executor.submit(_reresolve_css_files_in_worker, chunk, dry_run)
+                       for chunk in chunks]
+            for future in as_completed(futures):
+                yield future.result()
+
+    def handle(self, *args, **options):
+        css_ids = self.get_css_ids(options['folder'])
+        total = len(css_ids)
+        dry_run = options['dry_run']
+        processed = changed = failed = 0
+        started = time.time()
+        results = self.iter_results(
+            _iter_chunks(css_ids, options['chunk_size']), dry_run,
+            options['workers'], options['processes'])
+        for chunk_processed, chunk_changed, chunk_failed in results:
+            processed += chunk_processed
+            changed += chunk_changed
+            failed += chunk_failed
+            elapsed = time.time() - started
+            self.stdout.write('%d/%d css files, %d changed, %d failed (%.1f files/s)' % (
+                processed, total, changed, failed, processed / elapsed if elapsed else 0))
+        self.stdout.write('%s %d of %d css files in %.1fs.' % (
+            'Would change' if dry_run else 'Changed', changed, total,
+            time.time() - started))
@@ -0,0 +1,380 @@
+"""Precomputed logical path -> url manifest.
+
+With FILERTAGS_MANIFEST set to the name of a manifest file, filerfile and
+filerfiles answer from it before going to the cache or the database, so
+frontend processes resolve the paths it holds without any query.
+
+The manifest is a text file with one path<TAB>url line per file, sorted by
+path. Every process maps it in memory once and looks paths up with a
+binary search; the file is checked for changes at most once every
+FILERTAGS_LOCAL_CACHE_TIMEOUT seconds. It is written by the
+filertags_export_manifest command and kept up to date by the File and
+Folder hooks in filertags.signals.
+
+The hooks don't rewrite the manifest: they append their changes to a
+delta file, named after the manifest with .delta appended, which is read
+together with it. Removed paths are written without a url. Once the delta
+grows past FILERTAGS_MANIFEST_DELTA_SIZE bytes it is merged into the
+manifest; exporting the manifest again drops it as well. Changes made in
+a transaction are only appended once it commits, on Django versions with
+transaction.on_commit.
+"""
+import mmap
+import os
+import tempfile
+import threading
+import time
+from array import array
+
+from django.db import transaction, DEFAULT_DB_ALIAS
+
+from .paths import get_file_logical_path, get_storage_path, normalize_path
+from .settings import LOCAL_CACHE_TIMEOUT, LOGICAL_EQ_ACTUAL_URL, MANIFEST, \
+    MANIFEST_DELTA_SIZE
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+def get_manifest_path(filer_file):
+    """Returns the path under which filerfile looks filer_file up or None."""
+    if LOGICAL_EQ_ACTUAL_URL:
+        return get_storage_path(filer_file)
+    return get_file_logical_path(filer_file)
+
+
+def _is_valid_entry(path, url):
+    return not any(char in value for value in (path, url or '') for char in '\t\n')
+
+
+def _get_delta_name(filename):
+    return filename + '.delta'
+
+
+def _stat(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime, stat.st_size
+
+
+def _read_delta(filename):
+    """Returns the path -> url changes of a delta file, None urls for the
+    removed paths, and the identity of the file read.
+    """
+    delta = {}
+    try:
+        delta_file = open(_get_delta_name(filename), 'rb')
+    except (IOError, OSError):
+        return delta, None
+    with delta_file:
+        stat = os.fstat(delta_file.fileno())
+        for line in delta_file:
+            if not line.endswith(b'\n'):
+                # a change being appended
+                break
+            path, tab, url = line[:-1].partition(b'\t')
+            delta[path] = url.decode('utf-8') if tab else None
+    return delta, (stat.st_ino, stat.st_mtime, stat.st_size)
+
+
+class Manifest(object):
+    """Read only view of a manifest file and its delta."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._delta, self.delta_stat = _read_delta(filename)
+        with open(filename, 'rb') as manifest_file:
+            self.stat = os.fstat(manifest_file.fileno())
+            if self.stat.st_size:
+                self._data = mmap.mmap(manifest_file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # empty files can't be mapped
+                self._data = b''
+        self._offsets = array('Q')
+        position, size = 0, len(self._data)
+        while position < size:
+            self._offsets.append(position)
+            position = self._data.find(b'\n', position) + 1
+            if not position:
+                break
+
+    def __len__(self):
+        # the entries of the manifest file, without its delta
+        return len(self._offsets)
+
+    def _entry(self, index):
+        start = self._offsets[index]
+        end = self._data.find(b'\n', start)
+        path, _, url = self._data[start:end if end != -1 else len(self._data)].partition(b'\t')
+        return path, url
+
+    def get(self, path, default=None):
+        key = normalize_path(path).encode('utf-8')
+        if key in self._delta:
+            url = self._delta[key]
+            return url if url is not None else default
+        low, high = 0, len(self._offsets)
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self._offsets):
+            found, url = self._entry(low)
+            if found == key:
+                return url.decode('utf-8')
+        return default
+
+    def items(self):
+        for index in range(len(self._offsets)):
+            path, url = self._entry(index)
+            if path not in self._delta:
+                yield path.decode('utf-8'), url.decode('utf-8')
+        for path, url in self._delta.items():
+            if url is not None:
+                yield path.decode('utf-8'), url
+
+    def is_stale(self):
+        stat = _stat(self.filename)
+        return stat is None or stat != (
+            self.stat.st_ino, self.stat.st_mtime, self.stat.st_size) or \
+            _stat(_get_delta_name(self.filename)) != self.delta_stat
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+
+def write(filename, entries):
+    """Atomically replaces the manifest with the (path, url) entries."""
+    entries = sorted(
+        (normalize_path(path).encode('utf-8'), url.encode('utf-8'))
+        for path, url in entries if _is_valid_entry(path, url))
+    directory = os.path.dirname(os.path.abspath(filename))
+    descriptor, temporary = tempfile.mkstemp(dir=directory, prefix='.filertags-manifest-')
+    try:
+        with os.fdopen(descriptor, 'wb') as manifest_file:
+            last_path = None
+            count = 0
+            for path, url in entries:
+                if path == last_path:
+                    continue
+                manifest_file.write(b'%s\t%s\n' % (path, url))
+                last_path = path
+                count += 1
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, filename)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    return count
+
+
+class _FileLock(object):
+
+    def __init__(self, filename):
+        self.filename = filename + '.lock'
+
+    def __enter__(self):
+        self._file = open(self.filename, 'a')
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+
+
+def is_enabled():
+    return bool(MANIFEST)
+
+
+def get_delta_position(filename):
+    """Returns the identity of the current delta of a manifest, to hand to
+    replace once the manifest is exported.
+    """
+    stat = _stat(_get_delta_name(filename))
+    return stat and (stat[0], stat[2])
+
+
+def replace(filename, entries, delta_position=None):
+    """Replaces the manifest with the (path, url) entries, dropping the
+    changes of its delta up to delta_position since the entries include
+    them. Returns the number of entries written.
+    """
+    with _FileLock(filename):
+        count = write(filename, entries)
+        delta_name = _get_delta_name(filename)
+        stat = _stat(delta_name)
+        if stat is not None:
+            kept = b''
+            if delta_position is None or (stat[0], stat[2]) != delta_position:
+                # the delta might have been merged and started over since
+                # the export began; only the changes made since are kept
+                same_file = delta_position is not None and stat[0] == delta_position[0]
+                with open(delta_name, 'rb') as delta_file:
+                    if same_file:
+                        delta_file.seek(delta_position[1])
+                    kept = delta_file.read()
+            _replace_delta(delta_name, kept)
+    if filename == MANIFEST:
+        reset()
+    return count
+
+
+def _replace_delta(delta_name, content):
+    if not content:
+        os.unlink(delta_name)
+        return
+    directory = os.path.dirname(os.path.abspath(delta_name))
+    descriptor, temporary = tempfile.mkstemp(dir=directory, prefix='.filertags-manifest-')
+    with os.fdopen(descriptor, 'wb') as delta_file:
+        delta_file.write(content)
+    os.chmod(temporary, 0o644)
+    os.replace(temporary, delta_name)
+
+
+def _append(changes):
+    """Appends the path -> url changes to the delta of the manifest; None
+    urls remove the paths.
+    """
+    if not is_enabled() or not os.path.exists(MANIFEST):
+        # only exported manifests are kept up to date
+        return
+    lines = b''.join(
+        (b'%s\t%s\n' % (path.encode('utf-8'), url.encode('utf-8')) if url is not None
+         else b'%s\n' % path.encode('utf-8'))
+        for path, url in ((normalize_path(path), url) for path, url in changes.items())
+        if _is_valid_entry(path, url))
+    if not lines:
+        return
+    with _FileLock(MANIFEST):
+        with open(_get_delta_name(MANIFEST), 'ab') as delta_file:
+            delta_file.write(lines)
+            size = delta_file.tell()
+        if size > MANIFEST_DELTA_SIZE:
+            # the delta is read whole by every process, it's merged into the
+            # manifest once it grows too large
+            current = Manifest(MANIFEST)
+            try:
+                write(MANIFEST, current.items())
+            finally:
+                current.close()
+            os.unlink(_get_delta_name(MANIFEST))
+    # this process sees its own changes right away
+    reset()
+
+
+def _on_commit(func, using=None):
+    """Runs func once the current transaction commits, so the changes of a
+    rolled back transaction never reach the manifest. Outside of a
+    transaction, or on Django versions without transaction.on_commit,
+    func runs immediately.
+    """
+    alias = using or DEFAULT_DB_ALIAS
+    if not hasattr(transaction, 'on_commit') or \
+            not transaction.get_connection(alias).in_atomic_block:
+        func()
+        return
+    transaction.on_commit(func, using=alias)
+
+
+def update(changes, using=None):
+    """Merges a path -> url dict into the manifest once the transaction
+    commits; None urls remove the paths.
+    """
+    if changes:
+        _on_commit(lambda: _append(changes), using)
+
+
+def move(moves, using=None):
+    """Moves the urls of the (old path, new path) pairs to their new paths
+    once the transaction commits.
+    """
+    if moves:
+        _on_commit(lambda: _move(moves), using)
+
+
+def _move(moves):
+    if not is_enabled() or not os.path.exists(MANIFEST):
+        return
+    current = Manifest(MANIFEST)
+    try:
+        changes = {}
+        for old, new in moves:
+            url = current.get(old)
+            changes[old] = None
+            if url is not None:
+                changes[new] = url
+    finally:
+        current.close()
+    _append(changes)
+
+
+_lock = threading.Lock()
+_manifest = None
+_checked = 0
+
+
+def get_manifest():
+    """Returns the manifest of this process or None if there isn't any."""
+    global _manifest, _checked
+    if not MANIFEST:
+        return None
+    now = time.time()
+    if now - _checked < LOCAL_CACHE_TIMEOUT:
+        return _manifest
+    with _lock:
+        if _manifest is None or _manifest.is_stale():
+            previous = _manifest
+            try:
+                _manifest = Manifest(MANIFEST)
+            except (IOError, OSError):
+                _manifest = None
+            if previous is not None:
+                previous.close()
+        _checked = now
+    return _manifest
+
+
+def lookup(path):
+    """Returns the url of path found in the manifest or None."""
+    manifest = get_manifest()
+    if manifest is None:
+        return None
+    try:
+        return manifest.get(path)
+    except ValueError:
+        # closed by another thread swapping in a newer manifest; the path
+        # is resolved without it this time
+        return None
+
+
+def lookup_many(paths):
+    """Maps the paths found in the manifest to their urls."""
+    manifest = get_manifest()
+    if manifest is None:
+        return {}
+    try:
+        urls = [(path, manifest.get(path)) for path in paths]
+    except ValueError:
+        # see lookup
+        return {}
+    return dict((path, url) for path, url in urls if url is not None)
+
+
+def reset():
+    """Makes the next lookup of this process load the manifest again."""
+    global _manifest, _checked
+    with _lock:
+        if _manifest is not None:
+            _manifest.close()
+        _manifest = None
+        _checked = 0
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filer', '__first__'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LogicalPath',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('path_hash', models.CharField(unique=True, max_length=40)),
+                ('path', models.TextField()),
+                ('file', models.ForeignKey(related_name='filertags_logical_paths', on_delete=django.db.models.deletion.CASCADE, to='filer.File')),
+            ],
+        ),
+    ]
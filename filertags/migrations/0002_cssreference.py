@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filer', '__first__'),
+        ('filertags', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CssReference',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('path_hash', models.CharField(max_length=40, db_index=True)),
+                ('path', models.TextField()),
+                ('css', models.ForeignKey(related_name='filertags_css_references', on_delete=django.db.models.deletion.CASCADE, to='filer.File')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='cssreference',
+            unique_together=set([('css', 'path_hash')]),
+        ),
+    ]
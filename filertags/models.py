@@ -1,3 +1,170 @@
-from django.db import models
+import hashlib
 
-# Create your models here.
+from django.db import IntegrityError, models, transaction
+
+from filer.models.filemodels import File
+
+from .paths import normalize_path
+
+
+def hash_path(path):
+    return hashlib.sha1(normalize_path(path).encode('utf-8')).hexdigest()
+
+
+class LogicalPathManager(models.Manager):
+
+    def lookup(self, path):
+        """Returns the file found at the logical path or None."""
+        try:
+            return self.select_related('file').get(path_hash=hash_path(path)).file
+        except self.model.DoesNotExist:
+            return None
+
+    def lookup_many(self, paths, chunk_size=500):
+        """Maps the given logical paths to the files found at them;
+        paths that are not indexed are left out.
+        """
+        paths_by_hash = dict((hash_path(path), path) for path in paths)
+        hashes = list(paths_by_hash)
+        found = {}
+        for i in range(0, len(hashes), chunk_size):
+            entries = self.select_related('file').filter(
+                path_hash__in=hashes[i:i + chunk_size])
+            for entry in entries:
+                found[paths_by_hash[entry.path_hash]] = entry.file
+        return found
+
+    def register(self, filer_file, path):
+        """Makes path the only logical path of filer_file; a None path
+        (clipboard files) removes the file from the table.
+        """
+        if path is None:
+            self.filter(file=filer_file).delete()
+            return
+        path_hash = hash_path(path)
+        self.filter(file=filer_file).exclude(path_hash=path_hash).delete()
+        defaults = {'path': normalize_path(path), 'file': filer_file}
+        try:
+            with transaction.atomic(using=self.db):
+                self.update_or_create(path_hash=path_hash, defaults=defaults)
+        except IntegrityError:
+            # a concurrent save of the same path inserted the row first
+            self.filter(path_hash=path_hash).update(**defaults)
+
+    def move(self, moved_files):
+        """Updates the table after the files were moved to a new logical path.
+
+        moved_files is an iterable of (file id, new logical path) pairs.
+        """
+        entries = dict((hash_path(path), self.model(
+            path_hash=hash_path(path), path=normalize_path(path), file_id=file_id))
+            for file_id, path in moved_files)
+        if not entries:
+            return
+        file_ids = [entry.file_id for entry in entries.values()]
+        self.filter(models.Q(file__in=file_ids) |
+                    models.Q(path_hash__in=list(entries))).delete()
+        self.bulk_create(list(entries.values()))
+
+
+class LogicalPath(models.Model):
+    """Denormalized logical path -> file mapping.
+
+    The full logical path of every file is kept in this table so that a
+    path resolves with a single indexed lookup, no matter how deep the
+    folder tree is. Rows are kept in sync by the File and Folder hooks in
+    filertags.signals and can be rebuilt with the filertags_backfill command.
+
+    A path only has one row, so when sibling folders or files share a name
+    it resolves to the most recently saved file, where walking the folders
+    finds nothing.
+    """
+    path_hash = models.CharField(max_length=40, unique=True)
+    path = models.TextField()
+    file = models.ForeignKey(File, related_name='filertags_logical_paths',
+                             on_delete=models.CASCADE)
+
+    objects = LogicalPathManager()
+
+    def __str__(self):
+        return self.path
+
+
+class CssReferenceManager(models.Manager):
+
+    def referencing_files(self, path):
+        """Returns the css files that reference the logical path."""
+        return self.referencing_any([path])
+
+    def referencing_any(self, paths):
+        """Returns the css files that reference any of the logical paths."""
+        css_ids = self.filter(
+            path_hash__in=[hash_path(path) for path in paths]).values('css_id')
+        return File.objects.filter(pk__in=css_ids)
+
+    def referenced_paths(self, paths, chunk_size=500):
+        """Returns the normalized logical paths referenced by any css."""
+        hashes = list(set(hash_path(path) for path in paths))
+        referenced = set()
+        for i in range(0, len(hashes), chunk_size):
+            referenced.update(self.filter(
+                path_hash__in=hashes[i:i + chunk_size]).values_list('path', flat=True))
+        return referenced
+
+    def set_references(self, css, paths):
+        paths = dict((hash_path(path), normalize_path(path)) for path in paths)
+        self.filter(css=css).delete()
+        self.bulk_create([
+            self.model(css=css, path_hash=path_hash, path=path)
+            for path_hash, path in paths.items()])
+
+    def move(self, moved_paths, chunk_size=500):
+        """Updates the table after the css files referencing the old paths
+        of the (old logical path, new logical path) pairs were pointed to
+        the new ones.
+        """
+        new_paths = dict((hash_path(old), normalize_path(new)) for old, new in moved_paths)
+        old_hashes = list(new_paths)
+        moved = []
+        for i in range(0, len(old_hashes), chunk_size):
+            moved.extend(self.filter(path_hash__in=old_hashes[i:i + chunk_size]).values_list(
+                'pk', 'css_id', 'path_hash'))
+        if not moved:
+            return
+        entries = {}
+        for _, css_id, old_hash in moved:
+            path = new_paths[old_hash]
+            entries[(css_id, hash_path(path))] = path
+        new_hashes = list(set(new_hash for _, new_hash in entries))
+        for i in range(0, len(new_hashes), chunk_size):
+            # css files already referencing the new paths keep their rows
+            existing = self.filter(path_hash__in=new_hashes[i:i + chunk_size]).values_list(
+                'css_id', 'path_hash')
+            for key in existing:
+                entries.pop(key, None)
+        pks = [pk for pk, _, _ in moved]
+        for i in range(0, len(pks), chunk_size):
+            self.filter(pk__in=pks[i:i + chunk_size]).delete()
+        self.bulk_create([
+            self.model(css_id=css_id, path_hash=path_hash, path=path)
+            for (css_id, path_hash), path in entries.items()])
+
+
+class CssReference(models.Model):
+    """Reverse index of the logical urls referenced by resolved css files.
+
+    Rows are recorded whenever resolve_resource_urls rewrites a css so that
+    saving a resource only has to open the css files that reference it.
+    """
+    css = models.ForeignKey(File, related_name='filertags_css_references',
+                            on_delete=models.CASCADE)
+    path_hash = models.CharField(max_length=40, db_index=True)
+    path = models.TextField()
+
+    objects = CssReferenceManager()
+
+    class Meta:
+        unique_together = (('css', 'path_hash'),)
+
+    def __str__(self):
+        return self.path
@@ -0,0 +1,104 @@
+"""Helpers for computing the logical paths of filer files and folders.
+
+Logical paths are returned without leading or trailing slashes, the same
+way filerfile and filerthumbnail normalize their argument:
+    media/images/foobar.png
+"""
+from filer.models.filemodels import File
+from filer.models.foldermodels import Folder
+import filer.settings as filer_settings
+
+
+def normalize_path(path):
+    return path.strip('/')
+
+
+def get_file_name(filer_file):
+    return filer_file.name if filer_file.name else filer_file.original_filename
+
+
+def get_upload_prefixes():
+    return [storage['main']['UPLOAD_TO_PREFIX']
+            for storage in list(filer_settings.FILER_STORAGES.values())]
+
+
+def get_folder_path(folder):
+    return '/'.join(f.name for f in folder.get_ancestors(include_self=True))
+
+
+def get_file_logical_path(filer_file):
+    """Returns the logical path of a file or None for clipboard files."""
+    if filer_file.folder is None:
+        return None
+    folder_path = '/'.join(folder.name for folder in filer_file.logical_path)
+    return normalize_path('%s/%s' % (folder_path, get_file_name(filer_file)))
+
+
+def get_storage_path(filer_file):
+    """Returns the path of the stored file relative to its upload prefix.
+
+    When all storages upload files by path this is the path used by
+    filerfile to find the file.
+    """
+    name = filer_file.file.name if filer_file.file else None
+    if not name:
+        return None
+    for prefix in get_upload_prefixes():
+        if name.startswith('%s/' % prefix):
+            return name[len(prefix) + 1:]
+    return None
+
+
+def get_hashed_lookup_path(filer_file):
+    """Returns the path under which find_hashed_file finds a file whose
+    stored name was modified by the storage.
+    """
+    storage_path = get_storage_path(filer_file)
+    if storage_path is None:
+        return None
+    folder_path = storage_path[:storage_path.rfind('/') + 1]
+    return normalize_path(folder_path + get_file_name(filer_file))
+
+
+def get_lookup_paths(filer_file):
+    """Returns all the paths under which a file can be looked up."""
+    paths = set([get_file_logical_path(filer_file), get_storage_path(filer_file),
+                 get_hashed_lookup_path(filer_file)])
+    paths.discard(None)
+    return paths
+
+
+def get_all_folder_paths():
+    """Maps the id of every folder to its logical path using a single query."""
+    paths_by_id = {}
+    folders = Folder.objects.order_by('tree_id', 'lft').values_list(
+        'pk', 'parent_id', 'name')
+    for pk, parent_id, name in folders.iterator():
+        if parent_id is None:
+            paths_by_id[pk] = name
+        else:
+            paths_by_id[pk] = '%s/%s' % (paths_by_id[parent_id], name)
+    return paths_by_id
+
+
+def get_subtree_folder_paths(folder, folder_path):
+    """Maps the ids of a folder and of all its descendants to their
+    logical paths, assuming the folder itself lives at folder_path.
+    """
+    paths_by_id = {folder.pk: folder_path}
+    descendants = folder.get_descendants().order_by('level').values_list(
+        'pk', 'parent_id', 'name')
+    for pk, parent_id, name in descendants:
+        paths_by_id[pk] = '%s/%s' % (paths_by_id[parent_id], name)
+    return paths_by_id
+
+
+def iter_subtree_file_paths(folder, folder_path):
+    """Yields (file id, logical path) for every file under a folder,
+    assuming the folder itself lives at folder_path.
+    """
+    paths_by_id = get_subtree_folder_paths(folder, folder_path)
+    files = File.objects.filter(folder__in=list(paths_by_id)).values_list(
+        'pk', 'folder_id', 'name', 'original_filename')
+    for pk, folder_id, name, original_filename in files.iterator():
+        yield pk, '%s/%s' % (paths_by_id[folder_id], name or original_filename)
@@ -1,3 +1,5 @@
+from django.conf import settings
+
 import filer.settings
 
 filer_storages = getattr(filer.settings, 'FILER_STORAGES', {})
@@ -5,3 +7,76 @@ filer_storages = getattr(filer.settings, 'FILER_STORAGES', {})
 LOGICAL_EQ_ACTUAL_URL = all(
     storage['main']['UPLOAD_TO'] == 'filer.utils.generate_filename.by_path'
     for storage in list(filer_storages.values()))
+
+# resolutions of logical paths are cached in a small in-process LRU which
+# sits in front of the django cache named by CACHE_ALIAS
+CACHE_ENABLED = getattr(settings, 'FILERTAGS_CACHE_ENABLED', True)
+CACHE_ALIAS = getattr(settings, 'FILERTAGS_CACHE_ALIAS', 'default')
+CACHE_TIMEOUT = getattr(settings, 'FILERTAGS_CACHE_TIMEOUT', 60 * 60)
+CACHE_KEY_PREFIX = getattr(settings, 'FILERTAGS_CACHE_KEY_PREFIX', 'filertags')
+# other processes only learn about invalidations through the shared cache,
+# so entries of the in-process LRU have to be short lived
+LOCAL_CACHE_SIZE = getattr(settings, 'FILERTAGS_LOCAL_CACHE_SIZE', 1000)
+LOCAL_CACHE_TIMEOUT = getattr(settings, 'FILERTAGS_LOCAL_CACHE_TIMEOUT', 10)
+# paths that can't be resolved are cached for a short while too, so broken
+# references don't query the database on every render; a miss is logged at
+# most once per MISS_LOG_INTERVAL seconds and process
+MISS_CACHE_TIMEOUT = getattr(settings, 'FILERTAGS_MISS_CACHE_TIMEOUT', 30)
+MISS_LOG_INTERVAL = getattr(settings, 'FILERTAGS_MISS_LOG_INTERVAL', 60)
+
+# resolve logical paths through the denormalized filertags.LogicalPath table,
+# which is written on every file save; run the migrations and the
+# filertags_backfill command before turning this on for existing files.
+# Unlike walking the folders, the index resolves a path shared by sibling
+# folders or files of the same name to the most recently saved file
+LOGICAL_PATH_INDEX = getattr(settings, 'FILERTAGS_LOGICAL_PATH_INDEX', False)
+# walk the folders for the paths missing from the index, which only finds
+# the files saved before it was built; turn it off once it's backfilled so
+# that unknown paths cost a single query
+LOGICAL_PATH_INDEX_FALLBACK = getattr(settings, 'FILERTAGS_LOGICAL_PATH_INDEX_FALLBACK', True)
+
+# look the folders of logical paths up in an in-process snapshot of the
+# whole folder tree instead of querying them, see filertags.folder_tree
+FOLDER_TREE_SNAPSHOT = getattr(settings, 'FILERTAGS_FOLDER_TREE_SNAPSHOT', False)
+# snapshots older than this are loaded again even if no change was
+# announced through the shared cache
+FOLDER_TREE_MAX_AGE = getattr(settings, 'FILERTAGS_FOLDER_TREE_MAX_AGE', 300)
+
+# only open the css files recorded as referencing a saved resource instead
+# of scanning all of them. References are always recorded for the css files
+# resolved from now on; run filertags_backfill before turning this on so
+# that the css files uploaded before are found as well
+CSS_REFERENCE_INDEX = getattr(settings, 'FILERTAGS_CSS_REFERENCE_INDEX', False)
+
+# counters and timers for the filters and signal hooks, see
+# filertags.instrumentation
+INSTRUMENTATION = getattr(settings, 'FILERTAGS_INSTRUMENTATION', False)
+INSTRUMENTATION_SINKS = getattr(
+    settings, 'FILERTAGS_INSTRUMENTATION_SINKS',
+    ['filertags.instrumentation.LoggingSink'])
+
+# 'immediate' updates the css files referencing a resource from its post save
+# hook; 'deferred' queues the resource and updates each referencing css once
+# per transaction, after it commits, through CSS_UPDATE_BACKEND
+CSS_UPDATE_MODE = getattr(settings, 'FILERTAGS_CSS_UPDATE_MODE', 'immediate')
+CSS_UPDATE_BACKEND = getattr(
+    settings, 'FILERTAGS_CSS_UPDATE_BACKEND',
+    'filertags.css_updates.InlineBackend')
+# inline the css files imported at the start of an uploaded css with
+# @import into it, all of them or none; the bundle is built or rebuilt
+# whenever an imported css is saved
+CSS_BUNDLE_IMPORTS = getattr(settings, 'FILERTAGS_CSS_BUNDLE_IMPORTS', False)
+# store a gzip compressed copy, named after the css with .gz appended, next
+# to every css rewritten by filertags so that it can be served precompressed
+CSS_GZIP = getattr(settings, 'FILERTAGS_CSS_GZIP', False)
+CSS_GZIP_LEVEL = getattr(settings, 'FILERTAGS_CSS_GZIP_LEVEL', 9)
+# number of threads reading and rewriting the stored css files referencing a
+# saved resource; worth raising with remote storages
+CSS_UPDATE_WORKERS = getattr(settings, 'FILERTAGS_CSS_UPDATE_WORKERS', 1)
+
+# name of the logical path -> url manifest written by the
+# filertags_export_manifest command, see filertags.manifest
+MANIFEST = getattr(settings, 'FILERTAGS_MANIFEST', None)
+# size in bytes past which the changes appended to the manifest by the save
+# hooks are merged into it
+MANIFEST_DELTA_SIZE = getattr(settings, 'FILERTAGS_MANIFEST_DELTA_SIZE', 1024 * 1024)
@@ -1,25 +1,54 @@
 import codecs
+import collections
 import hashlib
+import itertools
+import logging
 import re
+import tempfile
+import threading
+import uuid
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
-from django.core.files.base import ContentFile
+from django.core.files.base import File as DjangoFile
 from django.core.files.uploadedfile import UploadedFile
+from django.db import transaction
 from django.db.models import signals
 
 from filer.models.filemodels import File
+from filer.models.foldermodels import Folder
 from filer.models.imagemodels import Image
-from filertags.settings import LOGICAL_EQ_ACTUAL_URL
-from .templatetags.filertags import filerfile
+from filertags import caching, css_bundles, css_gzip, css_updates, \
+    folder_tree, instrumentation, manifest
+from filertags import css as css_tools
+from filertags.lookups import non_polymorphic
+from filertags.models import CssReference, LogicalPath
+from filertags.paths import get_file_logical_path, get_folder_path, \
+    get_lookup_paths, iter_subtree_file_paths, normalize_path
+from filertags.settings import LOGICAL_EQ_ACTUAL_URL, LOGICAL_PATH_INDEX, \
+    CSS_REFERENCE_INDEX, CSS_UPDATE_MODE, CSS_UPDATE_WORKERS, \
+    CSS_BUNDLE_IMPORTS, CSS_GZIP, FOLDER_TREE_SNAPSHOT
+from .templatetags.filertags import filerfiles
+
+logger = logging.getLogger(__name__)
 
 
 _LOGICAL_URL_TEMPLATE = "/* logicalurl('%s') */"
 _RESOURCE_URL_TEMPLATE = "url('%s') " + _LOGICAL_URL_TEMPLATE
-_RESOURCE_URL_REGEX = re.compile(r"\burl\(([^\)]*)\)")
 
-_COMMENT_REGEX = re.compile(r"/\*.*?\*/")
+_LOGICAL_URL_REGEX = re.compile(r"/\* logicalurl\('([^']*)'\) \*/")
+
 _ALREADY_PARSED_MARKER = '/* Filer urls already resolved */'
 
+# css files are read and rewritten in chunks of _CHUNK_SIZE bytes; rewritten
+# content larger than _SPOOL_SIZE is kept in a temporary file on disk
+_CHUNK_SIZE = 64 * 1024
+_SPOOL_SIZE = 1024 * 1024
+# number of css files loaded at once by the hooks updating them
+_CSS_CHUNK_SIZE = 100
+# times a css changing while it's being updated is read again
+_CSS_UPDATE_ATTEMPTS = 3
+
 
 def _is_in_clipboard(filer_file):
     return filer_file.folder is None
@@ -29,10 +58,6 @@ def _construct_logical_folder_path(filer_file):
     return '/%s/' % '/'.join((folder.name for folder in filer_file.logical_path))
 
 
-def _get_commented_regions(content):
-    return [(m.start(), m.end()) for m in re.finditer(_COMMENT_REGEX, content)]
-
-
 def _is_in_memory(file_):
     return isinstance(file_, UploadedFile)
 
@@ -77,15 +102,119 @@ def _get_css_encoding(content, css_name):
     return 'utf-8'
 
 
+class _RewrittenContent(object):
+    """Temporary file holding the encoded content of a rewritten css.
+    The sha1 and the size of the content are computed while it's written.
+    """
+
+    def __init__(self, encoding):
+        self.file = tempfile.SpooledTemporaryFile(max_size=_SPOOL_SIZE)
+        self.size = 0
+        self._sha = hashlib.sha1()
+        self._encoder = codecs.getincrementalencoder(encoding)()
+
+    def write(self, text, final=False):
+        data = self._encoder.encode(text, final)
+        if data:
+            self.file.write(data)
+            self._sha.update(data)
+            self.size += len(data)
+
+    @property
+    def sha1(self):
+        return self._sha.hexdigest()
+
+    def chunks(self):
+        self.file.seek(0)
+        return iter(lambda: self.file.read(_CHUNK_SIZE), b'')
+
+
+def _iter_file_chunks(filer_file):
+    filer_file.file.seek(0)
+    return iter(lambda: filer_file.file.read(_CHUNK_SIZE), b'')
+
+
+def _copy_chunks(chunks, copy):
+    """Yields the chunks, writing them to the copy file as well."""
+    for chunk in chunks:
+        copy.write(chunk)
+        yield chunk
+
+
+def _iter_copied_chunks(copy):
+    copy.seek(0)
+    return iter(lambda: copy.read(_CHUNK_SIZE), b'')
+
+
+def _read_css(css, raw_chunks=None):
+    """Returns the encoding of a css and an iterator over its decoded
+    content, read from raw_chunks or else from its file. Only the first
+    chunk is used to detect the encoding since both the BOM and the
+    @charset directive have to be at the very start.
+    """
+    chunks = _iter_file_chunks(css) if raw_chunks is None else iter(raw_chunks)
+    head = next(chunks, b'')
+    encoding = _get_css_encoding(head, _get_filer_file_name(css))
+    decoder = codecs.getincrementaldecoder(encoding)()
+
+    def decoded_chunks():
+        for chunk in itertools.chain([head], chunks):
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+        text = decoder.decode(b'', True)
+        if text:
+            yield text
+    return encoding, decoded_chunks()
+
+
+def _rewrite_css(css, get_replacements, prepare_head=None, raw_chunks=None):
+    """Streams a css through a CssRewriter and returns the rewritten
+    content as a _RewrittenContent.
+    """
+    encoding, chunks = _read_css(css, raw_chunks)
+    new_content = _RewrittenContent(encoding)
+    rewriter = css_tools.CssRewriter(get_replacements)
+    for i, chunk in enumerate(chunks):
+        if i == 0 and prepare_head is not None:
+            chunk = prepare_head(chunk)
+        new_content.write(rewriter.feed(chunk))
+    new_content.write(rewriter.feed('', True), True)
+    return new_content
+
+
+def _scan_css(css, get_replacements):
+    """Streams a css through a CssRewriter, discarding the output."""
+    _, chunks = _read_css(css)
+    _scan_chunks(chunks, get_replacements)
+
+
+def _scan_chunks(chunks, get_replacements):
+    rewriter = css_tools.CssRewriter(get_replacements)
+    for chunk in chunks:
+        rewriter.feed(chunk)
+    rewriter.feed('', True)
+
+
 def _rewrite_file_content(filer_file, new_content):
+    """Replaces the content of filer_file with new_content.
+
+    Returns False, without touching the storage, when the new content is
+    identical to the stored one.
+    """
     if _is_in_memory(filer_file.file.file):
         filer_file.file.seek(0)
-        filer_file.file.write(new_content)
+        for chunk in new_content.chunks():
+            filer_file.file.write(chunk)
     else:
+        if filer_file.sha1 == new_content.sha1:
+            return False
         storage = filer_file.file.storage
-        fp = ContentFile(new_content, filer_file.file.name)
+        new_content.file.seek(0)
+        fp = DjangoFile(new_content.file, filer_file.file.name)
         filer_file.file.file = fp
-        storage.delete(filer_file.file.name)
+        if not css_gzip.can_overwrite(storage):
+            storage.delete(filer_file.file.name)
         filer_file.file.name = storage.save(filer_file.file.name, fp)
     # all code in filer.filemodels.File.save which percedes the call to
     # super(File, self).save will be executed BEFORE the resolve_resource_urls
@@ -94,10 +223,12 @@ def _rewrite_file_content(filer_file, new_content):
     # This is ugly since any new file content related attribute that
     # might be added in the future verisons of filer will require an update
     # of this function as well...
-    sha = hashlib.sha1()
-    sha.update(new_content)
-    filer_file.sha1 = sha.hexdigest()
-    filer_file._file_size = len(new_content)
+    filer_file.sha1 = new_content.sha1
+    filer_file._file_size = new_content.size
+    # the final name of new uploads is only known once they are saved; the
+    # compressed copy is written by compress_stored_css
+    filer_file._filertags_content_rewritten = True
+    return True
 
 
 def _is_css(filer_file):
@@ -125,6 +256,32 @@ def _is_already_parsed(content):
     return re.match(regex, content) is not None
 
 
+def _get_logical_url(logical_folder_path, url):
+    # strip spaces and quotes
+    url = url.strip('\'\" ')
+    parsed_url = urllib.parse.urlparse(url)
+    if parsed_url.netloc or parsed_url.scheme not in ['', 'http', 'https']:
+        # ignore everyghing which is not served through http
+        # or explicitly specifies a hostname; these are resources
+        # not served from filer
+        return None
+    return urllib.parse.urljoin(logical_folder_path, url)
+
+
+def _get_css_logical_path(css):
+    return urllib.parse.urljoin(
+        _construct_logical_folder_path(css), _get_filer_file_name(css))
+
+
+def _read_stored_css(css):
+    """Returns the encoding and the decoded content of a stored css."""
+    with css.file.storage.open(css.file.name, 'rb') as stored:
+        content = stored.read()
+    encoding = _get_css_encoding(content, _get_filer_file_name(css))
+    return encoding, content.decode(encoding)
+
+
+@instrumentation.timed('signals.resolve_resource_urls')
 def resolve_resource_urls(instance, **kwargs):
     """Pre save hook for css files uploaded to filer.
     It's purpose is to resolve the actual urls of resources referenced
@@ -162,69 +319,311 @@ def resolve_resource_urls(instance, **kwargs):
     css_file = instance
     if _is_in_clipboard(css_file):
         return
-    content = css_file.file.read()
-    encoding = _get_css_encoding(content, _get_filer_file_name(css_file))
-    content = content.decode(encoding)
-    if _is_already_parsed(content):
+    # the content read by the first pass is kept, in memory or in a
+    # temporary file when large, for the second one; the stored css is
+    # read only once
+    copy = tempfile.SpooledTemporaryFile(max_size=_SPOOL_SIZE)
+    try:
+        _resolve_resource_urls(css_file, copy)
+    finally:
+        copy.close()
+
+
+def _resolve_resource_urls(css_file, copy):
+    _, chunks = _read_css(css_file, _copy_chunks(_iter_file_chunks(css_file), copy))
+    head = next(chunks, '')
+    if _is_already_parsed(head):
         # this css' resource urls have already been resolved
         # this happens when moving the css in and out of the clipboard
         # multiple times
         return
 
     logical_folder_path = _construct_logical_folder_path(css_file)
-    commented_regions = _get_commented_regions(content)
-    local_cache = {}
-
-    def change_urls(match):
-        for start, end in commented_regions:
-            # we don't make any changes to urls that are part of commented regions
-            if start < match.start() < end or start < match.end() < end:
-                return match.group()
-        # strip spaces and quotes
-        url = match.group(1).strip('\'\" ')
-        parsed_url = urllib.parse.urlparse(url)
-        if parsed_url.netloc or parsed_url.scheme not in ['', 'http', 'https']:
-            # ignore everyghing which is not served through http
-            # or explicitly specifies a hostname; these are resources
-            # not served from filer
-            return match.group()
-        logical_file_path = urllib.parse.urljoin(logical_folder_path, url)
-        if not logical_file_path in local_cache:
-            local_cache[logical_file_path] = _RESOURCE_URL_TEMPLATE % (
-                filerfile(logical_file_path), logical_file_path)
-        return local_cache[logical_file_path]
-
-    new_content = _insert_already_parsed_marker(
-        re.sub(_RESOURCE_URL_REGEX, change_urls, content))
-    new_content = new_content.encode(encoding)
+
+    def iter_resource_urls(tokens):
+        # urls that are part of commented regions are never reported by the
+        # scanner, so they are left unchanged
+        for token in tokens:
+            if token.kind == css_tools.URL:
+                logical_file_path = _get_logical_url(logical_folder_path, token.value)
+                if logical_file_path is not None:
+                    yield token, logical_file_path
+
+    # the css is streamed twice: the first pass collects the referenced
+    # resources so that they are resolved in batches by filerfiles instead
+    # of with queries of their own
+    logical_file_paths = set()
+
+    def collect_urls(text, tokens):
+        logical_file_paths.update(path for _, path in iter_resource_urls(tokens))
+        return []
+    _scan_chunks(itertools.chain([head], chunks), collect_urls)
+    actual_urls = filerfiles(logical_file_paths)
+
+    referenced_paths = set(actual_urls)
+    imports, bundles = [], {}
+    if CSS_BUNDLE_IMPORTS:
+        # @import rules are only allowed at the start of a css, so they are
+        # looked for in its first chunk. The imported css files are
+        # recorded as references whether they are bundled or not: the
+        # bundle is built or updated whenever one of them is saved
+        imports, bundles = css_bundles.get_import_bundles(
+            head, logical_folder_path, css_file)
+        referenced_paths.update(logical_url for _, _, logical_url in imports)
+    # the @import rules are replaced by placeholder comments which are
+    # replaced in turn by the inlined content; the inlined content is
+    # written out as it is instead of being resolved again
+    placeholders = {}
+    nonce = uuid.uuid4().hex
+
+    def prepare_head(chunk):
+        replacements = []
+        rules = list(css_bundles.iter_import_rules(chunk, logical_folder_path)) \
+            if bundles else []
+        # the first chunk is read again from the copy of the css; its rules
+        # are only replaced if they are the ones bundles were loaded for
+        if [logical_url for _, _, logical_url, _ in rules] == \
+                [logical_url for _, _, logical_url in imports]:
+            for start, end, logical_url, _ in rules:
+                content = bundles[logical_url]
+                placeholder = '/* filertags-bundle %s %d */' % (nonce, len(placeholders))
+                placeholders[placeholder] = css_bundles.get_import_region(logical_url, content)
+                replacements.append((start, end, placeholder))
+                referenced_paths.update(get_referenced_logical_urls(content))
+        return _insert_already_parsed_marker(
+            css_tools.replace_spans(chunk, replacements))
+
+    def resolve_urls(text, tokens):
+        replacements = []
+        for token in tokens:
+            if token.kind == css_tools.COMMENT and token.value in placeholders:
+                replacements.append(
+                    (token.start, token.end, placeholders[token.value]))
+            elif token.kind == css_tools.URL:
+                logical_file_path = _get_logical_url(logical_folder_path, token.value)
+                if logical_file_path is not None:
+                    replacements.append((token.start, token.end, _RESOURCE_URL_TEMPLATE % (
+                        actual_urls.get(logical_file_path, ''), logical_file_path)))
+        return replacements
+    new_content = _rewrite_css(css_file, resolve_urls, prepare_head=prepare_head,
+                               raw_chunks=_iter_copied_chunks(copy))
     _rewrite_file_content(css_file, new_content)
+    # the css might not have a primary key yet; the references are
+    # recorded by record_css_references once it is saved
+    css_file._filertags_referenced_paths = referenced_paths
+
+
+def get_referenced_logical_urls(content):
+    """Returns the logical urls annotated in an already resolved css,
+    including the ones of the css files bundled into it.
+    """
+    return set(_LOGICAL_URL_REGEX.findall(content)) | \
+        css_bundles.get_bundled_logical_urls(content)
+
+
+@instrumentation.timed('signals.record_css_references')
+def record_css_references(instance, raw=False, **kwargs):
+    """Post save hook that records the logical urls referenced by a css
+    whose resource urls were just resolved by resolve_resource_urls.
+    """
+    referenced_paths = getattr(instance, '_filertags_referenced_paths', None)
+    if raw or referenced_paths is None:
+        return
+    del instance._filertags_referenced_paths
+    CssReference.objects.set_references(instance, referenced_paths)
+
+
+@instrumentation.timed('signals.remember_stored_css')
+def remember_stored_css(instance, raw=False, **kwargs):
+    """Pre save hook which records the stored name and hash of a css before
+    it's saved, so that compress_stored_css can tell whether its file changed.
+    """
+    instance._filertags_previous_file = None
+    if raw or not CSS_GZIP or not instance.pk:
+        return
+    instance._filertags_previous_file = non_polymorphic(File.objects.filter(
+        pk=instance.pk)).values_list('file', 'sha1').first()
+
+
+@instrumentation.timed('signals.compress_stored_css')
+def compress_stored_css(instance, raw=False, **kwargs):
+    """Post save hook which, with FILERTAGS_CSS_GZIP turned on, stores a gzip
+    compressed copy next to every css whose file changed, so that it can be
+    served precompressed. The copy of the previous file is deleted when the
+    css is stored under another name.
+    """
+    rewritten = instance.__dict__.pop('_filertags_content_rewritten', False)
+    previous = instance.__dict__.pop('_filertags_previous_file', None)
+    if raw or not CSS_GZIP:
+        return
+    css_gzip.update_compressed_copy(instance, previous, rewritten)
+
+
+@instrumentation.timed('signals.remember_compressed_css')
+def remember_compressed_css(instance, **kwargs):
+    # the name of the file might be cleared while it's deleted
+    if CSS_GZIP and instance.file and _is_css(instance):
+        instance._filertags_compressed_name = css_gzip.get_compressed_name(
+            instance.file.name)
+
+
+@instrumentation.timed('signals.delete_compressed_css')
+def delete_compressed_css(instance, **kwargs):
+    """Post delete hook which deletes the compressed copy of a css."""
+    compressed_name = instance.__dict__.pop('_filertags_compressed_name', None)
+    if compressed_name is not None:
+        instance.file.storage.delete(compressed_name)
 
 
 def update_url_statements_in_css(css, resource_file, logical_file_path):
-    logical_url_snippet = _LOGICAL_URL_TEMPLATE % logical_file_path
-    url_updating_regex = "%s %s" % (
-        _RESOURCE_URL_REGEX.pattern, re.escape(logical_url_snippet))
-    repl = "url('%s') %s" % (resource_file.url, logical_url_snippet)
+    update_logical_urls_in_css(css, {logical_file_path: resource_file.url})
+
+
+def update_logical_urls_in_css(css, actual_urls, dry_run=False):
+    """Points the url statements of a css annotated with the logical urls
+    in actual_urls, a mapping of logical urls to actual urls, to their new
+    actual urls. The css is read once and written at most once, whatever
+    the number of urls. Returns whether the content of the css changed.
+    """
+    return _update_css_file(css, _get_url_statements(actual_urls), dry_run)
+
+
+def _get_url_statements(actual_urls):
+    """Maps logical urls to the annotated url statements pointing to the
+    actual urls found in actual_urls.
+    """
+    return dict(
+        (logical_url, _RESOURCE_URL_TEMPLATE % (actual_url, logical_url))
+        for logical_url, actual_url in actual_urls.items())
+
+
+def _update_css_file(css, replacements, dry_run=False):
     try:
-        css.file.seek(0)
-        old_content = css.file.read()
-        encoding = _get_css_encoding(old_content, _get_filer_file_name(css))
-        content = old_content.decode(encoding)
-        new_content = re.sub(url_updating_regex, repl, content)
-        new_content = new_content.encode(encoding)
+        return _update_annotated_urls(css, replacements, dry_run)
     except IOError:
         # the filer database might have File entries that reference
         # files no longer phisically exist
         # TODO: find the root cause of missing filer files
-        return
-    else:
-        if old_content != new_content:
-            _rewrite_file_content(css, new_content)
-            css.save()
+        return False
+
+
+def _read_annotated_url_updates(css, replacements):
+    """Rewrites the url statements of css annotated with the logical urls
+    found in replacements with the mapped text. Returns whether any of
+    them changed and the rewritten content.
+    """
+    changed = []
+
+    def update_url_statements(text, tokens):
+        updates = [
+            (start, end, replacements[logical_url])
+            for start, end, logical_url in css_tools.annotated_urls(text, tokens)
+            if logical_url in replacements]
+        if any(text[start:end] != repl for start, end, repl in updates):
+            changed.append(True)
+        return updates
+
+    try:
+        new_content = _rewrite_css(css, update_url_statements)
     finally:
         css.file.close()
+    return bool(changed), new_content
 
 
+def _write_css_update(css, sha1, new_content):
+    """Writes the rewritten content of a css and saves it, provided that its
+    row still holds sha1, the hash of the content it was rewritten from.
+
+    The css is read and rewritten beforehand, without any lock; its row is
+    only locked while the new content is written, so concurrent updates of
+    the same css don't overwrite each other's changes. Returns None when
+    the css changed in the meantime and has to be read again, otherwise
+    whether it was rewritten.
+    """
+    with transaction.atomic():
+        locked = non_polymorphic(File.objects.select_for_update()).filter(
+            pk=css.pk).first()
+        if locked is None:
+            # deleted in the meantime
+            return False
+        if locked.sha1 != sha1:
+            return None
+        try:
+            rewritten = _rewrite_file_content(locked, new_content)
+            if rewritten:
+                locked.save()
+        finally:
+            locked.file.close()
+    return rewritten
+
+
+def _update_annotated_urls(css, replacements, dry_run=False):
+    """Replaces the url statements annotated with the logical urls found in
+    replacements with the mapped text, reading and writing the css once
+    unless it changes while it's being rewritten. Returns whether the
+    content of the css changed.
+    """
+    for _ in range(_CSS_UPDATE_ATTEMPTS):
+        changed, new_content = _read_annotated_url_updates(css, replacements)
+        if not changed or dry_run:
+            return changed
+        if _write_css_update(css, css.sha1, new_content) is not None:
+            return True
+        # another update got there first; its content is rewritten again
+        css = non_polymorphic(File.objects.filter(pk=css.pk)).first()
+        if css is None:
+            return False
+    logger.warning('Gave up updating css %s, it kept changing', css.pk)
+    return False
+
+
+def reresolve_css(css, dry_run=False):
+    """Resolves again the actual urls of all the resources referenced by
+    a css, e.g. after a storage migration.
+
+    Css files that were never resolved go through resolve_resource_urls;
+    the annotated url statements of the already resolved ones are
+    updated in place. Returns whether the content of the css changed.
+    """
+    if not _is_css(css) or _is_in_clipboard(css):
+        return False
+    _, chunks = _read_css(css)
+    head = next(chunks, '')
+    if not _is_already_parsed(head):
+        if not dry_run:
+            resolve_resource_urls(css)
+            css.save()
+            record_css_references(css)
+        return True
+
+    logical_urls = set()
+    imported_urls = set()
+
+    def collect_urls(text, tokens):
+        tokens = list(tokens)
+        logical_urls.update(
+            logical_url for _, _, logical_url in css_tools.annotated_urls(text, tokens))
+        imported_urls.update(
+            css_tools.get_imported_url(token.value) for token in tokens
+            if token.kind == css_tools.COMMENT)
+        return []
+    _scan_css(css, collect_urls)
+    imported_urls.discard(None)
+    if CSS_BUNDLE_IMPORTS:
+        # the css files of the @import rules left unbundled
+        imported_urls.update(
+            logical_url for _, _, logical_url, _ in css_bundles.iter_import_rules(
+                head, _construct_logical_folder_path(css)) if logical_url is not None)
+    actual_urls = filerfiles(logical_urls)
+    changed = _update_annotated_urls(css, dict(
+        (logical_url, _RESOURCE_URL_TEMPLATE % (actual_urls[logical_url], logical_url))
+        for logical_url in logical_urls), dry_run)
+    if not dry_run:
+        CssReference.objects.set_references(css, logical_urls | imported_urls)
+    return changed
+
+
+@instrumentation.timed('signals.update_referencing_css_files')
 def update_referencing_css_files(instance, **kwargs):
     """Post save hook for any resource uploaded to filer that
     might be referenced by a css.
@@ -237,32 +636,379 @@ def update_referencing_css_files(instance, **kwargs):
     If the url between parentheses matches the logical url of the resource
     being saved, the actual url (which percedes the comment)
     is being updated.
+
+    With FILERTAGS_CSS_REFERENCE_INDEX turned on only the css files recorded
+    in the CssReference table as referencing the resource are parsed.
+
+    With FILERTAGS_CSS_UPDATE_MODE set to 'deferred' the logical url is only
+    queued; the css files are updated once the transaction commits, by
+    update_css_files_referencing, together with all the other resources
+    saved in the same transaction.
+
+    With FILERTAGS_CSS_BUNDLE_IMPORTS turned on, saving a css rebuilds the
+    bundles importing it instead, see filertags.css_bundles.
     """
-    if _is_css(instance):
+    if _is_in_clipboard(instance):
         return
-    resource_file = instance
-    if _is_in_clipboard(resource_file):
+    if _is_css(instance) and not CSS_BUNDLE_IMPORTS:
         return
+    resource_file = instance
     resource_name = _get_filer_file_name(resource_file)
     logical_file_path = urllib.parse.urljoin(
         _construct_logical_folder_path(resource_file),
         resource_name)
-    css_files = File.objects.filter(original_filename__endswith=".css")
-    for css in css_files:
-        update_url_statements_in_css(css, resource_file, logical_file_path)
+    if CSS_UPDATE_MODE == 'deferred':
+        css_updates.enqueue(logical_file_path, using=kwargs.get('using'))
+        return
+    if _is_css(resource_file):
+        css_bundles.rebuild_import_bundles({logical_file_path: resource_file})
+        return
+    _update_css_files(_get_referencing_css_files([logical_file_path]),
+                      _get_url_statements({logical_file_path: resource_file.url}))
+
+
+def _get_referencing_css_files(logical_file_paths):
+    if CSS_REFERENCE_INDEX:
+        return CssReference.objects.referencing_any(logical_file_paths)
+    return File.objects.filter(original_filename__endswith=".css")
+
+
+def _get_css_scan_fields():
+    fields = set(field.name for field in File._meta.fields)
+    # is_public picks the storage of the file in some filer versions; sha1
+    # tells whether the file changed while it was being rewritten
+    return [name for name in ('file', 'name', 'original_filename', 'is_public', 'sha1')
+            if name in fields]
+
+
+def _iter_css_chunks(css_files):
+    """Iterates over a queryset of css files in lists of _CSS_CHUNK_SIZE,
+    loading only the columns needed to read them, so memory use doesn't
+    grow with the number of css files.
+    """
+    css_files = non_polymorphic(css_files).only(*_get_css_scan_fields()).order_by('pk')
+    last_pk = None
+    while True:
+        chunk = css_files if last_pk is None else css_files.filter(pk__gt=last_pk)
+        chunk = list(chunk[:_CSS_CHUNK_SIZE])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1].pk
+
+
+def _iter_css_files(css_files):
+    for chunk in _iter_css_chunks(css_files):
+        for css in chunk:
+            yield css
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=CSS_UPDATE_WORKERS)
+    return _executor
+
+
+def _read_stored_css_update(css, replacements):
+    """Runs in the executor threads: reads css and rewrites its content
+    without touching the database. Returns the new content or None if it
+    doesn't change.
+    """
+    try:
+        changed, new_content = _read_annotated_url_updates(css, replacements)
+    except IOError:
+        # see _update_css_file
+        return None
+    return new_content if changed else None
+
+
+def _write_stored_css_update(css, future, replacements):
+    new_content = future.result()
+    if new_content is None:
+        return
+    try:
+        if _write_css_update(css, css.sha1, new_content) is None:
+            _update_css_file(css, replacements)
+    except IOError:
+        pass
+
+
+def _update_css_files_concurrently(css_files, replacements):
+    """Reads and rewrites the css files in the threads of the executor;
+    only the calling thread talks to the database, writing the rewritten
+    files one at a time with _write_css_update. The css files which
+    changed while they were being rewritten are updated again serially.
+
+    At most CSS_UPDATE_WORKERS css files are in flight, so memory use
+    doesn't grow with the number of css files.
+    """
+    executor = _get_executor()
+    pending = collections.deque()
+    for css in _iter_css_files(css_files):
+        pending.append((css, executor.submit(_read_stored_css_update, css, replacements)))
+        if len(pending) >= CSS_UPDATE_WORKERS:
+            _write_stored_css_update(*pending.popleft(), replacements=replacements)
+    while pending:
+        _write_stored_css_update(*pending.popleft(), replacements=replacements)
+
+
+def _update_css_files(css_files, replacements):
+    """Replaces the url statements of the css files of a queryset annotated
+    with the logical urls found in replacements with the mapped text.
+    """
+    if CSS_UPDATE_WORKERS > 1:
+        _update_css_files_concurrently(css_files, replacements)
+        return
+    for css in _iter_css_files(css_files):
+        _update_css_file(css, replacements)
+
+
+def update_css_files_referencing(logical_file_paths):
+    """Updates the actual urls of many resources at once; every css
+    referencing any of them is read and rewritten only once.
+    """
+    if CSS_BUNDLE_IMPORTS:
+        css_bundles.rebuild_import_bundles_of(logical_file_paths)
+    actual_urls = filerfiles(set(logical_file_paths))
+    _update_css_files(_get_referencing_css_files(actual_urls),
+                      _get_url_statements(actual_urls))
+
+
+def _get_file_urls(file_ids):
+    urls = {}
+    file_ids = list(file_ids)
+    for i in range(0, len(file_ids), _CSS_CHUNK_SIZE):
+        files = non_polymorphic(File.objects.filter(pk__in=file_ids[i:i + _CSS_CHUNK_SIZE]))
+        urls.update((filer_file.pk, filer_file.url) for filer_file in files)
+    return urls
+
+
+def update_css_files_referencing_moved_files(moved_files):
+    """Points the css files referencing files which were moved to a new
+    logical path, along with a renamed or moved folder, to their new
+    logical paths; moved_files holds (file id, old path, new path) tuples.
+
+    Only the css files referencing the old or the new logical paths are
+    read, each of them once, whatever the number of moved files.
+    """
+    logical_urls = dict((file_id, ('/%s' % old, '/%s' % new))
+                        for file_id, old, new in moved_files)
+    if CSS_REFERENCE_INDEX:
+        referenced = CssReference.objects.referenced_paths(
+            [path for paths in logical_urls.values() for path in paths])
+        logical_urls = dict(
+            (file_id, (old, new)) for file_id, (old, new) in logical_urls.items()
+            if normalize_path(old) in referenced or normalize_path(new) in referenced)
+    if not logical_urls:
+        return
+    actual_urls = _get_file_urls(logical_urls)
+    replacements = {}
+    for file_id, (old, new) in logical_urls.items():
+        if file_id not in actual_urls:
+            continue
+        # the old annotations follow the file to its new logical url and the
+        # css files already referencing the new logical url get its url
+        url_statement = _RESOURCE_URL_TEMPLATE % (actual_urls[file_id], new)
+        replacements[old] = replacements[new] = url_statement
+    _update_css_files(_get_referencing_css_files(replacements), replacements)
+    CssReference.objects.move(
+        (old, new) for old, new in logical_urls.values())
+
+
+@instrumentation.timed('signals.update_css_files_in_moved_folder')
+def update_css_files_in_moved_folder(instance, raw=False, **kwargs):
+    """Post save hook for folders; see update_css_files_referencing_moved_files."""
+    if raw:
+        return
+    moved_files = _get_moved_files(instance)
+    if moved_files:
+        update_css_files_referencing_moved_files(moved_files)
 
 
 def attach_css_rewriting_rules():
     signals.pre_save.connect(resolve_resource_urls, sender=File)
+    signals.post_save.connect(record_css_references, sender=File)
     signals.post_save.connect(update_referencing_css_files, sender=File)
     signals.post_save.connect(update_referencing_css_files, sender=Image)
+    signals.post_save.connect(update_css_files_in_moved_folder, sender=Folder)
+    signals.pre_save.connect(remember_stored_css, sender=File)
+    signals.post_save.connect(compress_stored_css, sender=File)
+    signals.pre_delete.connect(remember_compressed_css, sender=File)
+    signals.post_delete.connect(delete_compressed_css, sender=File)
 
 
 def detach_css_rewriting_rules():
     signals.pre_save.disconnect(resolve_resource_urls, sender=File)
+    signals.post_save.disconnect(record_css_references, sender=File)
     signals.post_save.disconnect(update_referencing_css_files, sender=File)
     signals.post_save.disconnect(update_referencing_css_files, sender=Image)
+    signals.post_save.disconnect(update_css_files_in_moved_folder, sender=Folder)
+    signals.pre_save.disconnect(remember_stored_css, sender=File)
+    signals.post_save.disconnect(compress_stored_css, sender=File)
+    signals.pre_delete.disconnect(remember_compressed_css, sender=File)
+    signals.post_delete.disconnect(delete_compressed_css, sender=File)
+
+
+@instrumentation.timed('signals.remember_file_lookup_paths')
+def remember_file_lookup_paths(instance, raw=False, **kwargs):
+    """Pre save hook which records the paths under which the file could be
+    looked up before being saved; a rename or a move makes them stale.
+    """
+    instance._filertags_previous_paths = set()
+    instance._filertags_previous_manifest_path = None
+    if raw or not instance.pk:
+        return
+    try:
+        previous = File.objects.get(pk=instance.pk)
+    except File.DoesNotExist:
+        return
+    instance._filertags_previous_paths = get_lookup_paths(previous)
+    instance._filertags_previous_manifest_path = manifest.get_manifest_path(previous)
+
+
+@instrumentation.timed('signals.update_file_lookup_paths')
+def update_file_lookup_paths(instance, raw=False, **kwargs):
+    """Post save hook which drops the cached resolutions of the paths
+    under which the file was and is being looked up and records its
+    logical path in the LogicalPath table.
+    """
+    paths = getattr(instance, '_filertags_previous_paths', set())
+    if not raw:
+        paths = paths | get_lookup_paths(instance)
+        if LOGICAL_PATH_INDEX:
+            LogicalPath.objects.register(
+                instance, get_file_logical_path(instance))
+    caching.invalidate(paths)
+    if manifest.is_enabled() and not raw:
+        changes = {}
+        previous_path = getattr(instance, '_filertags_previous_manifest_path', None)
+        if previous_path is not None:
+            changes[previous_path] = None
+        manifest_path = manifest.get_manifest_path(instance)
+        if manifest_path is not None:
+            changes[manifest_path] = instance.url
+        manifest.update(changes, using=kwargs.get('using'))
+
+
+@instrumentation.timed('signals.remember_deleted_file_lookup_paths')
+def remember_deleted_file_lookup_paths(instance, **kwargs):
+    # the logical path has to be computed before the delete since the
+    # folder might be deleted along with the file
+    instance._filertags_previous_paths = get_lookup_paths(instance)
+    instance._filertags_previous_manifest_path = manifest.get_manifest_path(instance)
+
+
+@instrumentation.timed('signals.invalidate_deleted_file_lookup_paths')
+def invalidate_deleted_file_lookup_paths(instance, **kwargs):
+    caching.invalidate(getattr(instance, '_filertags_previous_paths', ()))
+    previous_path = getattr(instance, '_filertags_previous_manifest_path', None)
+    if manifest.is_enabled() and previous_path is not None:
+        manifest.update({previous_path: None}, using=kwargs.get('using'))
+
+
+@instrumentation.timed('signals.remember_folder_path')
+def remember_folder_path(instance, raw=False, **kwargs):
+    instance._filertags_previous_path = None
+    instance.__dict__.pop('_filertags_moved_files', None)
+    if raw or not instance.pk:
+        return
+    try:
+        previous = Folder.objects.get(pk=instance.pk)
+    except Folder.DoesNotExist:
+        return
+    instance._filertags_previous_path = get_folder_path(previous)
+
+
+def _get_moved_files(folder):
+    """Returns (file id, old logical path, new logical path) for all the
+    files below a folder that was just renamed or moved; computed once
+    per save for all the folder hooks.
+    """
+    moved_files = getattr(folder, '_filertags_moved_files', None)
+    if moved_files is not None:
+        return moved_files
+    moved_files = []
+    old_path = getattr(folder, '_filertags_previous_path', None)
+    if old_path is not None:
+        new_path = get_folder_path(folder)
+        if new_path != old_path:
+            moved_files = [
+                (file_id, path, new_path + path[len(old_path):])
+                for file_id, path in iter_subtree_file_paths(folder, old_path)]
+    folder._filertags_moved_files = moved_files
+    return moved_files
+
+
+@instrumentation.timed('signals.update_folder_lookup_paths')
+def update_folder_lookup_paths(instance, raw=False, **kwargs):
+    """Post save hook for folders. Renaming or moving a folder changes the
+    logical paths of all the files below it.
+    """
+    if raw:
+        return
+    moved_files = _get_moved_files(instance)
+    if not moved_files:
+        return
+    caching.invalidate(set(old for _, old, _ in moved_files) |
+                       set(new for _, _, new in moved_files))
+    if LOGICAL_PATH_INDEX:
+        LogicalPath.objects.move(
+            (file_id, new) for file_id, _, new in moved_files)
+    if manifest.is_enabled() and not LOGICAL_EQ_ACTUAL_URL:
+        # the stored files don't move, their urls only change paths
+        manifest.move([(old, new) for _, old, new in moved_files],
+                      using=kwargs.get('using'))
+
+
+@instrumentation.timed('signals.invalidate_folder_tree')
+def invalidate_folder_tree(instance, raw=False, created=False, **kwargs):
+    """Post save hook for folders. Creating, renaming or moving a folder
+    makes every process load its folder tree snapshot again, see
+    filertags.folder_tree.
+    """
+    if raw or not FOLDER_TREE_SNAPSHOT:
+        return
+    previous_path = getattr(instance, '_filertags_previous_path', None)
+    if created or previous_path != get_folder_path(instance):
+        folder_tree.invalidate()
+
+
+@instrumentation.timed('signals.invalidate_deleted_folder_tree')
+def invalidate_deleted_folder_tree(instance, **kwargs):
+    if FOLDER_TREE_SNAPSHOT:
+        folder_tree.invalidate()
+
+
+def attach_path_tracking_rules():
+    for sender in (File, Image):
+        signals.pre_save.connect(remember_file_lookup_paths, sender=sender)
+        signals.post_save.connect(update_file_lookup_paths, sender=sender)
+        signals.pre_delete.connect(remember_deleted_file_lookup_paths, sender=sender)
+        signals.post_delete.connect(invalidate_deleted_file_lookup_paths, sender=sender)
+    signals.pre_save.connect(remember_folder_path, sender=Folder)
+    signals.post_save.connect(update_folder_lookup_paths, sender=Folder)
+    signals.post_save.connect(invalidate_folder_tree, sender=Folder)
+    signals.post_delete.connect(invalidate_deleted_folder_tree, sender=Folder)
+
+
+def detach_path_tracking_rules():
+    for sender in (File, Image):
+        signals.pre_save.disconnect(remember_file_lookup_paths, sender=sender)
+        signals.post_save.disconnect(update_file_lookup_paths, sender=sender)
+        signals.pre_delete.disconnect(remember_deleted_file_lookup_paths, sender=sender)
+        signals.post_delete.disconnect(invalidate_deleted_file_lookup_paths, sender=sender)
+    signals.pre_save.disconnect(remember_folder_path, sender=Folder)
+    signals.post_save.disconnect(update_folder_lookup_paths, sender=Folder)
+    signals.post_save.disconnect(invalidate_folder_tree, sender=Folder)
+    signals.post_delete.disconnect(invalidate_deleted_folder_tree, sender=Folder)
 
 
 if not LOGICAL_EQ_ACTUAL_URL:
     attach_css_rewriting_rules()
+attach_path_tracking_rules()
@@ -1,62 +1,57 @@
-import logging
+import re
 
 from django import template
-from django.db.models import Q
 from django.template.defaultfilters import stringfilter
+from django.utils.html import escape
 
-from filer.models import File, Folder
-import filer.settings as filer_settings
+from filer.models import File
 # TODO: this is ugly: the ..settings is because the toplevel package
 #    name has the same name as this module; should probably rename the toplevel package?
 from ..settings import LOGICAL_EQ_ACTUAL_URL
-
-logger = logging.getLogger(__name__)
-
-
-def q_matches_name(file_name):
-    return (Q(original_filename=file_name, name='') |
-            Q(original_filename=file_name, name__isnull=True) |
-            Q(name=file_name))
+from .. import caching, instrumentation, manifest
+# q_matches_name, get_possible_paths, hashed_files and find_hashed_file used
+# to be defined here
+from ..lookups import find_file, find_files, find_hashed_file, \
+    find_hashed_files, find_stored_files, get_possible_paths, hashed_files, \
+    log_miss, non_polymorphic, q_matches_name  # noqa: F401
 
 
+@instrumentation.timed('filerthumbnail')
 def filerthumbnail(path):
-    parts = path.strip('/').split('/')
-    folder_names = parts[:-1]
-    file_name = parts[-1]
-    if not path or not folder_names or not file_name:
-        return None
-
-    current_parent = None
-    try:
-        for folder_name in folder_names:
-            if not current_parent:
-                folder = Folder.objects.get(name=folder_name, parent__isnull=True)
-            else:
-                folder = Folder.objects.get(name=folder_name, parent=current_parent)
-            current_parent = folder
-        return File.objects.get(q_matches_name(file_name), Q(folder=folder)).file
-    except (File.DoesNotExist, File.MultipleObjectsReturned, Folder.DoesNotExist) as e:
-        logger.info('%s on %s' % (str(e), path))
+    filer_file = caching.get(caching.FILE, path)
+    if filer_file is caching.NOT_CACHED:
+        filer_file = find_file(path)
+        caching.set(caching.FILE, path, filer_file)
+        if filer_file is None:
+            instrumentation.incr('filerthumbnail.miss')
+            return None
+        instrumentation.incr('filerthumbnail.resolved')
+    elif filer_file is None:
+        instrumentation.incr('filerthumbnail.cached_miss')
         return None
+    else:
+        instrumentation.incr('filerthumbnail.cache_hit')
+    return filer_file.file
 
 
-def get_possible_paths(path):
-    return ['%s/%s' % (storage['main']['UPLOAD_TO_PREFIX'], path)
-            for storage in list(filer_settings.FILER_STORAGES.values())]
-
-
-def find_hashed_file(path):
-    path = path.strip('/')
-    slash_index = path.rfind('/')
-    folder_slug, file_name = path[:slash_index+1], path[slash_index+1:]
-    for folder_path in get_possible_paths(folder_slug):
-        slash_count = folder_path.count('/')
-        candidates = File.objects.filter(q_matches_name(file_name), file__startswith=folder_path)
-        for candidate in candidates:
-            if str(candidate.file).count('/') == slash_count:
-                return candidate
+def _find_url(path):
+    if LOGICAL_EQ_ACTUAL_URL:
+        try:
+            return non_polymorphic(File.objects).get(
+                file__in=get_possible_paths(path)).url
+        except (File.DoesNotExist, File.MultipleObjectsReturned) as e:
+            filer_file = find_hashed_file(path)
+            if filer_file:
+                instrumentation.incr('filerfile.fallback')
+                return filer_file.url
+            log_miss(path, str(e))
+            return None
+    else:
+        file_obj = filerthumbnail(path)
+        return file_obj.url if file_obj else None
 
 
+@instrumentation.timed('filerfile')
 def filerfile(path):
     """django-filer has two concepts of paths:
     * the logical path: media/images/foobar.png
@@ -64,18 +59,148 @@ def filerfile(path):
     This tag returns the actual url associated with the logical path.
     """
     path = path.strip('/')
+    url = manifest.lookup(path)
+    if url is not None:
+        instrumentation.incr('filerfile.manifest_hit')
+        return url
+    url = caching.get(caching.URL, path)
+    if url is caching.NOT_CACHED:
+        url = _find_url(path)
+        caching.set(caching.URL, path, url)
+        if url is None:
+            instrumentation.incr('filerfile.miss')
+            return path if LOGICAL_EQ_ACTUAL_URL else ''
+        instrumentation.incr('filerfile.resolved')
+    elif url is None:
+        instrumentation.incr('filerfile.cached_miss')
+        return path if LOGICAL_EQ_ACTUAL_URL else ''
+    else:
+        instrumentation.incr('filerfile.cache_hit')
+    return url
+
+
+def _find_urls(paths):
+    """Batch counterpart of _find_url; paths that can't be resolved are
+    left out of the result.
+    """
     if LOGICAL_EQ_ACTUAL_URL:
-        try:
-            return File.objects.get(file__in=get_possible_paths(path)).url
-        except (File.DoesNotExist, File.MultipleObjectsReturned) as e:
-            filer_file = find_hashed_file(path)
-            if filer_file:
-                return filer_file.url
-            logger.info('%s on %s' % (str(e), path))
-            return path
+        files = find_stored_files(paths)
+        missing = [path for path in paths if path not in files]
+        if missing:
+            files.update(find_hashed_files(missing))
     else:
-        file_obj = filerthumbnail(path)
-        return file_obj.url if file_obj else ''
+        files = find_files(paths)
+        caching.set_many(caching.FILE, files)
+    return dict((path, filer_file.url) for path, filer_file in files.items())
+
+
+def _resolve_urls(paths, guessed=False):
+    """Maps the normalized logical paths to their actual urls or to None
+    when they can't be resolved. Misses of guessed paths, which may not be
+    filer files at all, are neither counted nor logged.
+    """
+    wanted = set(path.strip('/') for path in paths)
+    from_manifest = manifest.lookup_many(wanted)
+    if from_manifest:
+        wanted -= set(from_manifest)
+        instrumentation.incr('filerfiles.manifest_hit', len(from_manifest))
+    urls = caching.get_many(caching.URL, wanted)
+    missing = wanted - set(urls)
+    instrumentation.incr('filerfiles.cache_hit', len(urls))
+    if missing:
+        found = _find_urls(missing)
+        urls.update(found)
+        not_found = missing - set(found)
+        resolutions = dict.fromkeys(not_found)
+        resolutions.update(found)
+        caching.set_many(caching.URL, resolutions)
+        instrumentation.incr('filerfiles.resolved', len(found))
+        if not guessed:
+            instrumentation.incr('filerfiles.miss', len(not_found))
+            for path in not_found:
+                log_miss(path, 'No file found')
+    urls.update(from_manifest)
+    return urls
+
+
+@instrumentation.timed('filerfiles')
+def filerfiles(paths):
+    """Batch counterpart of filerfile: returns a dict which maps each of the
+    logical paths to its actual url.
+
+    The paths are looked up together, 500 per query, instead of one at a
+    time. Paths missing from the LogicalPath index still cost a query per
+    folder level, and with LOGICAL_EQ_ACTUAL_URL the paths not stored under
+    their logical name cost another lookup of the hashed names.
+    """
+    normalized_paths = dict((path, path.strip('/')) for path in paths)
+    urls = _resolve_urls(normalized_paths.values())
+
+    def get_url(normalized):
+        url = urls.get(normalized)
+        if url is None:
+            return normalized if LOGICAL_EQ_ACTUAL_URL else ''
+        return url
+    return dict((path, get_url(normalized))
+                for path, normalized in normalized_paths.items())
+
+
+# absolute paths in src and href attributes; query strings and fragments
+# are left out of the path and kept as they are
+_ATTRIBUTE_PATH_REGEX = re.compile(
+    r"""(\b(?:src|href)\s*=\s*)(["'])(/(?!/)[^"'\s?#]+)([^"']*)\2""")
+
+
+class FilerUrlsNode(template.Node):
+
+    def __init__(self, nodelist, prefix):
+        self.nodelist = nodelist
+        self.prefix = prefix
+
+    @instrumentation.timed('filerurls')
+    def render(self, context):
+        content = self.nodelist.render(context)
+        prefix = self.prefix.resolve(context)
+        if not prefix or prefix == '/':
+            # every absolute link of the page would be taken for a filer path
+            raise template.TemplateSyntaxError(
+                "'filerurls' needs a path prefix other than '/'")
+        paths = set(match.group(3) for match in _ATTRIBUTE_PATH_REGEX.finditer(content)
+                    if match.group(3).startswith(prefix))
+        if not paths:
+            return content
+        urls = _resolve_urls(paths, guessed=True)
+
+        def replace_path(match):
+            url = urls.get(match.group(3).strip('/')) if match.group(3) in paths else None
+            if url is None:
+                # paths that aren't filer files are left untouched
+                return match.group()
+            return '%s%s%s%s%s' % (match.group(1), match.group(2), escape(url),
+                                   match.group(4), match.group(2))
+        return _ATTRIBUTE_PATH_REGEX.sub(replace_path, content)
+
+
+def filerurls(parser, token):
+    """Replaces the logical paths of the src and href attributes found in
+    its rendered body with their actual urls, resolving all of them with
+    one batch lookup. Only the paths starting with the given prefix, the
+    name of a root folder of filer, are rewritten:
+
+        {% filerurls "/media/" %}
+            <img src="/media/images/foobar.png">
+        {% endfilerurls %}
+
+    The paths that can't be resolved are left as they are, without being
+    logged as misses.
+    """
+    bits = token.split_contents()
+    if len(bits) != 2:
+        raise template.TemplateSyntaxError(
+            "'%s' takes one argument, a path prefix" % bits[0])
+    nodelist = parser.parse(('endfilerurls',))
+    parser.delete_first_token()
+    return FilerUrlsNode(nodelist, parser.compile_filter(bits[1]))
 
 
 def mustache(path):
@@ -87,3 +212,4 @@ register = template.Library()
 register.filter(stringfilter(filerthumbnail))
 register.filter(stringfilter(filerfile))
 register.filter(stringfilter(mustache))
+register.tag('filerurls', filerurls)
@@ -0,0 +1,100 @@
+import asyncio
+from unittest import skipUnless
+
+from django.core.cache import cache
+
+from filer.models.foldermodels import Folder
+
+from filertags import asynchronous, caching, instrumentation
+from filertags.templatetags.filertags import filerfile
+
+from .tests import FilerStorageTestCase, create_filer_file
+
+
+@skipUnless(asynchronous.HAS_ASYNC_ORM, 'needs the async ORM of Django 4.1+')
+class AsyncResolutionTest(FilerStorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        media = Folder.objects.create(name='media')
+        self.images = Folder.objects.create(name='images', parent=media)
+        self.files = dict(
+            ('/media/images/image%d.png' % i,
+             create_filer_file('image%d.png' % i, self.images, content='png'))
+            for i in range(5))
+
+    async def test_async_resolvers_match_sync_ones(self):
+        paths = list(self.files) + ['/media/images/missing.png']
+        urls = await asynchronous.aresolve_many(paths)
+        cache.clear()
+        caching.clear_local()
+        for path in paths:
+            self.assertEqual(await asynchronous.afilerfile(path), urls[path])
+        for path, filer_file in self.files.items():
+            self.assertEqual(urls[path], filer_file.url)
+
+    async def test_async_thumbnail(self):
+        path, filer_file = list(self.files.items())[0]
+        thumbnail = await asynchronous.afilerthumbnail(path)
+        self.assertEqual(thumbnail.name, filer_file.file.name)
+        self.assertIsNone(await asynchronous.afilerthumbnail('/media/images/missing.png'))
+
+
+class AsyncFallbackTest(FilerStorageTestCase):
+    """The async resolvers without the async ORM, e.g. on Django 1.8."""
+
+    def setUp(self):
+        super().setUp()
+        media = Folder.objects.create(name='media')
+        self.images = Folder.objects.create(name='images', parent=media)
+        self.files = dict(
+            ('/media/images/image%d.png' % i,
+             create_filer_file('image%d.png' % i, self.images, content='png'))
+            for i in range(5))
+        # the resolvers run in place, in the thread holding the test
+        # transaction
+        self.usual_async_orm = asynchronous.HAS_ASYNC_ORM
+        self.usual_sync_to_async = asynchronous.sync_to_async
+        asynchronous.HAS_ASYNC_ORM = False
+        asynchronous.sync_to_async = None
+
+    def tearDown(self):
+        asynchronous.HAS_ASYNC_ORM = self.usual_async_orm
+        asynchronous.sync_to_async = self.usual_sync_to_async
+        super().tearDown()
+
+    def run_coroutine(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_async_resolvers_match_sync_ones(self):
+        paths = list(self.files) + ['/media/images/missing.png']
+        urls = self.run_coroutine(asynchronous.aresolve_many(paths))
+        cache.clear()
+        caching.clear_local()
+        for path in paths:
+            self.assertEqual(self.run_coroutine(asynchronous.afilerfile(path)), urls[path])
+            self.assertEqual(filerfile(path), urls[path])
+        path, filer_file = list(self.files.items())[0]
+        self.assertEqual(self.run_coroutine(asynchronous.afilerthumbnail(path)).name,
+                         filer_file.file.name)
+
+    def test_async_resolvers_are_instrumented(self):
+        sink = instrumentation.MemorySink()
+        instrumentation.add_sink(sink)
+        try:
+            path = list(self.files)[0]
+            self.run_coroutine(asynchronous.afilerfile(path))
+            self.run_coroutine(asynchronous.afilerfile(path))
+            self.run_coroutine(asynchronous.afilerfiles([path, '/media/images/missing.png']))
+        finally:
+            instrumentation.remove_sink(sink)
+        self.assertEqual(len(sink.timings['filerfile']), 2)
+        self.assertEqual(len(sink.timings['filerfiles']), 1)
+        self.assertEqual(sink.counters['filerfile.resolved'], 1)
+        self.assertEqual(sink.counters['filerfile.cache_hit'], 1)
+        self.assertEqual(sink.counters['filerfiles.cache_hit'], 1)
+        self.assertEqual(sink.counters['filerfiles.miss'], 1)
@@ -0,0 +1,240 @@
+"""Benchmarks for the template filters and the css signal hooks.
+
+Builds a synthetic filer tree in a throwaway test database and reports,
+for every benchmark, the wall time, the number of queries and the peak
+memory allocated by python. Tracing allocations slows python down, so the
+peak memory is measured in a second run of every benchmark. Run it with:
+
+    DJANGO_SETTINGS_MODULE=filertags.tests.settings \\
+        python -m filertags.tests.benchmarks --files 20000 --css 200
+
+Use --json to save the results and compare them across versions. The
+script only relies on what the first releases of filertags provide, so it
+can be copied into an older checkout to measure it too.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+def _setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'filertags.tests.settings')
+    import django
+    django.setup()
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+
+
+class Dataset(object):
+    """Synthetic filer tree: folders nested depth levels deep with fanout
+    subfolders each, files spread over the leaf folders and css files
+    referencing refs_per_css random images each.
+    """
+
+    def __init__(self, depth, fanout, files, css, refs_per_css, seed=0):
+        self.depth = depth
+        self.fanout = fanout
+        self.files = files
+        self.css = css
+        self.refs_per_css = refs_per_css
+        self.random = random.Random(seed)
+        self.folders = []
+        self.file_paths = []
+        self.css_files = []
+
+    def generate(self):
+        self._generate_folders()
+        self._generate_files()
+        self._generate_css()
+
+    def _generate_folders(self):
+        from filer.models.foldermodels import Folder
+        level = [Folder.objects.create(name='media')]
+        paths = {level[0].pk: 'media'}
+        for depth in range(self.depth):
+            next_level = []
+            for parent in level:
+                for i in range(self.fanout):
+                    folder = Folder.objects.create(name='folder%d' % i, parent=parent)
+                    paths[folder.pk] = '%s/%s' % (paths[parent.pk], folder.name)
+                    next_level.append(folder)
+            level = next_level
+        self.folders = [(folder, paths[folder.pk]) for folder in level]
+
+    def _generate_files(self):
+        # files are created without touching the storage; the resolution
+        # benchmarks only need the database rows
+        from django.contrib.contenttypes.models import ContentType
+        from filer.models.filemodels import File
+        import filer.settings as filer_settings
+        prefix = list(filer_settings.FILER_STORAGES.values())[0]['main']['UPLOAD_TO_PREFIX']
+        extra = {}
+        if any(field.name == 'polymorphic_ctype' for field in File._meta.fields):
+            extra['polymorphic_ctype'] = ContentType.objects.get_for_model(File)
+        files = []
+        for i in range(self.files):
+            folder, folder_path = self.folders[i % len(self.folders)]
+            name = 'image%d.png' % i
+            path = '%s/%s' % (folder_path, name)
+            files.append(File(folder=folder, original_filename=name,
+                              file='%s/%s' % (prefix, path), **extra))
+            self.file_paths.append(path)
+        File.objects.bulk_create(files, batch_size=500)
+        from django.core.management import call_command, get_commands
+        # bulk_create skips the hooks filling the lookup tables, if any
+        if 'filertags_backfill' in get_commands():
+            call_command('filertags_backfill', stdout=io.StringIO())
+
+    def css_content(self, folder_path):
+        refs = self.random.sample(self.file_paths, min(self.refs_per_css, len(self.file_paths)))
+        return ''.join(
+            '/* license comment %d */\n.sprite%d { background: url(\'/%s\'); }\n' % (i, i, ref)
+            for i, ref in enumerate(refs))
+
+    def _generate_css(self):
+        # the css files are resolved by the pre save hook, like uploads are
+        from django.core.files.base import ContentFile
+        from filer.models.filemodels import File
+        for i in range(self.css):
+            folder, folder_path = self.random.choice(self.folders)
+            name = 'style%d.css' % i
+            self.css_files.append(File.objects.create(
+                folder=folder, original_filename=name,
+                file=ContentFile(self.css_content(folder_path).encode('utf-8'), name)))
+
+
+def measure(name, func, repeat=1, setup=None, memory=True):
+    """Runs func repeat times and returns its wall time, query count and
+    python memory peak. The memory peak is measured in a second run, after
+    calling setup again, unless memory is False; None is reported then.
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    if setup is not None:
+        setup()
+    with CaptureQueriesContext(connection) as queries:
+        started = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        elapsed = time.perf_counter() - started
+    peak = None
+    if memory:
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        try:
+            for _ in range(repeat):
+                func()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return {'name': name, 'repeat': repeat, 'seconds': elapsed,
+            'queries': len(queries), 'peak_memory': peak}
+
+
+def _clear_caches():
+    from django.core.cache import cache
+    cache.clear()
+    try:
+        from filertags import caching
+    except ImportError:
+        # releases without the in-process cache
+        return
+    caching.clear_local()
+
+
+def run_benchmarks(dataset, sample_size):
+    from django.core.files.base import ContentFile
+    from filer.models.filemodels import File
+    from filertags.signals import resolve_resource_urls, \
+        update_referencing_css_files
+    from filertags.templatetags.filertags import filerfile, filerthumbnail, \
+        find_hashed_file
+
+    paths = dataset.random.sample(dataset.file_paths, min(sample_size, len(dataset.file_paths)))
+    results = []
+
+    def resolve_all(resolver):
+        def run():
+            for path in paths:
+                resolver(path)
+        return run
+
+    for resolver in (filerfile, filerthumbnail):
+        results.append(measure('%s cold x%d' % (resolver.__name__, len(paths)),
+                               resolve_all(resolver), setup=_clear_caches))
+        results.append(measure('%s warm x%d' % (resolver.__name__, len(paths)),
+                               resolve_all(resolver)))
+    results.append(measure('find_hashed_file x%d' % len(paths), resolve_all(find_hashed_file)))
+
+    folder, folder_path = dataset.folders[0]
+    content = dataset.css_content(folder_path).encode('utf-8')
+
+    def resolve_css():
+        css = File(folder=folder, original_filename='benchmark.css',
+                   file=ContentFile(content, 'benchmark.css'))
+        resolve_resource_urls(css)
+    results.append(measure('resolve_resource_urls (%d urls)' % dataset.refs_per_css,
+                           resolve_css, setup=_clear_caches))
+
+    referenced = File.objects.get(
+        original_filename=os.path.basename(paths[0]))
+    results.append(measure('update_referencing_css_files',
+                           lambda: update_referencing_css_files(referenced)))
+    return results
+
+
+def report(results, out=sys.stdout):
+    out.write('%-45s %10s %10s %14s\n' % ('benchmark', 'seconds', 'queries', 'peak memory'))
+    for result in results:
+        peak = result['peak_memory']
+        out.write('%-45s %10.4f %10d %14s\n' % (
+            result['name'], result['seconds'], result['queries'],
+            '-' if peak is None else '%dKB' % (peak // 1024)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument('--files', type=int, default=20000)
+    parser.add_argument('--css', type=int, default=200)
+    parser.add_argument('--refs', type=int, default=50,
+                        help='url() references per css file')
+    parser.add_argument('--sample', type=int, default=500,
+                        help='number of paths resolved by the filter benchmarks')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write the results to this file')
+    options = parser.parse_args(argv)
+
+    _setup_django()
+    from filer.settings import FILER_PUBLICMEDIA_STORAGE
+    from filertags.signals import attach_css_rewriting_rules
+    attach_css_rewriting_rules()
+    media_root = tempfile.mkdtemp(prefix='filertags-benchmarks-')
+    FILER_PUBLICMEDIA_STORAGE.location = media_root
+    try:
+        dataset = Dataset(options.depth, options.fanout, options.files,
+                          options.css, options.refs, options.seed)
+        # the dataset can only be generated once
+        generation = measure('generate dataset', dataset.generate, memory=False)
+        results = [generation] + run_benchmarks(dataset, options.sample)
+    finally:
+        shutil.rmtree(media_root, ignore_errors=True)
+    report(results)
+    if options.json:
+        with open(options.json, 'w') as json_file:
+            json.dump({'options': vars(options), 'results': results}, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,7 +14,8 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'filer',
     'mptt',
-    'easy_thumbnails'
+    'easy_thumbnails',
+    'filertags',
 ]
 
 CMS_TEMPLATES = (
@@ -61,4 +62,3 @@ filer_storages = getattr(filer.settings, 'FILER_STORAGES', {})
 LOGICAL_EQ_ACTUAL_URL = all(
     storage['main']['UPLOAD_TO'] == 'filer.utils.generate_filename.by_path'
     for storage in list(filer_storages.values()))
-
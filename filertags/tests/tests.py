@@ -1,20 +1,40 @@
+import gzip
 import hashlib
+import io
+import logging
 import os.path
+import random
 import re
 import shutil
+import sys
+import tempfile
+from unittest import skipUnless
 
 from django.contrib.auth.models import User
 from django.core.cache import cache
 from django.core.files.base import File as DjangoFile, ContentFile
-from django.test import TestCase
+from django.core.management import call_command
+from django.db import connection, transaction, DatabaseError, IntegrityError
+from django.template import Context, Template, TemplateSyntaxError
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
 
 from filer.models.filemodels import File
 from filer.models.foldermodels import Folder
+from filer.models.imagemodels import Image
 from filer.settings import FILER_PUBLICMEDIA_STORAGE
 
+import filertags
+from filertags import caching, css_updates, folder_tree, instrumentation, \
+    lookups, manifest
+from filertags import css as css_tools
+from filertags import signals as filertags_signals
+from filertags.models import CssReference, LogicalPath
 from filertags.signals import _ALREADY_PARSED_MARKER, _LOGICAL_URL_TEMPLATE,\
     attach_css_rewriting_rules, detach_css_rewriting_rules
-from filertags.templatetags.filertags import find_hashed_file
+from filertags.templatetags import filertags as filertags_templatetags
+from filertags.templatetags.filertags import find_hashed_file, filerfile, \
+    filerfiles, filerthumbnail
 
 
 def create_filer_file(name, folder, content=None, owner=None):
@@ -30,14 +50,53 @@ def create_filer_file(name, folder, content=None, owner=None):
                                folder=folder)
 
 
+def create_filer_image(name, folder, owner=None):
+    """Creates an Image of the test image files/foobar.png stored as name."""
+    path = os.path.join(os.path.dirname(__file__), 'files', 'foobar.png')
+    with open(path, 'rb') as image_file:
+        return Image.objects.create(owner=owner,
+                                    original_filename=name,
+                                    file=DjangoFile(image_file, name=name),
+                                    folder=folder)
+
+
 def _get_test_usermedia_location():
     HERE = os.path.dirname(os.path.realpath(__file__))
     return os.path.join(HERE, 'tmp_user_media')
 
 
-class CssRewriteTest(TestCase):
+class FilerStorageTestCase(TestCase):
+    """Stores the filer files of the tests of the class in ./tmp_user_media,
+    which gets deleted afterwards along with the cached lookups.
+    """
+
+    def setUp(self):
+        self.usual_location = FILER_PUBLICMEDIA_STORAGE.location
+        FILER_PUBLICMEDIA_STORAGE.location = _get_test_usermedia_location()
+
+    def tearDown(self):
+        cache.clear()
+        caching.clear_local()
+        shutil.rmtree(FILER_PUBLICMEDIA_STORAGE.location)
+        FILER_PUBLICMEDIA_STORAGE.location = self.usual_location
+
+
+class LogicalPathIndexMixin(object):
+    """Turns the opt-in LogicalPath index on for the tests of the class."""
 
     def setUp(self):
+        self.usual_logical_path_index = lookups.LOGICAL_PATH_INDEX
+        lookups.LOGICAL_PATH_INDEX = True
+        filertags_signals.LOGICAL_PATH_INDEX = True
+        super().setUp()
+        lookups.LOGICAL_PATH_INDEX = self.usual_logical_path_index
+        filertags_signals.LOGICAL_PATH_INDEX = self.usual_logical_path_index
+
+
+class CssRewriteTest(FilerStorageTestCase):
+
+    def setUp(self):
+        super().setUp()
         attach_css_rewriting_rules()
         self.superuser = User.objects.create_superuser(
             'admin', 'admin@filertags.com', 'secret')
@@ -46,16 +105,10 @@ class CssRewriteTest(TestCase):
         producer = Folder.objects.create(name='producer', parent=media_folder)
         self.producer_css = Folder.objects.create(name='css', parent=producer)
         self.producer_images = Folder.objects.create(name='images', parent=producer)
-        self.usual_location = FILER_PUBLICMEDIA_STORAGE.location
-        # all files generated during these tests are written to ./tmp_user_media
-        # and get deleted afterwards (see tearDown)
-        FILER_PUBLICMEDIA_STORAGE.location = _get_test_usermedia_location()
 
     def tearDown(self):
-        cache.clear()
-        shutil.rmtree(FILER_PUBLICMEDIA_STORAGE.location)
-        FILER_PUBLICMEDIA_STORAGE.location = self.usual_location
         detach_css_rewriting_rules()
+        super().tearDown()
 
     def create_file(self, name, folder, content=None):
         return create_filer_file(name, folder, content, owner=self.superuser)
@@ -77,6 +130,26 @@ class CssRewriteTest(TestCase):
         new_content = open(updated_css.path).read()
         self.assertIsNotNone(re.search(r"\burl\('[^']*foobar[^']*png'\)", new_content))
 
+    def test_css_urls_are_resolved_through_the_logical_path_index(self):
+        usual_index = lookups.LOGICAL_PATH_INDEX
+        lookups.LOGICAL_PATH_INDEX = True
+        filertags_signals.LOGICAL_PATH_INDEX = True
+        # the test settings store files under their logical path
+        usual_logical_eq = filertags_templatetags.LOGICAL_EQ_ACTUAL_URL
+        filertags_templatetags.LOGICAL_EQ_ACTUAL_URL = False
+        try:
+            image = self.create_file('foobar.png', self.producer_images)
+            css = self.create_file('logical.css', self.producer_css, content="""\
+.a { background: url('../images/foobar.png'); }
+.b { background: url('/media/producer/images/foobar.png'); }
+""")
+        finally:
+            filertags_templatetags.LOGICAL_EQ_ACTUAL_URL = usual_logical_eq
+            lookups.LOGICAL_PATH_INDEX = usual_index
+            filertags_signals.LOGICAL_PATH_INDEX = usual_index
+        self.assertEqual(open(css.path).read().count("url('%s') %s" % (
+            image.url, _LOGICAL_URL_TEMPLATE % '/media/producer/images/foobar.png')), 2)
+
     def _verify_css_is_corectly_rewritten(self, css):
         css_content = open(css.path).read()
         self.assertTrue(css_content.startswith(_ALREADY_PARSED_MARKER))
@@ -163,17 +236,438 @@ class CssRewriteTest(TestCase):
         sha.update(css_content)
         self.assertEqual(sha.hexdigest(), css.sha1)
 
+    def test_css_references_are_recorded(self):
+        css = self.create_file('relative_url_to_image.css', self.producer_css,
+                               content="""\
+.pledge-block {
+    background: url('../images/foobar.png');
+}
+""")
+        self.assertEqual(
+            list(CssReference.objects.filter(css=css).values_list('path', flat=True)),
+            ['media/producer/images/foobar.png'])
+        referencing = CssReference.objects.referencing_files(
+            '/media/producer/images/foobar.png')
+        self.assertEqual([f.pk for f in referencing], [css.pk])
+
+    def test_only_referencing_css_files_are_updated(self):
+        content = """\
+.pledge-block {
+    background: url('../images/foobar.png');
+}
+"""
+        css = self.create_file('indexed.css', self.producer_css, content=content)
+        unindexed_css = self.create_file(
+            'unindexed.css', self.producer_css, content=content)
+        CssReference.objects.filter(css=unindexed_css).delete()
+        usual_index = filertags_signals.CSS_REFERENCE_INDEX
+        filertags_signals.CSS_REFERENCE_INDEX = True
+        try:
+            self.create_file('foobar.png', self.producer_images)
+        finally:
+            filertags_signals.CSS_REFERENCE_INDEX = usual_index
+        self._verify_css_is_corectly_rewritten(File.objects.get(pk=css.pk))
+        unindexed_content = open(File.objects.get(pk=unindexed_css.pk).path).read()
+        self.assertIn("url('')", unindexed_content)
 
-class TestMatchFiles(TestCase):
+    def test_css_files_are_scanned_without_the_reference_index(self):
+        css = self.create_file('unindexed.css', self.producer_css, content="""\
+.pledge-block {
+    background: url('../images/foobar.png');
+}
+""")
+        CssReference.objects.filter(css=css).delete()
+        self.create_file('foobar.png', self.producer_images)
+        self._verify_css_is_corectly_rewritten(File.objects.get(pk=css.pk))
 
-    def setUp(self):
-        self.usual_location = FILER_PUBLICMEDIA_STORAGE.location
-        FILER_PUBLICMEDIA_STORAGE.location = _get_test_usermedia_location()
+    def test_css_is_rewritten_in_chunks(self):
+        image = self.create_file('foobar.png', self.producer_images)
+        declarations = ''.join(
+            ".block%d { background: url('../images/foobar.png'); }\n" % i
+            for i in range(50))
+        usual_chunk_size = filertags_signals._CHUNK_SIZE
+        filertags_signals._CHUNK_SIZE = 7
+        try:
+            css = self.create_file('chunked.css', self.producer_css,
+                                   content=declarations)
+        finally:
+            filertags_signals._CHUNK_SIZE = usual_chunk_size
+        css_content = open(css.path).read()
+        resolved = "url('%s') %s" % (
+            image.url, _LOGICAL_URL_TEMPLATE % '/media/producer/images/foobar.png')
+        self.assertEqual(css_content.count(resolved), 50)
+        self.assertEqual(len(css_content), css.size)
 
-    def tearDown(self):
-        cache.clear()
-        shutil.rmtree(FILER_PUBLICMEDIA_STORAGE.location)
-        FILER_PUBLICMEDIA_STORAGE.location = self.usual_location
+    def test_unchanged_content_is_not_rewritten(self):
+        css = self.create_file('relative_url_to_image.css', self.producer_css,
+                               content="""\
+.pledge-block {
+    background: url('../images/foobar.png');
+}
+""")
+        css = File.objects.get(pk=css.pk)
+        with open(css.path, 'rb') as css_file:
+            content = css_file.read()
+        modified = os.path.getmtime(css.path)
+        new_content = filertags_signals._RewrittenContent('utf-8')
+        new_content.write(content.decode('utf-8'), final=True)
+        self.assertFalse(filertags_signals._rewrite_file_content(css, new_content))
+        self.assertEqual(os.path.getmtime(css.path), modified)
+
+    def test_resolve_css_command(self):
+        css = self.create_file('absolute_url_to_image.css', self.producer_css,
+                               content="""\
+.pledge-block {
+    background: url('/media/producer/images/foobar.png');
+}
+""")
+        detach_css_rewriting_rules()
+        try:
+            self.create_file('foobar.png', self.producer_images)
+        finally:
+            attach_css_rewriting_rules()
+        unresolved_content = open(css.path).read()
+        out = io.StringIO()
+        call_command('filertags_resolve_css', dry_run=True, stdout=out)
+        self.assertIn('Would change 1 of 1 css files', out.getvalue())
+        self.assertEqual(open(css.path).read(), unresolved_content)
+        call_command('filertags_resolve_css', stdout=io.StringIO())
+        self._verify_css_is_corectly_rewritten(File.objects.get(pk=css.pk))
+
+    def test_resolve_css_command_in_processes(self):
+        for i in range(3):
+            self.create_file('absolute%d.css' % i, self.producer_css, content="""\
+.pledge-block {
+    background: url('/media/producer/images/foobar.png');
+}
+""")
+        detach_css_rewriting_rules()
+        try:
+            self.create_file('foobar.png', self.producer_images)
+        finally:
+            attach_css_rewriting_rules()
+        out = io.StringIO()
+        # the forked workers only see a copy of the test database, so their
+        # changes are not checked here
+        call_command('filertags_resolve_css', dry_run=True, workers=2,
+                     processes=True, chunk_size=1, stdout=out)
+        self.assertIn('Would change 3 of 3 css files', out.getvalue())
+
+    def test_css_files_are_updated_in_chunks(self):
+        css_files = [
+            self.create_file('chunk%d.css' % i, self.producer_css, content="""\
+.pledge-block {
+    background: url('../images/foobar.png');
+}
+""") for i in range(5)]
+        usual_chunk_size = filertags_signals._CSS_CHUNK_SIZE
+        filertags_signals._CSS_CHUNK_SIZE = 2
+        try:
+            self.create_file('foobar.png', self.producer_images)
+        finally:
+            filertags_signals._CSS_CHUNK_SIZE = usual_chunk_size
+        for css in css_files:
+            self._verify_css_is_corectly_rewritten(File.objects.get(pk=css.pk))
+
+    def test_css_files_are_updated_concurrently(self):
+        css_files = [
+            self.create_file('concurrent%d.css' % i, self.producer_css, content="""\
+.pledge-block {
+    background: url('../images/foobar.png');
+}
+""") for i in range(5)]
+        usual_workers = filertags_signals.CSS_UPDATE_WORKERS
+        filertags_signals.CSS_UPDATE_WORKERS = 3
+        try:
+            self.create_file('foobar.png', self.producer_images)
+        finally:
+            filertags_signals.CSS_UPDATE_WORKERS = usual_workers
+        for css in css_files:
+            self._verify_css_is_corectly_rewritten(File.objects.get(pk=css.pk))
+
+    def test_css_changed_while_being_updated_is_read_again(self):
+        css = self.create_file('changing.css', self.producer_css, content="""\
+.pledge-block {
+    background: url('../images/foobar.png');
+}
+""")
+        reads = []
+        usual_read = filertags_signals._read_annotated_url_updates
+
+        def read(css, replacements):
+            reads.append(css.pk)
+            if len(reads) == 1:
+                # another update saves the css while this one rewrites it
+                File.objects.filter(pk=css.pk).update(sha1='changed')
+            return usual_read(css, replacements)
+        filertags_signals._read_annotated_url_updates = read
+        try:
+            self.assertTrue(filertags_signals.update_logical_urls_in_css(
+                File.objects.get(pk=css.pk),
+                {'/media/producer/images/foobar.png': '/cdn/foobar.png'}))
+        finally:
+            filertags_signals._read_annotated_url_updates = usual_read
+        self.assertEqual(reads, [css.pk, css.pk])
+        self.assertIn("url('/cdn/foobar.png')", open(File.objects.get(pk=css.pk).path).read())
+
+    def test_css_files_are_scanned_with_deferred_columns(self):
+        self.create_file('scanned.css', self.producer_css, content="""\
+.pledge-block {
+    background: url('../images/foobar.png');
+}
+""")
+        scanned = list(filertags_signals._iter_css_files(
+            File.objects.filter(original_filename__endswith='.css')))
+        self.assertEqual(len(scanned), 1)
+        self.assertIn('sha1', scanned[0].get_deferred_fields())
+
+    def test_css_follows_files_of_renamed_folder(self):
+        self._verify_css_follows_files_of_renamed_folder()
+
+    def test_css_follows_files_of_renamed_folder_through_the_reference_index(self):
+        usual_index = filertags_signals.CSS_REFERENCE_INDEX
+        filertags_signals.CSS_REFERENCE_INDEX = True
+        try:
+            self._verify_css_follows_files_of_renamed_folder()
+        finally:
+            filertags_signals.CSS_REFERENCE_INDEX = usual_index
+
+    def _verify_css_follows_files_of_renamed_folder(self):
+        image = self.create_file('foobar.png', self.producer_images)
+        css = self.create_file('renamed.css', self.producer_css, content="""\
+.pledge-block {
+    background: url('../images/foobar.png');
+}
+.other-block {
+    background: url('../pictures/foobar.png');
+}
+""")
+        self.producer_images.name = 'pictures'
+        self.producer_images.save()
+        css_content = open(File.objects.get(pk=css.pk).path).read()
+        self.assertNotIn('/media/producer/images/', css_content)
+        resolved = "url('%s') %s" % (
+            File.objects.get(pk=image.pk).url,
+            _LOGICAL_URL_TEMPLATE % '/media/producer/pictures/foobar.png')
+        self.assertEqual(css_content.count(resolved), 2)
+        self.assertEqual(
+            list(CssReference.objects.filter(css=css).values_list('path', flat=True)),
+            ['media/producer/pictures/foobar.png'])
+
+    def test_deferred_updates_are_coalesced(self):
+        content = """\
+.a { background: url('../images/foo.png'); }
+.b { background: url('../images/bar.png'); }
+"""
+        css = self.create_file('coalesced.css', self.producer_css, content=content)
+        usual_mode = filertags_signals.CSS_UPDATE_MODE
+        filertags_signals.CSS_UPDATE_MODE = 'deferred'
+        try:
+            foo = self.create_file('foo.png', self.producer_images, content='foo')
+            bar = self.create_file('bar.png', self.producer_images, content='bar')
+        finally:
+            filertags_signals.CSS_UPDATE_MODE = usual_mode
+        # the test case transaction never commits, the updates are pending
+        self.assertIn("url('')", open(css.path).read())
+        self.assertEqual(css_updates.get_pending(), set([
+            '/media/producer/images/foo.png', '/media/producer/images/bar.png']))
+        css_updates.flush_pending()
+        self.assertEqual(css_updates.get_pending(), set())
+        css_content = open(File.objects.get(pk=css.pk).path).read()
+        self.assertIn("url('%s')" % foo.url, css_content)
+        self.assertIn("url('%s')" % bar.url, css_content)
+
+    def test_css_referencing_many_resources_is_rewritten_once(self):
+        content = """\
+.a { background: url('../images/foo.png'); }
+.b { background: url('../images/bar.png'); }
+"""
+        css = self.create_file('coalesced.css', self.producer_css, content=content)
+        detach_css_rewriting_rules()
+        try:
+            self.create_file('foo.png', self.producer_images, content='foo')
+            self.create_file('bar.png', self.producer_images, content='bar')
+        finally:
+            attach_css_rewriting_rules()
+        rewrites = []
+        usual_rewrite = filertags_signals._rewrite_file_content
+
+        def rewrite(filer_file, new_content):
+            rewrites.append(filer_file.pk)
+            return usual_rewrite(filer_file, new_content)
+        filertags_signals._rewrite_file_content = rewrite
+        try:
+            filertags_signals.update_css_files_referencing([
+                '/media/producer/images/foo.png', '/media/producer/images/bar.png'])
+        finally:
+            filertags_signals._rewrite_file_content = usual_rewrite
+        self.assertEqual(rewrites, [css.pk])
+        self.assertNotIn("url('')", open(File.objects.get(pk=css.pk).path).read())
+
+    def test_many_logical_urls_are_updated_in_one_pass(self):
+        css = self.create_file('many.css', self.producer_css, content="""\
+.a { background: url('../images/foo.png'); }
+.b { background: url('../images/bar.png'); }
+.c { background: url('../images/baz.png'); }
+""")
+        css = File.objects.get(pk=css.pk)
+        self.assertTrue(filertags_signals.update_logical_urls_in_css(css, {
+            '/media/producer/images/foo.png': '/cdn/foo.png',
+            '/media/producer/images/bar.png': '/cdn/bar.png'}))
+        css_content = open(File.objects.get(pk=css.pk).path).read()
+        self.assertIn("url('/cdn/foo.png') %s" % (
+            _LOGICAL_URL_TEMPLATE % '/media/producer/images/foo.png'), css_content)
+        self.assertIn("url('/cdn/bar.png') %s" % (
+            _LOGICAL_URL_TEMPLATE % '/media/producer/images/bar.png'), css_content)
+        self.assertIn("url('') %s" % (
+            _LOGICAL_URL_TEMPLATE % '/media/producer/images/baz.png'), css_content)
+        self.assertFalse(filertags_signals.update_logical_urls_in_css(
+            File.objects.get(pk=css.pk), {'/media/producer/images/foo.png': '/cdn/foo.png'}))
+
+    def test_compressed_copy_follows_rewrites(self):
+        usual_gzip = filertags_signals.CSS_GZIP
+        filertags_signals.CSS_GZIP = True
+        try:
+            css = self.create_file('compressed.css', self.producer_css, content="""\
+.pledge-block {
+    background: url('../images/foobar.png');
+}
+""")
+            compressed_path = css.path + '.gz'
+            with gzip.open(compressed_path, 'rb') as compressed:
+                self.assertEqual(compressed.read(), open(css.path, 'rb').read())
+            self.create_file('foobar.png', self.producer_images)
+            css = File.objects.get(pk=css.pk)
+            with gzip.open(compressed_path, 'rb') as compressed:
+                self.assertEqual(compressed.read(), open(css.path, 'rb').read())
+            self.assertNotIn(b"url('')", open(css.path, 'rb').read())
+            css.delete()
+        finally:
+            filertags_signals.CSS_GZIP = usual_gzip
+        self.assertFalse(os.path.exists(compressed_path))
+
+    def test_compressed_copy_follows_replaced_files(self):
+        usual_gzip = filertags_signals.CSS_GZIP
+        filertags_signals.CSS_GZIP = True
+        try:
+            css = self.create_file('replaced.css', self.producer_css, content='.a { color: red; }')
+            compressed_path = css.path + '.gz'
+            # content filertags doesn't rewrite
+            css = File.objects.get(pk=css.pk)
+            css.file = ContentFile(
+                '%s\n.a { color: blue; }' % _ALREADY_PARSED_MARKER, 'renamed.css')
+            css.save()
+            css = File.objects.get(pk=css.pk)
+            self.assertNotEqual(css.path + '.gz', compressed_path)
+            self.assertFalse(os.path.exists(compressed_path))
+            with gzip.open(css.path + '.gz', 'rb') as compressed:
+                self.assertEqual(compressed.read(), open(css.path, 'rb').read())
+        finally:
+            filertags_signals.CSS_GZIP = usual_gzip
+
+    def test_imports_are_bundled(self):
+        image = self.create_file('foobar.png', self.producer_images)
+        usual_bundle_imports = filertags_signals.CSS_BUNDLE_IMPORTS
+        filertags_signals.CSS_BUNDLE_IMPORTS = True
+        try:
+            base = self.create_file('base.css', self.producer_css, content="""\
+.base { background: url('../images/foobar.png'); }
+""")
+            css = self.create_file('main.css', self.producer_css, content="""\
+@import url('base.css');
+.main { color: red; }
+""")
+            css_content = open(css.path).read()
+            base_path = '/media/producer/css/base.css'
+            self.assertTrue(css_content.startswith(_ALREADY_PARSED_MARKER))
+            self.assertNotIn("@import", css_content)
+            self.assertIn("/* filertags-import('%s') */" % base_path, css_content)
+            self.assertEqual(css_content.count("url('%s') %s" % (
+                image.url, _LOGICAL_URL_TEMPLATE % '/media/producer/images/foobar.png')), 1)
+            self.assertEqual(
+                set(CssReference.objects.filter(css=css).values_list('path', flat=True)),
+                set(['media/producer/css/base.css', 'media/producer/images/foobar.png']))
+
+            base = File.objects.get(pk=base.pk)
+            with open(base.path, 'w') as base_file:
+                base_file.write('%s\n.base { color: blue; }\n' % _ALREADY_PARSED_MARKER)
+            base.save()
+        finally:
+            filertags_signals.CSS_BUNDLE_IMPORTS = usual_bundle_imports
+        css_content = open(File.objects.get(pk=css.pk).path).read()
+        self.assertIn('.base { color: blue; }', css_content)
+        self.assertNotIn('foobar', css_content)
+        self.assertIn('.main { color: red; }', css_content)
+        self.assertEqual(
+            list(CssReference.objects.filter(css=css).values_list('path', flat=True)),
+            ['media/producer/css/base.css'])
+
+    def test_imports_are_bundled_together_or_not_at_all(self):
+        usual_bundle_imports = filertags_signals.CSS_BUNDLE_IMPORTS
+        filertags_signals.CSS_BUNDLE_IMPORTS = True
+        try:
+            base = self.create_file('base.css', self.producer_css, content=".base { color: red; }\n")
+            self.create_file('print.css', self.producer_css, content=".print { color: red; }\n")
+            css = self.create_file('main.css', self.producer_css, content="""\
+@import url('base.css');
+@import 'print.css' print;
+.main { color: red; }
+""")
+        finally:
+            filertags_signals.CSS_BUNDLE_IMPORTS = usual_bundle_imports
+        css_content = open(css.path).read()
+        self.assertNotIn('filertags-import', css_content)
+        self.assertIn("@import url('%s') %s;" % (
+            base.url, _LOGICAL_URL_TEMPLATE % '/media/producer/css/base.css'), css_content)
+        self.assertIn("@import 'print.css' print;", css_content)
+        self.assertEqual(
+            set(CssReference.objects.filter(css=css).values_list('path', flat=True)),
+            set(['media/producer/css/base.css', 'media/producer/css/print.css']))
+
+    def test_imports_are_bundled_once_the_imported_css_is_saved(self):
+        usual_bundle_imports = filertags_signals.CSS_BUNDLE_IMPORTS
+        filertags_signals.CSS_BUNDLE_IMPORTS = True
+        try:
+            css = self.create_file('main.css', self.producer_css, content="""\
+@import 'late.css';
+.main { color: red; }
+""")
+            self.assertIn("@import 'late.css';", open(css.path).read())
+            self.assertEqual(
+                list(CssReference.objects.filter(css=css).values_list('path', flat=True)),
+                ['media/producer/css/late.css'])
+            # the urls of the imported css are written out as they are
+            self.create_file('late.css', self.producer_css, content="""\
+%s
+.late { background: url('/media/producer/images/missing.png'); }
+""" % _ALREADY_PARSED_MARKER)
+        finally:
+            filertags_signals.CSS_BUNDLE_IMPORTS = usual_bundle_imports
+        css_content = open(File.objects.get(pk=css.pk).path).read()
+        self.assertNotIn('@import', css_content)
+        self.assertIn("/* filertags-import('/media/producer/css/late.css') */", css_content)
+        self.assertIn(".late { background: url('/media/producer/images/missing.png'); }",
+                      css_content)
+
+    def test_deferred_bundle_rebuilds(self):
+        usual_bundle_imports = filertags_signals.CSS_BUNDLE_IMPORTS
+        usual_update_mode = filertags_signals.CSS_UPDATE_MODE
+        filertags_signals.CSS_BUNDLE_IMPORTS = True
+        try:
+            css = self.create_file('main.css', self.producer_css, content="@import 'late.css';\n")
+            filertags_signals.CSS_UPDATE_MODE = 'deferred'
+            self.create_file('late.css', self.producer_css, content=".late { color: red; }\n")
+            # the test case transaction never commits, the rebuild is pending
+            self.assertIn('@import', open(File.objects.get(pk=css.pk).path).read())
+            self.assertEqual(css_updates.get_pending(), set(['/media/producer/css/late.css']))
+            css_updates.flush_pending()
+        finally:
+            filertags_signals.CSS_BUNDLE_IMPORTS = usual_bundle_imports
+            filertags_signals.CSS_UPDATE_MODE = usual_update_mode
+        self.assertIn('.late { color: red; }', open(File.objects.get(pk=css.pk).path).read())
+
+
+class TestMatchFiles(FilerStorageTestCase):
 
     def test_find_hashed_file(self):
         media = Folder.objects.create(name='media')
@@ -189,3 +683,793 @@ class TestMatchFiles(TestCase):
         self.assertIsNone(find_hashed_file(search_path))
         searched_file = create_filer_file("test.txt", folder, content="test")
         self.assertEqual(find_hashed_file(search_path), searched_file)
+
+    def test_find_hashed_file_uses_one_query(self):
+        media = Folder.objects.create(name='media')
+        for i in range(10):
+            create_filer_file("test%d.txt" % i, media, content="test")
+        searched_file = create_filer_file("test.txt", media, content="test")
+        with self.assertNumQueries(1):
+            self.assertEqual(find_hashed_file('/media/test.txt'), searched_file)
+
+
+class ResolutionCacheTest(FilerStorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.media = Folder.objects.create(name='media')
+        self.images = Folder.objects.create(name='images', parent=self.media)
+        self.image = create_filer_file('foobar.png', self.images, content='png')
+
+    def test_warm_lookups_do_not_query(self):
+        url = filerfile('/media/images/foobar.png')
+        filerthumbnail('/media/images/foobar.png')
+        with self.assertNumQueries(0):
+            self.assertEqual(filerfile('/media/images/foobar.png'), url)
+            self.assertEqual(filerthumbnail('media/images/foobar.png').name,
+                             self.image.file.name)
+
+    def test_shared_cache_is_used_when_local_cache_is_cold(self):
+        url = filerfile('/media/images/foobar.png')
+        caching.clear_local()
+        with self.assertNumQueries(0):
+            self.assertEqual(filerfile('/media/images/foobar.png'), url)
+
+    def test_lookups_are_invalidated_when_file_is_deleted(self):
+        filerfile('/media/images/foobar.png')
+        filerthumbnail('/media/images/foobar.png')
+        self.image.delete()
+        self.assertIsNone(filerthumbnail('/media/images/foobar.png'))
+
+    def test_lookups_are_invalidated_when_folder_is_renamed(self):
+        self.assertIsNotNone(filerthumbnail('/media/images/foobar.png'))
+        self.images.name = 'pictures'
+        self.images.save()
+        self.assertIsNone(filerthumbnail('/media/images/foobar.png'))
+        self.assertIsNotNone(filerthumbnail('/media/pictures/foobar.png'))
+
+    def test_misses_are_cached(self):
+        self.assertIsNone(filerthumbnail('/media/images/missing.png'))
+        self.assertEqual(filerfile('/media/images/missing.png'),
+                         filerfile('/media/images/missing.png'))
+        with self.assertNumQueries(0):
+            self.assertIsNone(filerthumbnail('/media/images/missing.png'))
+            filerfile('/media/images/missing.png')
+            filerfiles(['/media/images/missing.png'])
+
+    def test_shared_cache_holds_misses(self):
+        self.assertIsNone(filerthumbnail('/media/images/missing.png'))
+        filerfiles(['/media/images/other.png'])
+        caching.clear_local()
+        # a stored None can't be told from a missing key by most backends
+        key = caching.make_key(caching.FILE, '/media/images/missing.png')
+        self.assertIsNotNone(cache.get(key))
+        with self.assertNumQueries(0):
+            self.assertIsNone(filerthumbnail('/media/images/missing.png'))
+            filerfiles(['/media/images/other.png'])
+
+    def test_cached_miss_is_dropped_when_file_is_created(self):
+        self.assertIsNone(filerthumbnail('/media/images/missing.png'))
+        missing = create_filer_file('missing.png', self.images, content='png')
+        self.assertEqual(filerthumbnail('/media/images/missing.png').name,
+                         missing.file.name)
+
+    def test_misses_are_logged_once_per_interval(self):
+        logger = logging.getLogger('filertags.templatetags.filertags')
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger.addHandler(handler)
+        usual_level = logger.level
+        logger.setLevel(logging.INFO)
+        try:
+            for _ in range(3):
+                caching.clear_local()
+                cache.clear()
+                filerthumbnail('/media/images/unlogged.png')
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(usual_level)
+        self.assertEqual(len(records), 1)
+
+
+class LogicalPathIndexTest(LogicalPathIndexMixin, FilerStorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        folder = None
+        for name in ('media', 'a', 'b', 'c', 'd'):
+            folder = Folder.objects.create(name=name, parent=folder)
+        self.folder = folder
+        self.image = create_filer_file('foobar.png', folder, content='png')
+
+    def test_saved_file_is_indexed(self):
+        self.assertEqual(
+            LogicalPath.objects.lookup('/media/a/b/c/d/foobar.png').pk,
+            self.image.pk)
+
+    def test_deep_path_resolves_with_one_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(filerthumbnail('/media/a/b/c/d/foobar.png').name,
+                             self.image.file.name)
+
+    def test_folder_rename_updates_index(self):
+        parent = Folder.objects.get(name='b')
+        parent.name = 'renamed'
+        parent.save()
+        self.assertIsNone(LogicalPath.objects.lookup('media/a/b/c/d/foobar.png'))
+        self.assertEqual(
+            LogicalPath.objects.lookup('media/a/renamed/c/d/foobar.png').pk,
+            self.image.pk)
+
+    def test_backfill_rebuilds_index(self):
+        LogicalPath.objects.all().delete()
+        call_command('filertags_backfill')
+        self.assertEqual(
+            LogicalPath.objects.lookup('media/a/b/c/d/foobar.png').pk,
+            self.image.pk)
+
+    def test_unindexed_files_are_found_by_walking_the_tree(self):
+        LogicalPath.objects.all().delete()
+        self.assertEqual(filerthumbnail('/media/a/b/c/d/foobar.png').name,
+                         self.image.file.name)
+
+    def test_unindexed_paths_cost_one_query_without_the_fallback(self):
+        LogicalPath.objects.all().delete()
+        usual_fallback = lookups.LOGICAL_PATH_INDEX_FALLBACK
+        lookups.LOGICAL_PATH_INDEX_FALLBACK = False
+        try:
+            with self.assertNumQueries(1):
+                self.assertIsNone(filerthumbnail('/media/a/b/c/d/foobar.png'))
+            with self.assertNumQueries(1):
+                self.assertEqual(lookups.find_files(
+                    ['media/a/b/c/d/foobar.png']), {})
+        finally:
+            lookups.LOGICAL_PATH_INDEX_FALLBACK = usual_fallback
+
+    def test_concurrently_registered_paths_are_updated(self):
+        other = create_filer_file('other.png', self.folder, content='png')
+        path = 'media/a/b/c/d/foobar.png'
+
+        def update_or_create(**kwargs):
+            # another save of the same path got its row in first
+            raise IntegrityError('duplicate path_hash')
+        LogicalPath.objects.update_or_create = update_or_create
+        try:
+            LogicalPath.objects.register(other, path)
+        finally:
+            del LogicalPath.objects.update_or_create
+        self.assertEqual(LogicalPath.objects.lookup(path).pk, other.pk)
+
+    def test_duplicate_paths_resolve_to_the_latest_file(self):
+        image = create_filer_file('foobar.png', self.folder, content='png')
+        # walking the folders can't tell the files apart
+        self.assertEqual(LogicalPath.objects.lookup('media/a/b/c/d/foobar.png').pk,
+                         image.pk)
+
+
+class FolderTreeSnapshotTest(FilerStorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        folder = None
+        for name in ('media', 'a', 'b', 'c', 'd'):
+            folder = Folder.objects.create(name=name, parent=folder)
+        self.image = create_filer_file('foobar.png', folder, content='png')
+        # the folders are walked instead of looking the path up in the index
+        self.usual_index = lookups.LOGICAL_PATH_INDEX
+        lookups.LOGICAL_PATH_INDEX = False
+        lookups.FOLDER_TREE_SNAPSHOT = True
+        filertags_signals.FOLDER_TREE_SNAPSHOT = True
+        folder_tree.reset()
+
+    def tearDown(self):
+        lookups.LOGICAL_PATH_INDEX = self.usual_index
+        lookups.FOLDER_TREE_SNAPSHOT = False
+        filertags_signals.FOLDER_TREE_SNAPSHOT = False
+        folder_tree.reset()
+        super().tearDown()
+
+    def test_only_the_file_is_queried_with_a_loaded_snapshot(self):
+        folder_tree.get_tree()
+        with self.assertNumQueries(1):
+            self.assertEqual(filerthumbnail('/media/a/b/c/d/foobar.png').name,
+                             self.image.file.name)
+        with self.assertNumQueries(0):
+            self.assertIsNone(filerthumbnail('/media/a/missing/c/d/foobar.png'))
+
+    def test_batches_are_resolved_through_the_snapshot(self):
+        folder_tree.get_tree()
+        with self.assertNumQueries(1):
+            found = lookups.walk_folder_trees(
+                ['media/a/b/c/d/foobar.png', 'media/a/b/missing.png'])
+        self.assertEqual(list(found), ['media/a/b/c/d/foobar.png'])
+
+    def test_snapshot_follows_folder_changes(self):
+        tree = folder_tree.get_tree()
+        folder = Folder.objects.get(name='b')
+        folder.name = 'renamed'
+        folder.save()
+        self.assertIsNot(folder_tree.get_tree(), tree)
+        self.assertIsNone(filerthumbnail('/media/a/b/c/d/foobar.png'))
+        self.assertEqual(filerthumbnail('/media/a/renamed/c/d/foobar.png').name,
+                         self.image.file.name)
+        tree = folder_tree.get_tree()
+        Folder.objects.create(name='e', parent=folder)
+        self.assertIsNot(folder_tree.get_tree(), tree)
+
+    def test_snapshot_is_reloaded_when_the_generation_changes(self):
+        tree = folder_tree.get_tree()
+        caching.incr_counter(folder_tree._GENERATION)
+        # other processes see the new generation once their check expires
+        self.assertIs(folder_tree.get_tree(), tree)
+        folder_tree._checked = 0
+        self.assertIsNot(folder_tree.get_tree(), tree)
+
+    def test_old_snapshots_are_reloaded(self):
+        tree = folder_tree.get_tree()
+        tree.loaded -= folder_tree.FOLDER_TREE_MAX_AGE
+        folder_tree._checked = 0
+        self.assertIsNot(folder_tree.get_tree(), tree)
+
+    def test_snapshot_is_reloaded_without_a_shared_counter(self):
+        usual_get_counter = caching.get_counter
+        # what a DummyCache returns
+        caching.get_counter = lambda name: None
+        try:
+            tree = folder_tree.get_tree()
+            self.assertIs(folder_tree.get_tree(), tree)
+            folder_tree._checked = 0
+            self.assertIsNot(folder_tree.get_tree(), tree)
+        finally:
+            caching.get_counter = usual_get_counter
+
+
+class BatchResolutionTest(LogicalPathIndexMixin, FilerStorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        media = Folder.objects.create(name='media')
+        self.images = Folder.objects.create(name='images', parent=media)
+        self.files = dict(
+            ('/media/images/image%d.png' % i,
+             create_filer_file('image%d.png' % i, self.images, content='png'))
+            for i in range(20))
+
+    def test_batch_matches_single_lookups(self):
+        urls = filerfiles(list(self.files) + ['/media/images/missing.png'])
+        cache.clear()
+        caching.clear_local()
+        for path in list(self.files) + ['/media/images/missing.png']:
+            self.assertEqual(urls[path], filerfile(path))
+
+    def test_query_count_does_not_depend_on_batch_size(self):
+        with self.assertNumQueries(1):
+            filerfiles(list(self.files)[:2])
+        with self.assertNumQueries(1):
+            filerfiles(list(self.files)[2:])
+
+    def test_batch_uses_cache(self):
+        filerfiles(self.files)
+        with self.assertNumQueries(0):
+            filerfiles(self.files)
+
+    def test_resolve_many(self):
+        paths = (path for path in list(self.files) + ['/media/images/missing.png'])
+        urls = filertags.resolve_many(paths)
+        self.assertEqual(len(urls), len(self.files) + 1)
+        for path, filer_file in self.files.items():
+            self.assertEqual(urls[path], filer_file.url)
+
+    def test_resolve_many_query_count_does_not_depend_on_batch_size(self):
+        paths = list(self.files)
+        with self.assertNumQueries(1):
+            filertags.resolve_many(paths[:1])
+        with self.assertNumQueries(1):
+            filertags.resolve_many(paths[1:])
+
+    def test_resolve_many_through_the_logical_path_index(self):
+        # the test settings store files under their logical path
+        usual_logical_eq = filertags_templatetags.LOGICAL_EQ_ACTUAL_URL
+        filertags_templatetags.LOGICAL_EQ_ACTUAL_URL = False
+        try:
+            paths = list(self.files)
+            with self.assertNumQueries(1):
+                urls = filertags.resolve_many(paths)
+            urls.update(filertags.resolve_many(['/media/images/missing.png']))
+            self.assertEqual(urls['/media/images/missing.png'], '')
+            for path, filer_file in self.files.items():
+                self.assertEqual(urls[path], filer_file.url)
+            cache.clear()
+            caching.clear_local()
+            for path in paths[:3] + ['/media/images/missing.png']:
+                self.assertEqual(urls[path], filerfile(path))
+        finally:
+            filertags_templatetags.LOGICAL_EQ_ACTUAL_URL = usual_logical_eq
+
+    def test_filerurls_block_rewrites_paths_in_one_batch(self):
+        tmpl = Template(
+            '{% load filertags %}{% filerurls "/media/" %}'
+            '{% for path in paths %}<img src="{{ path }}?v=1">{% endfor %}'
+            '{% endfilerurls %}')
+        with self.assertNumQueries(1):
+            rendered = tmpl.render(Context({'paths': list(self.files)}))
+        for path, filer_file in self.files.items():
+            self.assertIn('<img src="%s?v=1">' % filer_file.url, rendered)
+
+    def test_filerurls_block_keeps_unknown_paths(self):
+        logger = logging.getLogger('filertags.templatetags.filertags')
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger.addHandler(handler)
+        usual_level = logger.level
+        logger.setLevel(logging.INFO)
+        content = ('<a href="/media/about/">about</a><a href="/contact/">contact</a>'
+                   '<script src="//cdn.com/x.js"></script>')
+        try:
+            rendered = Template(
+                '{% load filertags %}{% filerurls "/media/" %}' + content +
+                '{% endfilerurls %}').render(Context())
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(usual_level)
+        self.assertEqual(rendered, content)
+        self.assertEqual(records, [])
+
+    def test_filerurls_block_needs_a_prefix(self):
+        with self.assertRaises(TemplateSyntaxError):
+            Template('{% load filertags %}{% filerurls %}{% endfilerurls %}')
+        with self.assertRaises(TemplateSyntaxError):
+            Template('{% load filertags %}{% filerurls "/" %}'
+                     '<a href="/about/">about</a>{% endfilerurls %}').render(Context())
+
+    def test_filerurls_block_with_prefix(self):
+        path = list(self.files)[0]
+        rendered = Template(
+            '{% load filertags %}{% filerurls "/static/" %}'
+            '<img src="{{ path }}">{% endfilerurls %}').render(Context({'path': path}))
+        self.assertEqual(rendered, '<img src="%s">' % path)
+
+
+class ManifestTest(FilerStorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.manifest_dir = tempfile.mkdtemp()
+        self.usual_manifest = manifest.MANIFEST
+        manifest.MANIFEST = os.path.join(self.manifest_dir, 'manifest.txt')
+        manifest.reset()
+        media = Folder.objects.create(name='media')
+        self.images = Folder.objects.create(name='images', parent=media)
+        self.image = create_filer_file('foobar.png', self.images, content='png')
+        self.path = manifest.get_manifest_path(self.image)
+
+    def tearDown(self):
+        manifest.MANIFEST = self.usual_manifest
+        manifest.reset()
+        shutil.rmtree(self.manifest_dir)
+        super().tearDown()
+
+    def test_exported_manifest_resolves_without_queries(self):
+        call_command('filertags_export_manifest', stdout=io.StringIO())
+        with self.assertNumQueries(0):
+            self.assertEqual(filerfile(self.path), self.image.url)
+            self.assertEqual(filerfiles([self.path]), {self.path: self.image.url})
+
+    def test_manifest_lookups(self):
+        filename = os.path.join(self.manifest_dir, 'sorted.txt')
+        entries = [('media/%d/image%d.png' % (i % 7, i), '/url/%d' % i)
+                   for i in range(100)]
+        self.assertEqual(manifest.write(filename, entries), 100)
+        loaded = manifest.Manifest(filename)
+        self.assertEqual(len(loaded), 100)
+        for path, url in entries:
+            self.assertEqual(loaded.get('/%s' % path), url)
+        self.assertIsNone(loaded.get('media/missing.png'))
+        loaded.close()
+
+    def test_manifest_is_updated_by_the_save_hooks(self):
+        call_command('filertags_export_manifest', stdout=io.StringIO())
+        added = create_filer_file('added.png', self.images, content='png')
+        self.assertEqual(manifest.lookup(manifest.get_manifest_path(added)), added.url)
+        added_path = manifest.get_manifest_path(added)
+        added.delete()
+        self.assertIsNone(manifest.lookup(added_path))
+        self.assertEqual(manifest.lookup(self.path), self.image.url)
+
+    def test_save_hooks_append_to_the_delta(self):
+        call_command('filertags_export_manifest', stdout=io.StringIO())
+        with open(manifest.MANIFEST, 'rb') as manifest_file:
+            exported = manifest_file.read()
+        added = create_filer_file('added.png', self.images, content='png')
+        added_path = manifest.get_manifest_path(added)
+        with open(manifest.MANIFEST, 'rb') as manifest_file:
+            self.assertEqual(manifest_file.read(), exported)
+        delta_name = manifest.MANIFEST + '.delta'
+        self.assertTrue(os.path.exists(delta_name))
+        self.assertEqual(manifest.lookup(added_path), added.url)
+        # exporting again merges the delta
+        call_command('filertags_export_manifest', stdout=io.StringIO())
+        self.assertFalse(os.path.exists(delta_name))
+        self.assertEqual(manifest.lookup(added_path), added.url)
+
+    def test_large_deltas_are_merged(self):
+        call_command('filertags_export_manifest', stdout=io.StringIO())
+        usual_delta_size = manifest.MANIFEST_DELTA_SIZE
+        manifest.MANIFEST_DELTA_SIZE = 0
+        try:
+            added = create_filer_file('added.png', self.images, content='png')
+        finally:
+            manifest.MANIFEST_DELTA_SIZE = usual_delta_size
+        self.assertFalse(os.path.exists(manifest.MANIFEST + '.delta'))
+        loaded = manifest.Manifest(manifest.MANIFEST)
+        self.assertEqual(len(loaded), 2)
+        self.assertEqual(loaded.get(manifest.get_manifest_path(added)), added.url)
+        loaded.close()
+
+    @skipUnless(hasattr(transaction, 'on_commit'), 'needs transaction.on_commit')
+    def test_rolled_back_changes_are_not_appended(self):
+        call_command('filertags_export_manifest', stdout=io.StringIO())
+        try:
+            with transaction.atomic():
+                added = create_filer_file('added.png', self.images, content='png')
+                added_path = manifest.get_manifest_path(added)
+                raise DatabaseError('rolled back')
+        except DatabaseError:
+            pass
+        self.assertFalse(os.path.exists(manifest.MANIFEST + '.delta'))
+        self.assertIsNone(manifest.lookup(added_path))
+
+    def test_replaced_manifest_is_closed(self):
+        call_command('filertags_export_manifest', stdout=io.StringIO())
+        loaded = manifest.get_manifest()
+        manifest.reset()
+        self.assertTrue(loaded._data.closed)
+        self.assertEqual(manifest.lookup(self.path), self.image.url)
+
+    def test_unexported_manifest_is_not_created(self):
+        create_filer_file('added.png', self.images, content='png')
+        self.assertFalse(os.path.exists(manifest.MANIFEST))
+        self.assertEqual(filerfile(self.path), self.image.url)
+
+
+def _rewrite_urls_with_regexes(content, rewrite):
+    """The url rewriting done by resolve_resource_urls before the css
+    scanner was introduced; kept as a reference for fuzzing the scanner.
+    """
+    commented_regions = [
+        (m.start(), m.end()) for m in re.finditer(r"/\*.*?\*/", content)]
+
+    def change_urls(match):
+        for start, end in commented_regions:
+            if start < match.start() < end or start < match.end() < end:
+                return match.group()
+        return rewrite(match.group(1))
+    return re.sub(r"\burl\(([^\)]*)\)", change_urls, content)
+
+
+def _rewrite_urls_with_scanner(content, rewrite):
+    return css_tools.replace_spans(content, [
+        (token.start, token.end, rewrite(token.value))
+        for token in css_tools.iter_tokens(content)
+        if token.kind == css_tools.URL])
+
+
+class CssScannerTest(SimpleTestCase):
+
+    # well formed css fragments on which the scanner has to behave exactly
+    # like the regex based rewriting it replaced
+    fragments = [
+        'a {', ' }', ' ', '\n', 'color: red;', 'background:', '"text"',
+        'url(img.png)', "url('x.png')", 'url( "y.png" )', '-url(d.png)',
+        'xurl(no.png)', 'url(data:image/png;base64,iVBO)', '/* comment */',
+        '/* url(c.png) */', "/* it's */", '/* a *//* b */',
+    ]
+
+    def test_fuzz_against_regex_rewriting(self):
+        rng = random.Random(1234)
+
+        def rewrite(url):
+            return 'url(%s)' % url.upper()
+        for _ in range(5000):
+            content = ''.join(rng.choice(self.fragments)
+                              for _ in range(rng.randint(0, 30)))
+            self.assertEqual(_rewrite_urls_with_regexes(content, rewrite),
+                             _rewrite_urls_with_scanner(content, rewrite))
+
+    def test_chunked_rewriting_matches_whole_rewriting(self):
+        rng = random.Random(4321)
+        fragments = self.fragments + [
+            'url(', '/*', '"', ')', "url('a)b')",
+            "url('z') /* logicalurl('/m/z.png') */"]
+
+        def rewrite_urls(text, tokens):
+            return [(token.start, token.end, 'url(%s)' % token.value.upper())
+                    for token in tokens if token.kind == css_tools.URL]
+
+        def rewrite_annotated_urls(text, tokens):
+            return [(start, end, logical_url) for start, end, logical_url
+                    in css_tools.annotated_urls(text, tokens)]
+        for _ in range(2000):
+            content = ''.join(rng.choice(fragments)
+                              for _ in range(rng.randint(0, 40)))
+            for get_replacements in (rewrite_urls, rewrite_annotated_urls):
+                expected = css_tools.replace_spans(content, get_replacements(
+                    content, list(css_tools.iter_tokens(content))))
+                rewriter = css_tools.CssRewriter(get_replacements)
+                output = []
+                position = 0
+                while position < len(content):
+                    size = rng.randint(1, 7)
+                    output.append(rewriter.feed(content[position:position + size]))
+                    position += size
+                output.append(rewriter.feed('', final=True))
+                self.assertEqual(''.join(output), expected)
+
+    def test_pending_text_stays_bounded(self):
+        rule = 'a { background: url(x.png) }\n'
+        contents = [
+            # minified css whose last url is followed by no other token
+            rule + 'b { color: red }' * 300000,
+            # unterminated strings and comments
+            rule + 'b { content: "' + 'x' * 4000000,
+            rule + '/*' + 'x' * 4000000,
+            "a { background: url(x.png) /* logicalurl('" + 'x' * 4000000]
+        chunk_size = 64 * 1024
+        for content in contents:
+            rewriter = css_tools.CssRewriter(lambda text, tokens: [])
+            output = []
+            for i in range(0, len(content), chunk_size):
+                output.append(rewriter.feed(content[i:i + chunk_size]))
+                self.assertLessEqual(len(rewriter._pending), 2 * chunk_size)
+            output.append(rewriter.feed('', final=True))
+            self.assertEqual(''.join(output), content)
+
+    def test_urls_in_multiline_comments_are_ignored(self):
+        content = "/*\n a { background: url(a.png); }\n*/ b { background: url(b.png); }"
+        self.assertEqual(
+            [token.value for token in css_tools.iter_tokens(content)
+             if token.kind == css_tools.URL],
+            ['b.png'])
+
+    def test_urls_and_comments_in_strings_are_ignored(self):
+        content = 'a { content: "url(a.png) /*"; background: url(b.png); }'
+        self.assertEqual(
+            [(token.kind, token.value) for token in css_tools.iter_tokens(content)],
+            [(css_tools.URL, 'b.png')])
+
+    def test_quoted_url_may_contain_parenthesis(self):
+        content = "a { background: url('a(1).png'); }"
+        self.assertEqual(
+            [token.value for token in css_tools.iter_tokens(content)],
+            ["'a(1).png'"])
+
+    def test_annotated_urls(self):
+        content = ("a { background: url('x') /* logicalurl('/m/x.png') */; "
+                   "color: url('y') /* comment */; }")
+        self.assertEqual(
+            [(content[start:end], logical_url) for start, end, logical_url
+             in css_tools.iter_annotated_urls(content)],
+            [("url('x') /* logicalurl('/m/x.png') */", '/m/x.png')])
+
+
+class InstrumentationTest(FilerStorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        media = Folder.objects.create(name='media')
+        create_filer_file('foobar.png', media, content='png')
+        self.sink = instrumentation.MemorySink()
+        instrumentation.add_sink(self.sink)
+
+    def tearDown(self):
+        instrumentation.remove_sink(self.sink)
+        super().tearDown()
+
+    def test_filerfile_counters_and_timers(self):
+        filerfile('/media/foobar.png')
+        filerfile('/media/foobar.png')
+        filerfile('/media/missing.png')
+        self.assertEqual(self.sink.counters['filerfile.resolved'], 1)
+        self.assertEqual(self.sink.counters['filerfile.cache_hit'], 1)
+        self.assertEqual(self.sink.counters['filerfile.miss'], 1)
+        self.assertEqual(len(self.sink.timings['filerfile']), 3)
+        first, second, _ = self.sink.queries['filerfile']
+        self.assertGreater(first, 0)
+        self.assertEqual(second, 0)
+
+    def test_queries_are_counted_without_being_logged(self):
+        connection.queries_log.clear()
+        filerfile('/media/foobar.png')
+        self.assertGreater(self.sink.queries['filerfile'][0], 0)
+        self.assertEqual(len(connection.queries_log), 0)
+
+    def test_signal_hooks_are_timed(self):
+        create_filer_file('other.png', Folder.objects.get(name='media'), content='png')
+        self.assertEqual(
+            len(self.sink.timings['signals.update_file_lookup_paths']), 1)
+
+    def test_signal_sink(self):
+        recorded = []
+
+        def receiver(metric, **kwargs):
+            recorded.append(metric)
+        instrumentation.metric_recorded.connect(receiver)
+        sink = instrumentation.SignalSink()
+        instrumentation.add_sink(sink)
+        try:
+            filerfile('/media/foobar.png')
+        finally:
+            instrumentation.remove_sink(sink)
+            instrumentation.metric_recorded.disconnect(receiver)
+        self.assertIn('filerfile', [metric.name for metric in recorded])
+
+
+class QueryBudgetTest(LogicalPathIndexMixin, FilerStorageTestCase):
+    """Upper bounds on the queries of the public entry points. None of them
+    may grow with the depth of the folder tree, the number of files being
+    resolved or the number of css files.
+    """
+    # a cold lookup of a path or of a batch of paths
+    RESOLVE_BUDGET = 1
+    # a cold lookup of paths which can't be resolved; stored files are
+    # looked up under their hashed names too
+    MISS_BUDGET = 2
+
+    def setUp(self):
+        super().setUp()
+        attach_css_rewriting_rules()
+
+    def tearDown(self):
+        detach_css_rewriting_rules()
+        super().tearDown()
+
+    def build_tree(self, name, depth, files, images=True):
+        """Creates a chain of depth folders below a root folder and files in
+        the deepest one; returns the deepest folder and the file paths.
+
+        With images, every other file is an Image: the polymorphic File
+        queries fetch the Image rows with an extra query unless the lookups
+        skip the downcast.
+        """
+        folder = Folder.objects.create(name=name)
+        names = [name]
+        for level in range(depth):
+            folder = Folder.objects.create(name='level%d' % level, parent=folder)
+            names.append(folder.name)
+        paths = []
+        for i in range(files):
+            if images and i % 2:
+                file_name = 'image%d.png' % i
+                create_filer_image(file_name, folder)
+            else:
+                file_name = 'file%d.png' % i
+                create_filer_file(file_name, folder, content='png')
+            paths.append('/%s/%s' % ('/'.join(names), file_name))
+        return folder, paths
+
+    def count_queries(self, func, cold=True):
+        if cold:
+            cache.clear()
+            caching.clear_local()
+        with CaptureQueriesContext(connection) as queries:
+            func()
+        return len(queries)
+
+    def test_lookups_do_not_depend_on_tree_depth(self):
+        for depth in (1, 4, 12):
+            _, paths = self.build_tree('depth%d' % depth, depth, 2)
+            for path in paths:
+                for resolver in (filerfile, filerthumbnail):
+                    self.assertLessEqual(
+                        self.count_queries(lambda: resolver(path)),
+                        self.RESOLVE_BUDGET, (resolver.__name__, path))
+
+    def test_cold_misses_do_not_depend_on_tree_depth(self):
+        # the folders are only walked for files saved before the index
+        usual_fallback = lookups.LOGICAL_PATH_INDEX_FALLBACK
+        lookups.LOGICAL_PATH_INDEX_FALLBACK = False
+        try:
+            for depth in (1, 4, 12):
+                _, paths = self.build_tree('miss%d' % depth, depth, 1)
+                folder_path = paths[0].rsplit('/', 1)[0]
+                missing = ['%s/missing.png' % folder_path,
+                           '%s/missing/missing.png' % folder_path]
+                for path in missing:
+                    self.assertLessEqual(
+                        self.count_queries(lambda: filerthumbnail(path)),
+                        self.RESOLVE_BUDGET, (path, depth))
+                self.assertLessEqual(
+                    self.count_queries(lambda: filerfiles(missing)),
+                    self.MISS_BUDGET, depth)
+        finally:
+            lookups.LOGICAL_PATH_INDEX_FALLBACK = usual_fallback
+
+    def test_batch_lookups_do_not_depend_on_batch_size(self):
+        _, paths = self.build_tree('batch', 4, 60)
+        tmpl = Template('{% load filertags %}{% filerurls "/batch/" %}'
+                        '{% for path in paths %}<img src="{{ path }}">{% endfor %}'
+                        '{% endfilerurls %}')
+        for size in (1, 10, 60):
+            batch = paths[:size]
+            self.assertLessEqual(self.count_queries(lambda: filerfiles(batch)),
+                                 self.RESOLVE_BUDGET, size)
+            self.assertLessEqual(
+                self.count_queries(lambda: filertags.resolve_many(batch)),
+                self.RESOLVE_BUDGET, size)
+            self.assertLessEqual(
+                self.count_queries(lambda: tmpl.render(Context({'paths': batch}))),
+                self.RESOLVE_BUDGET, size)
+
+    def test_warm_lookups_do_not_query(self):
+        _, paths = self.build_tree('warm', 6, 3)
+        missing = '/warm/missing.png'
+        for path in paths + [missing]:
+            filerfile(path)
+            filerthumbnail(path)
+        filerfiles(paths + [missing])
+
+        def resolve_all():
+            for path in paths + [missing]:
+                filerfile(path)
+                filerthumbnail(path)
+            filerfiles(paths + [missing])
+        self.assertEqual(self.count_queries(resolve_all, cold=False), 0)
+
+    def test_find_hashed_file_does_not_depend_on_folder_size(self):
+        for files in (2, 40):
+            _, paths = self.build_tree('hashed%d' % files, 2, files)
+            for path in paths[:2]:
+                self.assertLessEqual(
+                    self.count_queries(lambda: find_hashed_file(path)), 1, path)
+
+    def test_css_resolution_does_not_depend_on_url_count(self):
+        folder, paths = self.build_tree('urls', 3, 40)
+        counts = []
+        for urls in (2, 40):
+            content = ''.join('.b%d { background: url(%s); }\n' % (i, path)
+                              for i, path in enumerate(paths[:urls]))
+            counts.append(self.count_queries(lambda: create_filer_file(
+                'style%d.css' % urls, folder, content=content)))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_resource_save_does_not_depend_on_css_count(self):
+        folder, _ = self.build_tree('css', 2, 0)
+        content = '.b { background: url(%s); }\n'
+        counts = []
+        usual_index = filertags_signals.CSS_REFERENCE_INDEX
+        filertags_signals.CSS_REFERENCE_INDEX = True
+        try:
+            for unrelated, name in ((2, 'first.png'), (20, 'second.png')):
+                css_files = File.objects.filter(original_filename__startswith='unrelated')
+                for i in range(css_files.count(), unrelated):
+                    create_filer_file('unrelated%d.css' % i, folder,
+                                      content=content % '/css/level0/level1/unrelated.png')
+                create_filer_file('uses_%s.css' % name, folder,
+                                  content=content % '/css/level0/level1/%s' % name)
+                counts.append(self.count_queries(
+                    lambda: create_filer_file(name, folder, content='png')))
+        finally:
+            filertags_signals.CSS_REFERENCE_INDEX = usual_index
+        self.assertEqual(counts[0], counts[1])
+
+    def test_folder_rename_does_not_depend_on_file_count(self):
+        counts = []
+        for files in (5, 50):
+            top_folder = Folder.objects.create(name='rename%d' % files)
+            folder = Folder.objects.create(name='images', parent=top_folder)
+            for i in range(files):
+                create_filer_file('file%d.png' % i, folder, content='png')
+                create_filer_image('image%d.png' % i, folder)
+
+            def rename():
+                top_folder.name = 'renamed%d' % files
+                top_folder.save()
+            counts.append(self.count_queries(rename))
+        self.assertEqual(counts[0], counts[1])
+
+
+if sys.version_info >= (3, 6):
+    # the async resolvers need async comprehensions
+    from .async_tests import AsyncFallbackTest, AsyncResolutionTest  # noqa: F401